@@ -7,38 +7,333 @@
 
 import os
 import sys
+import copy
+import argparse
 import json
+import time
+import threading
+
+import tracing
+
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 from dotenv import load_dotenv
 load_dotenv()
 
+# Connection settings shared by every AWS client the scripts create
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", 20)),
+    tcp_keepalive=True,
+    retries={
+        "mode": os.getenv("AWS_RETRY_MODE", "standard"),
+        "max_attempts": int(os.getenv("AWS_MAX_ATTEMPTS", 5))
+    }
+)
+
+# Transfer settings shared by every S3 upload the scripts make
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16777216,
+    max_concurrency=20,
+    num_download_attempts=10
+)
+
+# Local state kept between executions (indexes, caches, etc) lives here
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+awsSession = None
+awsClients = {}
+clientLock = threading.Lock()
+clientStats = {"CLIENTS": 0, "SECONDS": 0.0}
+transferManager = None
+transferManagerClient = None
+
+
+def getClient(serviceName):
+    """getClient() : Retrieves the shared AWS client for a service, creating it on first use so that scripts only pay for the clients they actually need
+
+    :param serviceName: boto3 service name (e.g. s3, rekognition, kinesis)
+
+    :return: The boto3 client shared by all scripts in this process
+    """
+    client = awsClients.get(serviceName)
+    if client is None:
+        global awsSession
+        with clientLock:
+            client = awsClients.get(serviceName)
+            if client is None:
+                startTime = time.perf_counter()
+                if awsSession is None:
+                    awsSession = boto3.session.Session()
+                client = tracing.instrumentClient(awsSession.client(serviceName, config=CLIENT_CONFIG))
+                awsClients[serviceName] = client
+                clientStats["CLIENTS"] += 1
+                clientStats["SECONDS"] += time.perf_counter() - startTime
+    return client
+
+
+def setClient(serviceName, client):
+    """setClient() : Replaces the shared client for a service (e.g. with a stubbed or simulated client)
+
+    :param serviceName: boto3 service name to replace the client of
+
+    :param client: Client to use from now on. None removes it so a real one is created on next use
+    """
+    with clientLock:
+        if client is None:
+            awsClients.pop(serviceName, None)
+        else:
+            awsClients[serviceName] = client
+
+
+def getTransferManager():
+    """getTransferManager() : Retrieves the S3 transfer manager shared by all uploads, so that concurrent uploads share one pool of threads and connections instead of building their own per file
+
+    :return: s3transfer TransferManager bound to the shared S3 client
+    """
+    global transferManager, transferManagerClient
+    client = getClient("s3")
+    with clientLock:
+        # Rebuild the manager if the S3 client has been replaced with setClient()
+        if transferManager is None or transferManagerClient is not client:
+            transferManager = create_transfer_manager(client, TRANSFER_CONFIG)
+            transferManagerClient = client
+        return transferManager
+
+
+def getClientStats():
+    """getClientStats() : Reports how many AWS clients have been built in this process and how long building them took
+
+    :return: Dictionary containing the CLIENTS count, total SECONDS and the SERVICES built
+    """
+    return {
+        "CLIENTS": clientStats["CLIENTS"],
+        "SECONDS": round(clientStats["SECONDS"], 4),
+        "SERVICES": sorted(awsClients.keys())
+    }
+
+
+class LazyClient:
+    """LazyClient : Module level stand-in for an AWS client that resolves to the shared client from getClient() when first used"""
+
+    def __init__(self, serviceName):
+        self.serviceName = serviceName
+
+    def __getattr__(self, name):
+        return getattr(getClient(self.serviceName), name)
+
+
+class Response:
+    """Response : Structured result of a library action. It mirrors the TYPE/MESSAGE/CONTENT/CODE envelope that the command line scripts emit"""
+
+    def __init__(self, messageType, code, message, content=None):
+        self.messageType = messageType
+        self.code = code
+        self.message = message
+        self.content = content
+
+    def envelope(self):
+        """envelope() : Produces the envelope dictionary read by the website and other scripts
+
+        :return: Dictionary with the TYPE, MESSAGE, CONTENT (JSON encoded) and CODE keys
+        """
+        return {
+            "TYPE": self.messageType,
+            "MESSAGE": self.message,
+            "CONTENT": json.dumps(self.content),
+            "CODE": self.code
+        }
+
+    def toJson(self):
+        return json.dumps(obj=self.envelope(), indent=2)
+
+
+class ResponseError(Exception):
+    """ResponseError : Raised with the ERROR response of a library action so that it unwinds to the caller without terminating the process"""
+
+    def __init__(self, response):
+        super().__init__(response.message)
+        self.response = response
+
 
 def respond(messageType, code, message, content=None):
-    """respond() : Print/return informational JSON message and sometimes terminate execution
+    """respond() : Builds the informational response of an action, raising it when it is an error
+
     :param messageType: Type of message (ERROR, SUCCESS, etc)
-    :param code: Exit code to terminate execution with
+
+    :param code: Exit code the command line scripts will terminate execution with
+
     :param message: Short message to be sent describing the event
+
     :param content: Optional excess message content (e.g. JSON data) used by the website or other scripts
+
+    :return: The Response object for non-error messages. ERROR messages raise a ResponseError instead
+    """
+    response = Response(messageType, code, message, content)
+    if messageType == "ERROR":
+        raise ResponseError(response)
+
+    return response
+
+
+def invoke(action, *args, **kwargs):
+    """invoke() : Runs a library action, converting a raised ResponseError back into its Response
+
+    :param action: Function to run
+
+    :return: The Response of the action, whether it succeeded or not
+    """
+    try:
+        return action(*args, **kwargs)
+    except ResponseError as e:
+        return e.response
+
+
+def removeResponseFile(responseFile=None):
+    """removeResponseFile() : Deletes an old response file so that a crashed run cannot be mistaken for the previous result
+
+    :param responseFile: Path of the response file. Defaults to RESPONSE_FILE_PATH
+    """
+    responseFile = responseFile or os.getenv("RESPONSE_FILE_PATH")
+    if responseFile is not None and os.path.isfile(responseFile):
+        try:
+            os.remove(responseFile)
+        except Exception as e:
+            print(f"[WARNING] Failed to delete old response json file\n{e}")
+
+
+def addResponseArgument(argumentParser):
+    """addResponseArgument() : Adds the -r option every command line script accepts, to choose where its response file is written
+
+    :param argumentParser: ArgumentParser of the script
     """
-    jsonMessage = json.dumps(
-        obj={
-            "TYPE": messageType,
-            "MESSAGE": message,
-            "CONTENT": json.dumps(content),
-            "CODE": code
-        },
-        indent=2
+    argumentParser.add_argument(
+        "-r", "--response",
+        required=False,
+        help="Path to write the response file to. Defaults to RESPONSE_FILE_PATH. Give each concurrent execution its own path so they do not overwrite each other's response"
     )
+
+
+def parseResponseFile(argv):
+    """parseResponseFile() : Finds the response file path given with -r among the command line arguments, before the script itself parses them (which may fail and still needs responding to)
+
+    :param argv: Command line arguments
+
+    :return: The path given with -r, or None to use RESPONSE_FILE_PATH
+    """
+    argumentParser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    argumentParser.add_argument("-r", "--response")
+    return argumentParser.parse_known_args(argv)[0].response
+
+
+def emit(response, responseFile=None):
+    """emit() : Command line counterpart to respond(). Prints the response envelope, writes it to the response file and terminates execution with the response code
+
+    :param response: Response object to emit
+
+    :param responseFile: Path to write the envelope to. Defaults to RESPONSE_FILE_PATH
+    """
+    jsonMessage = response.toJson()
     print(jsonMessage)
 
-    # Replace response file and exit
-    with open(os.getenv("RESPONSE_FILE_PATH"), "w") as logfile:
-        logfile.write(jsonMessage)
-    sys.exit(code)
+    # Replace the response file in one step so readers never see a partially written file
+    responseFile = responseFile or os.getenv("RESPONSE_FILE_PATH")
+    if responseFile is not None:
+        tempFile = f"{responseFile}.{os.getpid()}.tmp"
+        with open(tempFile, "w") as logfile:
+            logfile.write(jsonMessage)
+        os.replace(tempFile, responseFile)
+    sys.exit(response.code)
+
+
+def writeJsonFile(path, obj):
+    """writeJsonFile() : Writes an object as JSON to a local file in one step, so concurrent readers never see a partially written file
+
+    :param path: Path of the file to replace
+
+    :param obj: JSON serialisable object to write
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tempFile = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tempFile, "w") as jsonFile:
+        # Anything else JSON can't store (e.g. datetimes from boto3) is kept as a string
+        json.dump(obj, jsonFile, default=str)
+    os.replace(tempFile, path)
+
+
+class DiskCache:
+    """DiskCache : Cache of values that rarely change (e.g. AWS metadata). Values are kept in memory and in a JSON file in CACHE_DIR, so later executions reuse them until they expire. Values read back from the file have anything JSON can't store (e.g. datetimes) as strings"""
+
+    def __init__(self, name, ttl):
+        self.path = os.path.join(CACHE_DIR, f"{name}.json")
+        self.ttl = ttl
+        self.entries = {}
+        self.modified = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Reload whenever another execution has replaced the file
+        try:
+            fileStat = os.stat(self.path)
+        except FileNotFoundError:
+            self.entries, self.modified = {}, None
+            return
+        if (fileStat.st_ino, fileStat.st_mtime_ns) != self.modified:
+            try:
+                with open(self.path, "r") as cacheFile:
+                    self.entries = json.load(cacheFile)
+            except ValueError:
+                self.entries = {}
+            self.modified = (fileStat.st_ino, fileStat.st_mtime_ns)
+
+    def save(self):
+        writeJsonFile(self.path, self.entries)
+        fileStat = os.stat(self.path)
+        self.modified = (fileStat.st_ino, fileStat.st_mtime_ns)
+
+    def get(self, key, fetch, refresh=False):
+        """get() : Retrieves a value from the cache, fetching and storing it if it is missing or has expired
+
+        :param key: Key of the value
+
+        :param fetch: Function that retrieves the current value
+
+        :param refresh: If True, the value is always fetched again
+
+        :return: A copy of the value
+        """
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if refresh is False and entry is not None and time.time() - entry["STORED"] < self.ttl:
+                return copy.deepcopy(entry["VALUE"])
+
+        value = fetch()
+        with self.lock:
+            self.load()
+            self.entries[key] = {"VALUE": value, "STORED": time.time()}
+            self.save()
+        return copy.deepcopy(value)
+
+    def invalidate(self, key=None):
+        """invalidate() : Removes a value from the cache so that it is fetched again on next use
+
+        :param key: Key of the value to remove. If not given, every value is removed
+        """
+        with self.lock:
+            self.load()
+            if key is None:
+                self.entries = {}
+            else:
+                self.entries.pop(key, None)
+            self.save()
 
 
 def parseObjectName(fileName):
     """parseObjectName() : Produces a single word identifier for an image
+
     :param fileName: Full path to an S3 or local file
+
     :return: The identifier to be assigned
     """
 
@@ -53,7 +348,9 @@ def parseObjectName(fileName):
 
 def parseImageObject(objectName):
     """parseImageObject() : Ensures that an object name is an image and appends jpg if it isn't
+
     :param objectName: Objectname to be checked and modified
+
     :return: The new objectName
     """
 
@@ -0,0 +1,307 @@
+# -----------------------------------------------------------
+# Resident service that keeps the manager (and its AWS clients) loaded and serves its actions over a local socket
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import os
+import sys
+import json
+import stat
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import commons
+import manager
+import results
+from gesture import gesture_recog
+
+load_dotenv()
+
+DEFAULT_WORKERS = 4
+# Actions waiting for a free worker before further requests are turned away
+DEFAULT_MAX_QUEUED = 16
+# Seconds a turned away client has to finish sending its request
+REJECT_TIMEOUT = 5
+
+
+def envelope(messageType, code, message, content=None):
+    """envelope() : Builds the same TYPE/MESSAGE/CONTENT/CODE object that the manager responds with
+
+    :param messageType: Type of message (ERROR, SUCCESS, etc)
+
+    :param code: Exit code the manager would have terminated with
+
+    :param message: Short message to be sent describing the event
+
+    :param content: Optional excess message content
+
+    :return: The response envelope dictionary
+    """
+    return commons.Response(messageType, code, message, content).envelope()
+
+
+def runAction(args):
+    """runAction() : Runs a single manager action in-process, exactly as if manager.py had been executed with the same arguments
+
+    :param args: List of manager.py command line arguments (e.g. ["-a", "delete", "-p", "foobar"])
+
+    :return: The response envelope dictionary produced by the action
+    """
+    try:
+        argDict = manager.parseArgs(args)
+    except SystemExit:
+        # argparse exits on invalid arguments, it has already logged why
+        return envelope(
+            messageType="ERROR",
+            message=f"Invalid arguments given - {' '.join(args)}",
+            code=13
+        )
+
+    try:
+        response = manager.main(argDict)
+    except Exception as e:
+        return envelope(
+            messageType="ERROR",
+            message=f"Unhandled exception while running {argDict.action}",
+            content={"ERROR": str(e)},
+            code=1
+        )
+
+    print(f"[INFO] {argDict.action} finished with code {response.code}: {response.message}")
+    return response.envelope()
+
+
+class ManagerRequestHandler(BaseHTTPRequestHandler):
+    """ManagerRequestHandler : Accepts POST requests with a JSON body of {"args": [...]} and replies with the manager response envelope"""
+
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket peers have no host/port pair
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def sendJson(self, status, body):
+        payload = json.dumps(body, indent=2).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.sendJson(404, envelope(messageType="ERROR", message=f"No such endpoint {self.path}", code=13))
+
+        return self.sendJson(200, envelope(
+            messageType="SUCCESS",
+            message="Manager service is running",
+            content={"WORKERS": self.server.workers, "MAX_QUEUED": self.server.maxQueued, "AWS_CLIENTS": commons.getClientStats(), "RESULT_CACHE": results.rekognitionResults.getStats()},
+            code=0
+        ))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            args = json.loads(self.rfile.read(length))["args"]
+            if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+                raise ValueError("args must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            return self.sendJson(400, envelope(
+                messageType="ERROR",
+                message='Request body must be a JSON object of the form {"args": [...]}',
+                content={"ERROR": str(e)},
+                code=13
+            ))
+
+        self.sendJson(200, runAction(args))
+
+
+class BusyRequestHandler(ManagerRequestHandler):
+    """BusyRequestHandler : Replies to actions with 503 when too many are already waiting for a worker"""
+
+    timeout = REJECT_TIMEOUT
+
+    def handle(self):
+        # Rejections are answered by the thread accepting connections, so never keep the connection alive for another request
+        self.handle_one_request()
+
+    def do_POST(self):
+        # Read the body so the client gets the reply rather than a reset connection
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.sendJson(503, envelope(
+            messageType="ERROR",
+            message=f"Manager service is busy, {self.server.maxQueued} actions are already waiting. Try again later",
+            code=30
+        ))
+
+
+class PooledServerMixIn:
+    """PooledServerMixIn : Handles each connection on a bounded pool of worker threads instead of a new thread per request, turning connections away once too many are waiting"""
+
+    workers = DEFAULT_WORKERS
+    maxQueued = DEFAULT_MAX_QUEUED
+    pool = None
+    slots = None
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            return self.rejectRequest(request, client_address)
+        self.pool.submit(self.processPooledRequest, request, client_address)
+
+    def processPooledRequest(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def rejectRequest(self, request, client_address):
+        try:
+            BusyRequestHandler(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class UnixManagerServer(PooledServerMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+class TcpManagerServer(PooledServerMixIn, HTTPServer):
+    pass
+
+
+def createServer(socketPath=None, port=None, workers=DEFAULT_WORKERS, maxQueued=DEFAULT_MAX_QUEUED):
+    """createServer() : Binds the manager service to a Unix socket or a localhost TCP port
+
+    :param socketPath: Path of the Unix socket to listen on (takes priority over port)
+
+    :param port: Localhost TCP port to listen on. This is unauthenticated, so any local user can run actions through it
+
+    :param workers: Maximum number of actions to run at the same time
+
+    :param maxQueued: Maximum number of actions waiting for a worker, further requests are answered with 503
+
+    :return: The bound (but not yet serving) server
+    """
+    if socketPath is not None:
+        # Remove a socket left behind by a previous run, but never anything else that happens to be at that path
+        if os.path.lexists(socketPath):
+            if not stat.S_ISSOCK(os.lstat(socketPath).st_mode):
+                raise FileExistsError(f"{socketPath} exists and is not a socket, refusing to replace it")
+            os.remove(socketPath)
+        # Only the user running the service may connect, as any action (e.g. -a delete) can be requested.
+        # The socket is created with this mode rather than changed after binding, so it is never briefly open to others
+        previousUmask = os.umask(0o177)
+        try:
+            server = UnixManagerServer(socketPath, ManagerRequestHandler)
+        finally:
+            os.umask(previousUmask)
+    else:
+        # There is no authentication, so any local user can request any action over TCP. Prefer the socket
+        server = TcpManagerServer(("127.0.0.1", port), ManagerRequestHandler)
+
+    server.workers = workers
+    server.maxQueued = maxQueued
+    server.slots = threading.BoundedSemaphore(workers + maxQueued)
+    server.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="manager")
+    return server
+
+
+def reapModel(stop, interval):
+    """reapModel() : Stops the gesture model whenever it has been idle for GESTURE_MODEL_IDLE_TIMEOUT seconds, until the service shuts down
+
+    :param stop: threading.Event set when the service shuts down
+
+    :param interval: Seconds between each check
+    """
+    while not stop.wait(interval):
+        try:
+            gesture_recog.reapModel()
+        except commons.ResponseError as e:
+            print(f"[WARNING] Failed to stop the idle gesture model: {e.response.message}")
+        except Exception as e:
+            print(f"[WARNING] Failed to check if the gesture model is idle: {e}")
+
+
+#########
+# START #
+#########
+def main(argv):
+    """main() : Main method that parses the input opts and serves manager actions until interrupted"""
+    argumentParser = argparse.ArgumentParser(
+        description="Runs the manager as a resident service so that each action does not pay for interpreter startup and AWS client construction. POST {\"args\": [...manager.py arguments...]} to / and the response envelope is returned in the body.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    argumentParser.add_argument(
+        "-s", "--socket",
+        required=False,
+        default=os.getenv("MANAGER_SOCKET_PATH"),
+        help="Path of the Unix socket to listen on. Defaults to MANAGER_SOCKET_PATH"
+    )
+    argumentParser.add_argument(
+        "-p", "--port",
+        required=False,
+        type=int,
+        default=os.getenv("MANAGER_PORT"),
+        help="Localhost TCP port to listen on if no socket is given. Defaults to MANAGER_PORT. WARNING: TCP mode is unauthenticated, any local user can run any action (including -a delete). Use --socket, which only its owner can connect to"
+    )
+    argumentParser.add_argument(
+        "-w", "--workers",
+        required=False,
+        type=int,
+        default=int(os.getenv("MANAGER_WORKERS", DEFAULT_WORKERS)),
+        help=f"Maximum number of actions to run at the same time. Defaults to MANAGER_WORKERS or {DEFAULT_WORKERS}"
+    )
+    argumentParser.add_argument(
+        "-q", "--max-queued",
+        required=False,
+        type=int,
+        default=int(os.getenv("MANAGER_MAX_QUEUED", DEFAULT_MAX_QUEUED)),
+        help=f"Maximum number of actions waiting for a worker before further requests are answered with 503. Defaults to MANAGER_MAX_QUEUED or {DEFAULT_MAX_QUEUED}"
+    )
+    argDict = argumentParser.parse_args(argv)
+
+    if argDict.socket is None and argDict.port is None:
+        argumentParser.error("One of --socket or --port must be given")
+
+    server = createServer(argDict.socket, argDict.port, argDict.workers, argDict.max_queued)
+    location = argDict.socket if argDict.socket is not None else f"127.0.0.1:{argDict.port}"
+    print(f"[SUCCESS] Manager service listening on {location} with {argDict.workers} workers")
+
+    # Keep the gesture model warm between actions, stopping it once it has been idle for long enough
+    stopReaper = threading.Event()
+    if gesture_recog.MODEL_IDLE_TIMEOUT > 0:
+        interval = min(60, max(1, gesture_recog.MODEL_IDLE_TIMEOUT / 4))
+        threading.Thread(target=reapModel, args=(stopReaper, interval), name="reaper", daemon=True).start()
+        print(f"[INFO] Gesture model will be stopped after {gesture_recog.MODEL_IDLE_TIMEOUT:.0f}s without use")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("[INFO] Shutting down manager service...")
+    finally:
+        stopReaper.set()
+        server.server_close()
+        if argDict.socket is not None and os.path.exists(argDict.socket):
+            os.remove(argDict.socket)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
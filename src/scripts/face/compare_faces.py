@@ -5,24 +5,43 @@
 # Released under GNU GPL v3 License
 # -----------------------------------------------------------
 
-import boto3
 import botocore
 import os
+import numpy as np
 import json
 import sys
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv
 load_dotenv()
 
 sys.path.append(os.path.dirname(__file__) + "/..")
-import commons  # noqa: E402,F401
+import commons  # noqa: E402
+import images  # noqa: E402
+import tracing  # noqa: E402
 import time  # noqa: E402
+from face import index_photo  # noqa: E402
 
-rekog = boto3.client("rekognition")
-kinesis = boto3.client("kinesis")
-knVideo = boto3.client("kinesisvideo")
+rekog = commons.LazyClient("rekognition")
+kinesis = commons.LazyClient("kinesis")
+knVideo = commons.LazyClient("kinesisvideo")
 
+# Captured landmarks further than this (in X or Y, as a fraction of the image) from the stored ones are treated as a presentation attack
+ATTACK_THRESHOLD = 0.09
+KEY_LANDMARKS = ["eyeLeft", "eyeRight", "nose", "mouthLeft", "mouthRight"]
+# Compare "all" of Rekognition's landmarks instead of only the "key" ones, optionally aligning the faces first
+ATTACK_ALL_LANDMARKS = os.getenv("PRESENTATION_ATTACK_LANDMARKS", "key") == "all"
+ATTACK_ALIGN = os.getenv("PRESENTATION_ATTACK_ALIGN", "false").lower() == "true"
 
+# Kinesis allows 5 get_records calls per second per shard, so never poll a shard faster than this
+MIN_POLL_INTERVAL = 1 / 5
+# Longest a quiet shard goes unread. Higher values use fewer reads but can delay spotting a face by up to this long
+MAX_POLL_INTERVAL = float(os.getenv("KINESIS_MAX_POLL_INTERVAL", 1))
+
+
+@tracing.traced
 def compareFaces(localImage, username):
     """
     compareFaces() : Compares a locally stored image (or captured stream frame) with a user's stored S3 face
@@ -34,101 +53,93 @@ def compareFaces(localImage, username):
     :return: Empty FaceMatches list if no face was found, face comparison details otherwise
     """
     try:
-        with open(localImage, "rb") as fileBytes:
-            return rekog.compare_faces(
-                SourceImage={
-                    'Bytes': fileBytes.read(),
-                },
-                TargetImage={
-                    'S3Object': {
-                        'Bucket': os.getenv('FACE_RECOG_BUCKET'),
-                        'Name': f"users/{username}/{username}.jpg"
-                    }
-                },
-                SimilarityThreshold=95,
-                QualityFilter='AUTO'
-            )
+        return rekog.compare_faces(
+            SourceImage={
+                'Bytes': images.fitImage(localImage),
+            },
+            TargetImage={
+                'S3Object': {
+                    'Bucket': os.getenv('FACE_RECOG_BUCKET'),
+                    'Name': f"users/{username}/{username}.jpg"
+                }
+            },
+            SimilarityThreshold=95,
+            QualityFilter='AUTO'
+        )
     except rekog.exceptions.InvalidParameterException:
         return {"FaceMatches": []}
 
 
-def examineFace(record):
+def candidateFace(record):
     """
-    examineFace() : Decode and parse the shard bytes to extract a high matching face object. Once found, verify it is a real face by comparing the landmarks
+    candidateFace() : Decode and parse the shard bytes to extract a high matching face object that still needs checking for a presentation attack
 
     :param record: Shard containing frames and fragment numbers
 
-    :return: The matched face object with the highest similarity to the detected face or None if it is not a real face or no matches were found
+    :return: Tuple of the matched face object with the highest similarity, the landmarks of the detected face and the matched user. None if no face matched closely enough
     """
     jsonData = json.loads(record["Data"])
-    matchedFaces = None
     try:
         # NOTE: This will only check one face in the stream. This is intentional as the system gets overly complex and insecure when more than one face is trying to authenticate.
         matchedFaces = jsonData["FaceSearchResponse"][0]["MatchedFaces"]
     except IndexError:
-        return matchedFaces
+        return None
 
-    # If only one matched face was found, use that.
-    if len(matchedFaces) == 1:
+    # Just return nothing if no faces were found
+    if len(matchedFaces) == 0:
+        return None
 
-        # Verify face is similar enough
-        if matchedFaces[0]["Similarity"] < 95:
-            return None
+    # Find the greatest confident face if there is more than one, then verify it is similar enough
+    matchedFace = max(matchedFaces, key=lambda ev: ev["Similarity"])
+    if matchedFace["Similarity"] < 95:
+        return None
 
-        # Verify face is not a presentation attack
-        sourceLandmarks = jsonData["FaceSearchResponse"][0]["DetectedFace"]["Landmarks"]
-        try:
-            username = matchedFaces[0]['Face']['ExternalImageId'].split('.jpg')[0]
-        except Exception:
-            username = matchedFaces[0]['Face']['ExternalImageId'].split('.png')[0]
+    sourceLandmarks = jsonData["FaceSearchResponse"][0]["DetectedFace"]["Landmarks"]
+    username = matchedFace['Face']['ExternalImageId'].split('.jpg')[0]
+    return matchedFace, sourceLandmarks, username
 
-        try:
-            targetLandmarks = rekog.detect_faces(
-                Image={'S3Object': {
-                    'Bucket': os.getenv('FACE_RECOG_BUCKET'),
-                    'Name': f"users/{username}/{username}.jpg"
-                }}
-            )["FaceDetails"][0]["Landmarks"]
-        except botocore.exceptions.HTTPClientError:
-            # Special case as when the signal handler cancels the script during a net request, it will raise this exception
-            raise TimeoutError
 
-        if checkPresentationAttack(sourceLandmarks, targetLandmarks, username) is False:
-            return matchedFaces[0]
-        else:
-            return None
-    # Find the greatest confident face if there is more than one
-    elif len(matchedFaces) > 1:
-        # Verify top face is similar enough
-        matchedFace = max(matchedFaces, key=lambda ev: ev["Similarity"])
-        if matchedFace["Similarity"] < 95:
-            return None
+@tracing.traced
+def examineFaces(records):
+    """
+    examineFaces() : Extracts the high matching faces from a batch of records and verifies they are real faces by comparing the landmarks. The candidates of each user are checked together in one call
 
-        # Verify top face is not a presentation attack
-        sourceLandmarks = jsonData["FaceSearchResponse"][0]["DetectedFace"]["Landmarks"]
-        try:
-            username = matchedFace['Face']['ExternalImageId'].split('.jpg')[0]
-        except Exception:
-            username = matchedFace['Face']['ExternalImageId'].split('.png')[0]
+    :param records: Shard records containing frames and fragment numbers
 
+    :return: The matched face object of the earliest record with a real matching face, or None if there were none
+    """
+    candidates = [candidate for candidate in map(candidateFace, records) if candidate is not None]
+    if candidates == []:
+        return None
+
+    attacks = [None] * len(candidates)
+    for username in set(candidate[2] for candidate in candidates):
+        positions = [position for position, candidate in enumerate(candidates) if candidate[2] == username]
         try:
-            targetLandmarks = rekog.detect_faces(
-                Image={'S3Object': {
-                    'Bucket': os.getenv('FACE_RECOG_BUCKET'),
-                    'Name': f"users/{username}/{username}.jpg"
-                }}
-            )["FaceDetails"][0]["Landmarks"]
+            targetLandmarks = index_photo.getFaceDetails(username)["Landmarks"]
         except botocore.exceptions.HTTPClientError:
             # Special case as when the signal handler cancels the script during a net request, it will raise this exception
             raise TimeoutError
 
-        if checkPresentationAttack(sourceLandmarks, targetLandmarks, username) is False:
-            return matchedFace
-        else:
-            return None
-    # Just return nothing if no faces were found
-    else:
-        return None
+        userAttacks = checkPresentationAttacks([candidates[position][1] for position in positions], targetLandmarks)
+        for position, attack in zip(positions, userAttacks):
+            attacks[position] = attack
+
+    for candidate, attack in zip(candidates, attacks):
+        if not attack:
+            return candidate[0]
+    return None
+
+
+def examineFace(record):
+    """
+    examineFace() : Decode and parse the shard bytes to extract a high matching face object. Once found, verify it is a real face by comparing the landmarks
+
+    :param record: Shard containing frames and fragment numbers
+
+    :return: The matched face object with the highest similarity to the detected face or None if it is not a real face or no matches were found
+    """
+    return examineFaces([record])
 
 
 def createShardIterator(shardId):
@@ -146,7 +157,93 @@ def createShardIterator(shardId):
     )["ShardIterator"]
 
 
-def checkPresentationAttack(sourceLandmarks, targetLandmarks, user):
+def landmarkArray(landmarks, landmarkTypes, decimals=None):
+    """landmarkArray() : Converts a Rekognition landmarks list into an array of positions
+
+    :param landmarks: Array of landmarks as returned by Rekognition
+
+    :param landmarkTypes: Landmark types to take the positions of, in order
+
+    :param decimals: Optional number of decimals to round each coordinate to
+
+    :return: Array of shape (len(landmarkTypes), 2) holding the X and Y of each landmark, NaN where a landmark is missing
+    """
+    positions = {}
+    for mark in landmarks:
+        if decimals is None:
+            positions[mark["Type"]] = (mark["X"], mark["Y"])
+        else:
+            positions[mark["Type"]] = (round(mark["X"], decimals), round(mark["Y"], decimals))
+    return np.array([positions.get(landmarkType, (np.nan, np.nan)) for landmarkType in landmarkTypes], dtype=float)
+
+
+def alignLandmarks(sources, target):
+    """alignLandmarks() : Moves, rotates and scales each set of source landmarks onto the target landmarks (a least squares similarity transform) so that only differences in the face's shape remain
+
+    :param sources: Array of shape (frames, landmarks, 2) of the source landmark positions
+
+    :param target: Array of shape (landmarks, 2) of the target landmark positions
+
+    :return: Array of the aligned source landmark positions, the same shape as sources
+    """
+    sourceMean = sources.mean(axis=1, keepdims=True)
+    targetMean = target.mean(axis=0)
+    centredSources = sources - sourceMean
+    centredTarget = target - targetMean
+
+    # Best rotation from the SVD of each frame's covariance, avoiding reflections
+    u, sigma, vt = np.linalg.svd(np.einsum("nki,kj->nij", centredSources, centredTarget))
+    reflection = np.sign(np.linalg.det(np.einsum("nij,njk->nik", u, vt)))
+    sigma[:, -1] *= reflection
+    u[:, :, -1] *= reflection[:, None]
+    rotation = np.einsum("nij,njk->nik", u, vt)
+
+    variance = (centredSources ** 2).sum(axis=(1, 2))
+    scale = np.divide(sigma.sum(axis=1), variance, out=np.ones_like(variance), where=variance > 0)
+    return scale[:, None, None] * np.einsum("nki,nij->nkj", centredSources, rotation) + targetMean
+
+
+def checkPresentationAttacks(sourceLandmarksBatch, targetLandmarks, allLandmarks=None, align=None, threshold=ATTACK_THRESHOLD):
+    """checkPresentationAttacks() : Compares the landmarks of a batch of captured frames with a user's stored landmarks in one go, to see if each frame is close enough to confirm the application is not being subjected to a presentation attack
+
+    :param sourceLandmarksBatch: List of landmarks arrays, one per captured frame
+
+    :param targetLandmarks: Array of landmarks from the target image
+
+    :param allLandmarks: If True, every landmark of the target image is compared rather than just the eyes, nose and mouth. Defaults to PRESENTATION_ATTACK_LANDMARKS
+
+    :param align: If True, each frame's landmarks are aligned onto the target's before comparing them. Defaults to PRESENTATION_ATTACK_ALIGN
+
+    :param threshold: Largest difference allowed between the X or Y of a source and target landmark
+
+    :return: Array of booleans, True where an attack is occurring
+    """
+    if allLandmarks is None:
+        allLandmarks = ATTACK_ALL_LANDMARKS
+    if align is None:
+        align = ATTACK_ALIGN
+
+    if allLandmarks:
+        landmarkTypes = [mark["Type"] for mark in targetLandmarks]
+        decimals = None
+    else:
+        # Rounded exactly as the landmarks have always been compared
+        landmarkTypes = KEY_LANDMARKS
+        decimals = 3
+
+    target = landmarkArray(targetLandmarks, landmarkTypes, decimals)
+    sources = np.stack([landmarkArray(landmarks, landmarkTypes, decimals) for landmarks in sourceLandmarksBatch])
+
+    # Frames with a missing landmark are always attacks (a NaN difference never passes the threshold)
+    missing = np.isnan(sources).any(axis=(1, 2)) | np.isnan(target).any()
+    if align and not missing.all():
+        sources[~missing] = alignLandmarks(sources[~missing], np.nan_to_num(target))
+
+    withinThreshold = np.abs(sources - target) <= threshold
+    return missing | ~withinThreshold.all(axis=(1, 2))
+
+
+def checkPresentationAttack(sourceLandmarks, targetLandmarks, user, allLandmarks=None, align=None):
     """checkPresentationAttack() : Takes in two landmarks arrays and compares the key features to see if they are close enough to confirm the application is not being subjected to a presentation attack
 
     :param sourceLandmarks: Array of landmarks from the source image
@@ -155,40 +252,97 @@ def checkPresentationAttack(sourceLandmarks, targetLandmarks, user):
 
     :param user: User that is attempting to authenticate
 
+    :param allLandmarks: If True, every landmark is compared rather than just the eyes, nose and mouth. Defaults to PRESENTATION_ATTACK_LANDMARKS
+
+    :param align: If True, the source landmarks are aligned onto the target's before comparing them. Defaults to PRESENTATION_ATTACK_ALIGN
+
     :return: True if an attack is occurring, false otherwise
     """
-    threshold = 0.09
-    attack = False
-    for landmarkEntry in ["eyeLeft", "eyeRight", "nose", "mouthLeft", "mouthRight"]:
-        # Get matching landmark in source and target
-        sourceMark = next((item for item in sourceLandmarks if item['Type'] == landmarkEntry), None)
-        if sourceMark is None:
-            attack = True
-            break
-        targetMark = next((item for item in targetLandmarks if item['Type'] == landmarkEntry), None)
-
-        # Compare the positions of each within a certain threshold, fail if they are not within it
-        xDiff = abs(round(sourceMark["X"], 3) - round(targetMark["X"], 3))
-        yDiff = abs(round(sourceMark["Y"], 3) - round(targetMark["Y"], 3))
-        if ((xDiff <= threshold) is False) or ((yDiff <= threshold) is False):  # noqa: E712
-            attack = True
-            break
-
-    return attack
-
-
-def examineShard(shardJson):
+    return bool(checkPresentationAttacks([sourceLandmarks], targetLandmarks, allLandmarks, align)[0])
+
+
+class ShardPoller:
+    """ShardPoller : Paces the get_records calls for a single shard. It stays within the shard's read budget, polls as fast as allowed while records are arriving (or the consumer is behind the stream) and backs off with jitter while the stream is quiet"""
+
+    def __init__(self, minInterval=MIN_POLL_INTERVAL, maxInterval=MAX_POLL_INTERVAL):
+        self.minInterval = minInterval
+        self.maxInterval = max(maxInterval, minInterval)
+        self.backoff = minInterval
+        self.interval = minInterval
+        self.lastPoll = None
+
+    def wait(self, deadline=None, stop=None):
+        """wait() : Sleeps until the next get_records call is due, waking early if the search is stopped
+
+        :param deadline: Optional epoch time the wait will not go past
+
+        :param stop: Optional threading.Event that ends the wait as soon as it is set
+
+        :return: False if the search was stopped while waiting, True otherwise
+        """
+        if self.lastPoll is not None:
+            delay = self.lastPoll + self.interval - time.monotonic()
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+            if delay > 0:
+                if stop is not None:
+                    if stop.wait(delay):
+                        return False
+                else:
+                    time.sleep(delay)
+
+        self.lastPoll = time.monotonic()
+        return True
+
+    def update(self, records):
+        """update() : Adjusts the polling interval from the result of a get_records call
+
+        :param records: get_records response
+        """
+        if records["Records"] != [] or records.get("MillisBehindLatest", 0) > 0:
+            # Faces are arriving or we have fallen behind, read as quickly as the budget allows
+            self.backoff = self.minInterval
+            self.interval = self.minInterval
+        else:
+            # Quiet stream, back off exponentially with full jitter so shards are not polled in lockstep
+            self.backoff = min(self.maxInterval, self.backoff * 2)
+            self.interval = random.uniform(self.minInterval, self.backoff)
+
+    def throttled(self):
+        """throttled() : Backs off as far as allowed after the shard's read budget was exceeded"""
+        self.backoff = self.maxInterval
+        self.interval = random.uniform(self.maxInterval / 2, self.maxInterval)
+
+
+@tracing.traced
+def examineShard(shardJson, deadline=None, stop=None, poller=None):
     """
     examineShard() : Iterates through the latest shards obtained from the stream, retrieving the matched faces data for each shard
 
     :param shardJson: Details of the shard
 
+    :param deadline: Optional epoch time after which a TimeoutError is raised. Used when the caller cannot rely on a signal alarm (e.g. outside the main thread)
+
+    :param stop: Optional threading.Event that, once set, makes the search give up and return None (e.g. because another shard found the face)
+
+    :param poller: Optional ShardPoller pacing the reads. Defaults to one within the shard's read budget
+
     :return: The face that closest matches the detected face in the stream
     """
     iterator = createShardIterator(shardJson["ShardId"])
+    if poller is None:
+        poller = ShardPoller()
     faceFound = None
+    quiet = False
 
     while faceFound is None:
+        if poller.wait(deadline, stop) is False:
+            return None
+        if stop is not None and stop.is_set():
+            return None
+        if deadline is not None and time.time() > deadline:
+            raise TimeoutError
+
         try:
             # Get data from stream using the created iterator
             try:
@@ -199,23 +353,28 @@ def examineShard(shardJson):
                 # Special case as when the signal handler cancels the script during a get records, it will raise this exception
                 raise TimeoutError
 
-            # If records array empty, try adjacent shard and iterate until timeout expires or face is found
+            poller.update(records)
+            iterator = records.get("NextShardIterator")
+
+            # If records array empty, wait for the next batch until timeout expires or face is found
             if records["Records"] == []:
-                print(f"[WARNING] No records were found in shard {shardJson['ShardId']}. Trying next shard with same iterator...")
-                iterator = records['NextShardIterator']
-                continue
+                if quiet is False:
+                    print(f"[INFO] No records in shard {shardJson['ShardId']} yet, polling every {poller.minInterval:.1f}-{poller.maxInterval:.1f}s until there are...")
+                    quiet = True
             else:
-                # Iterate through data records and see if there is a matching face. If there is, break loop
-                for record in records["Records"]:
-                    faceFound = examineFace(record)
+                quiet = False
+                # Check the whole batch of records for a matching face at once
+                faceFound = examineFaces(records["Records"])
 
-                    if faceFound is not None:
-                        break
+            if faceFound is None and iterator is None:
+                # The shard has been closed (e.g. resharded), nothing more will ever arrive on it
+                print(f"[WARNING] Shard {shardJson['ShardId']} has been closed")
+                return None
 
-        # API is being spammed. Sleep to let it recover
+        # API is being spammed. Back off to let it recover
         except kinesis.exceptions.ProvisionedThroughputExceededException:
-            print("[WARNING] Exceeded AWS API limit for get-records. Sleeping and trying again...")
-            time.sleep(0.5)
+            print("[WARNING] Exceeded AWS API limit for get-records. Backing off and trying again...")
+            poller.throttled()
         # Shard Iterator has expired.
         except kinesis.exceptions.ExpiredIteratorException:
             print("[WARNING] Shard iterator has expired. Creating a new one now...")
@@ -227,8 +386,13 @@ def examineShard(shardJson):
 #########
 # START #
 #########
-def checkForFaces():
-    """checkForFaces() : Main method that handles all interactions with the stream and indicies. Note: this package is not supposed to be run directly, it should be instantiated from image_manager.py"""
+def checkForFaces(deadline=None):
+    """checkForFaces() : Main method that handles all interactions with the stream and indicies. Note: this package is not supposed to be run directly, it should be instantiated from image_manager.py
+
+    :param deadline: Optional epoch time after which the search is abandoned with a TimeoutError
+
+    :return: The first matched face found in any of the stream's shards
+    """
 
     # Create & Start/Restart Stream Processer if it hasn"t been already
     try:
@@ -275,9 +439,33 @@ def checkForFaces():
         }
     )["Shards"]
 
-    # Iterate through the shards
-    for shard in shards:
-        matchedFace = examineShard(shard)
+    return searchShards(shards, deadline)
+
 
-    # We will always return a successfull face or be forcibly aborted by the manager timeout
-    return matchedFace
+@tracing.traced
+def searchShards(shards, deadline=None, newPoller=ShardPoller):
+    """searchShards() : Reads every given shard at the same time (e.g. one per camera), the first shard to find a face stops the rest
+
+    :param shards: Shards of the camera data stream to read
+
+    :param deadline: Optional epoch time after which the search is abandoned with a TimeoutError
+
+    :param newPoller: Creates the ShardPoller pacing each shard's reads
+
+    :return: The first matched face found in any of the shards
+    """
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=max(len(shards), 1), thread_name_prefix="shard")
+    try:
+        consumers = [pool.submit(tracing.wrap(examineShard), shard, deadline, stop, newPoller()) for shard in shards]
+        for consumer in as_completed(consumers):
+            matchedFace = consumer.result()
+            if matchedFace is not None:
+                return matchedFace
+
+        # Consumers only stop without a face once the deadline has passed (or their shards were closed)
+        raise TimeoutError
+    finally:
+        # Also reached when the manager timeout aborts us, so the consumers (and their shard iterators) never outlive the search
+        stop.set()
+        pool.shutdown(wait=True)
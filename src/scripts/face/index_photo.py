@@ -6,68 +6,252 @@
 # -----------------------------------------------------------
 
 import commons
-
-import boto3
+import images
+import tracing
 
 import os
 import argparse
 import json
-from PIL import Image
+import time
+import fcntl
+import threading
 from dotenv import load_dotenv
 
 import sys
 sys.path.append(os.path.dirname(__file__) + "/..")
 
-client = boto3.client('rekognition')
+client = commons.LazyClient('rekognition')
+s3Client = commons.LazyClient('s3')
 load_dotenv()
 
+# Local index of the collection's faces by ExternalImageId, kept up to date by add/remove. Rebuild it with -a rebuild if the collection is changed elsewhere
+# Each collection has its own index in CACHE_DIR, unless FACE_INDEX_PATH names one file to use
+FACE_INDEX_PATH = os.getenv("FACE_INDEX_PATH") or None
+faceIndex = None
+faceIndexModified = None
+faceIndexLock = threading.Lock()
+
+# Enrolled face details (landmarks, quality, etc) never change between enrolments, so they are stored next to the face and kept in memory
+FACE_DETAILS_ATTRIBUTES = ["BoundingBox", "Landmarks", "Pose", "Quality", "Confidence"]
+FACE_DETAILS_CACHE_TTL = float(os.getenv("FACE_DETAILS_CACHE_TTL", 300))
+faceDetailsCache = {}
+faceDetailsLock = threading.Lock()
+
+
+def faceDetailsKey(username):
+    """faceDetailsKey() : S3 key of the sidecar file holding a user's enrolled face details
+    :param username: User the face belongs to
+    :return: S3 object key
+    """
+    return f"users/{username}/FaceDetails.json"
+
+
+def saveFaceDetails(username, faceDetail):
+    """saveFaceDetails() : Stores the compact details of a newly enrolled face in S3 and the in-process cache
+    :param username: User the face belongs to
+    :param faceDetail: FaceDetail object returned by index_faces or detect_faces with all attributes
+    :return: The compact face details that were stored
+    """
+    faceDetails = {attribute: faceDetail[attribute] for attribute in FACE_DETAILS_ATTRIBUTES if attribute in faceDetail}
+    s3Client.put_object(
+        Body=json.dumps(faceDetails).encode("utf-8"),
+        Bucket=os.getenv("FACE_RECOG_BUCKET"),
+        Key=faceDetailsKey(username)
+    )
+    with faceDetailsLock:
+        faceDetailsCache[username] = (faceDetails, time.monotonic())
+    return faceDetails
+
+
+def forgetFaceDetails(username):
+    """forgetFaceDetails() : Removes a user's face details from the in-process cache
+    :param username: User to forget the face details of
+    """
+    with faceDetailsLock:
+        faceDetailsCache.pop(username, None)
+
+
+def getFaceDetails(username):
+    """getFaceDetails() : Retrieves the details (e.g. landmarks) of a user's enrolled face. These come from memory when possible, then the sidecar file saved at enrolment. Faces enrolled before sidecars existed are detected once and their sidecar created
+    :param username: User to retrieve the face details of
+    :return: Dictionary of the face's BoundingBox, Landmarks, Pose, Quality and Confidence
+    """
+    with faceDetailsLock:
+        cached = faceDetailsCache.get(username)
+    if cached is not None and time.monotonic() - cached[1] < FACE_DETAILS_CACHE_TTL:
+        return cached[0]
+
+    try:
+        faceDetails = json.loads(s3Client.get_object(
+            Bucket=os.getenv("FACE_RECOG_BUCKET"),
+            Key=faceDetailsKey(username)
+        )["Body"].read())
+    except s3Client.exceptions.NoSuchKey:
+        print(f"[WARNING] No stored face details for {username}. Detecting them from the stored face instead...")
+        faceDetail = client.detect_faces(
+            Image={'S3Object': {
+                'Bucket': os.getenv('FACE_RECOG_BUCKET'),
+                'Name': f"users/{username}/{username}.jpg"
+            }},
+            Attributes=['ALL']
+        )["FaceDetails"][0]
+        return saveFaceDetails(username, faceDetail)
+
+    with faceDetailsLock:
+        faceDetailsCache[username] = (faceDetails, time.monotonic())
+    return faceDetails
+
+
+def listCollectionFaces():
+    """listCollectionFaces() : Pages through every face in the rekognition collection
+    :return: Generator of collection face objects
+    """
+    paginator = client.get_paginator("list_faces")
+    for page in paginator.paginate(CollectionId=os.getenv('FACE_RECOG_COLLECTION')):
+        for face in page["Faces"]:
+            yield face
+
+
+def faceIndexPath():
+    """faceIndexPath() : Gets the path of the local face index of the current collection, so that configurations sharing a CACHE_DIR never share face ids
+    :return: FACE_INDEX_PATH if it is set, otherwise a file in CACHE_DIR named after FACE_RECOG_COLLECTION
+    """
+    if FACE_INDEX_PATH is not None:
+        return FACE_INDEX_PATH
+    return os.path.join(commons.CACHE_DIR, f"face_index-{os.getenv('FACE_RECOG_COLLECTION')}.json")
+
+
+def readFaceIndex():
+    """readFaceIndex() : Loads the local ExternalImageId to face index, reusing the in-memory copy while the file is unchanged
+    :return: Dictionary of collection face objects by external image id, or None if no index has been built yet
+    """
+    global faceIndex, faceIndexModified
+    indexPath = faceIndexPath()
+    try:
+        # The index is always replaced rather than written in place, so a new inode means a new version
+        indexStat = os.stat(indexPath)
+        modified = (indexPath, indexStat.st_ino, indexStat.st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+    if faceIndex is None or modified != faceIndexModified:
+        with open(indexPath, "r") as indexFile:
+            faceIndex = json.load(indexFile)
+        faceIndexModified = modified
+    return faceIndex
+
+
+def collectionFaceIndex():
+    """collectionFaceIndex() : Builds a face index from scratch by paging through the whole rekognition collection
+    :return: Dictionary of collection face objects by external image id
+    """
+    print(f"[INFO] Building the face index of {os.getenv('FACE_RECOG_COLLECTION')}...")
+    index = {}
+    for face in listCollectionFaces():
+        # Keep the first face found for an id, matching the previous linear search
+        index.setdefault(face["ExternalImageId"], face)
+    return index
+
+
+def updateFaceIndex(update=None, rebuild=False):
+    """updateFaceIndex() : Applies a change to the local face index while holding a lock on it, so concurrent executions do not lose each other's changes. The index is built from the collection first if there isn't one yet
+    :param update: Optional function that is given the current index dictionary and returns the new index
+    :param rebuild: If True, the index is rebuilt from the collection even if one already exists
+    :return: The updated index
+    """
+    global faceIndex, faceIndexModified
+    indexPath = faceIndexPath()
+    os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+    with faceIndexLock, open(f"{indexPath}.lock", "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        index = None if rebuild else readFaceIndex()
+        if index is None:
+            index = collectionFaceIndex()
+        if update is not None:
+            index = update(index)
+        commons.writeJsonFile(indexPath, index)
+        faceIndex = index
+        indexStat = os.stat(indexPath)
+        faceIndexModified = (indexPath, indexStat.st_ino, indexStat.st_mtime_ns)
+    return index
+
+
+def rebuildFaceIndex():
+    """rebuildFaceIndex() : Rebuilds the local face index from the rekognition collection, e.g. after faces were added or removed outside of these scripts
+    :return: The rebuilt index
+    """
+    index = updateFaceIndex(rebuild=True)
+    print(f"[SUCCESS] Indexed {len(index)} faces to {faceIndexPath()}")
+    return index
+
 
-def faceInCollection(faceId):
-    """faceInCollection() : Searches and returns a user face's details (by it's external image id) in the rekognition collection
+def removeFromFaceIndex(faceId):
+    """removeFromFaceIndex() : Removes every entry of a face from the local face index
+    :param faceId: Collection FaceId of the face to remove
+    """
+    updateFaceIndex(lambda index: {imageId: face for imageId, face in index.items() if face["FaceId"] != faceId})
+
+
+def faceInCollection(faceId, verify=False):
+    """faceInCollection() : Searches and returns a user face's details (by it's external image id) in the rekognition collection. The local face index is used so no API calls are needed once it has been built
     :param faceId: External image id to search for
+    :param verify: If True, a miss in an existing local index is confirmed by rebuilding the index from the collection, since faces may have been added outside of these scripts
     :returns: Matched rekognition collection object
     """
-    faces = client.list_faces(
-        CollectionId=os.getenv('FACE_RECOG_COLLECTION'),
-    )['Faces']
+    index = readFaceIndex()
+    if index is None:
+        index = updateFaceIndex()
+    elif faceId not in index and verify:
+        print(f"[INFO] {faceId} is not in the face index. Checking the collection before concluding it is gone...")
+        index = updateFaceIndex(rebuild=True)
 
     foundFace = {}
-    for face in faces:
-        if faceId == face["ExternalImageId"]:
-            print(f"[INFO] {faceId} found with object name {faceId} (id = {face['FaceId']}). Face to be deleted:\n{face}")
-            foundFace = dict(face)
-            break
+    if faceId in index:
+        foundFace = dict(index[faceId])
+        print(f"[INFO] {faceId} found with object name {faceId} (id = {foundFace['FaceId']}). Face to be deleted:\n{foundFace}")
 
     return foundFace
 
 
+@tracing.traced
 def remove_face_from_collection(imageId):
     """remove_face_from_collection() : Removes a face from the rekognition collection.
     :param imageId: External image id to be deleted (e.g. morgan.jpg)
     :return: Face details object that was deleted from the collection
     """
+    # If no face was found, check to see if there is an alternative jpg or png file of the same name
+    if "jpg" in imageId:
+        altImageId = imageId.replace(".jpg", ".png")
+    else:
+        altImageId = imageId.replace(".png", ".jpg")
 
-    foundFace = faceInCollection(imageId)
-
-    if foundFace == {}:
-        # If no face was found, check to see if there is an alternative jpg or png file of the same name
-        if "jpg" in imageId:
-            altImageId = imageId.replace(".jpg", ".png")
-        else:
-            altImageId = imageId.replace(".png", ".jpg")
+    foundFace = faceInCollection(imageId) or faceInCollection(altImageId)
+    verified = False
+    while True:
+        if foundFace == {}:
+            # Still no face was found. Item does not likely exist so we return and leave error handling to caller
+            if verified:
+                return None
+            # Neither id is in the local index, which may be stale, so confirm against the collection before giving up
+            print(f"[WARNING] No face found with {imageId} or {altImageId} image id in the face index. Trying the collection...")
+            foundFace = faceInCollection(imageId, verify=True) or faceInCollection(altImageId)
+            verified = True
+            continue
 
-        print(f"[WARNING] No face found with {imageId} image id. Trying to find a {altImageId} id to delete...")
-        foundFace = faceInCollection(altImageId)
+        # Delete Object
+        deletedResponse = client.delete_faces(
+            CollectionId=os.getenv('FACE_RECOG_COLLECTION'),
+            FaceIds=[foundFace['FaceId']]
+        )
+        if deletedResponse.get("DeletedFaces", []) != []:
+            break
 
-        # Still no face was found. Item does not likely exist so we return and leave error handling to caller
-        if foundFace == {}:
+        # That face was already removed from the collection elsewhere, but the user may since have been indexed again under a new face id
+        print(f"[WARNING] {foundFace['ExternalImageId']} (id = {foundFace['FaceId']}) was no longer in the collection. Removing it from the face index...")
+        removeFromFaceIndex(foundFace["FaceId"])
+        if verified:
             return None
-
-    # Delete Object
-    deletedResponse = client.delete_faces(
-        CollectionId=os.getenv('FACE_RECOG_COLLECTION'),
-        FaceIds=[foundFace['FaceId']]
-    )
+        foundFace = {}
 
     # Verify face was deleted
     if deletedResponse["DeletedFaces"][0] != foundFace['FaceId']:
@@ -77,44 +261,46 @@ def remove_face_from_collection(imageId):
             code=4
         )
 
+    removeFromFaceIndex(foundFace["FaceId"])
     print(f"[SUCCESS] {imageId} was successfully removed from the collection!")
     return foundFace
 
 
-def add_face_to_collection(imagePath, s3Name=None):
+@tracing.traced
+def add_face_to_collection(imagePath, s3Name=None, username=None):
     """add_face_to_collection() : Retrieves an image and indexes it to a rekognition collection, ready for examination.
-    :param imagePath: Path to file to be uploaded
+    :param imagePath: Path to file (or ImageHandle) to be uploaded
     :param objectName: S3 object name and or path. If not specified then file_name is used
+    :param username: User the face belongs to, used to store the face details. If not specified then the object name (without extension) is used
     :return: Face object details that were created
     """
 
     # If an objectName was not specified, use the file name
     if s3Name is None:
-        objectName = commons.parseObjectName(imagePath)
+        objectName = commons.parseObjectName(str(imagePath))
     else:
         objectName = commons.parseImageObject(s3Name)
 
-    # Check if we're using a local file
-    if os.path.isfile(imagePath):
+    # Check if we're using a local file (or an image passed in memory)
+    if images.isLocalImage(imagePath):
         try:
-            Image.open(imagePath)
+            imagePath = images.verifyImage(imagePath)
         except IOError:
             return commons.respond(
                 messageType="ERROR",
-                message=f"File {imagePath} exists but is not an image. Only jpg and png files are valid",
+                message=f"File {imagePath} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid",
                 code=7
             )
 
-        with open(imagePath, "rb") as fileBytes:
-            print(f"[INFO] Indexing local image {imagePath} with collection object name {objectName}")
-            response = client.index_faces(
-                CollectionId=os.getenv('FACE_RECOG_COLLECTION'),
-                Image={'Bytes': fileBytes.read()},
-                ExternalImageId=objectName,
-                MaxFaces=1,
-                QualityFilter="AUTO",
-                DetectionAttributes=['ALL']
-            )
+        print(f"[INFO] Indexing local image {imagePath} with collection object name {objectName}")
+        response = client.index_faces(
+            CollectionId=os.getenv('FACE_RECOG_COLLECTION'),
+            Image={'Bytes': images.fitImage(imagePath)},
+            ExternalImageId=objectName,
+            MaxFaces=1,
+            QualityFilter="AUTO",
+            DetectionAttributes=['ALL']
+        )
 
     else:
         # Use an S3 object if no file was found at the image path given
@@ -138,6 +324,14 @@ def add_face_to_collection(imagePath, s3Name=None):
                 code=9
             )
 
+    # Keep the enrolled face's details so that matching never has to detect them again
+    if username is None:
+        username = os.path.splitext(objectName)[0]
+    if len(response['FaceRecords']) > 0:
+        saveFaceDetails(username, response['FaceRecords'][0]['FaceDetail'])
+        indexedFace = response['FaceRecords'][0]['Face']
+        updateFaceIndex(lambda index: {**index, objectName: indexedFace})
+
     # We're only looking to return one face
     print(f"[SUCCESS] {imagePath} was successfully added to the collection with image id {objectName}")
     return json.dumps(response['FaceRecords'][0])
@@ -147,7 +341,10 @@ def add_face_to_collection(imagePath, s3Name=None):
 # START #
 #########
 def main(argv):
-    """main() : Main method that parses the input opts and returns the result"""
+    """main() : Main method that parses the input opts and returns the result
+
+    :return: Response of the requested action. ERROR responses are raised as a ResponseError
+    """
 
     # Parse input parameters
     argumentParser = argparse.ArgumentParser(
@@ -157,13 +354,13 @@ def main(argv):
     argumentParser.add_argument(
         "-a", "--action",
         required=True,
-        choices=["add", "delete"],
-        help="""Action to be conducted on the --file. Only one action can be performed at one time:\n\nadd: Adds the --file to the collection. --name can optionally be added if the name of the --file is not what it should be in S3.\n\ndelete: Deletes the --file inside the collection.\n\nNote: There is no edit/rename action as collections don't support image renaming or deletion. If you wish to rename an image, delete the original and create a new one.
+        choices=["add", "delete", "rebuild"],
+        help="""Action to be conducted on the --file. Only one action can be performed at one time:\n\nadd: Adds the --file to the collection. --name can optionally be added if the name of the --file is not what it should be in S3.\n\ndelete: Deletes the --file inside the collection.\n\nrebuild: Rebuilds the local index of the collection's faces (no --file needed). Use this if faces were added or removed outside of these scripts.\n\nNote: There is no edit/rename action as collections don't support image renaming or deletion. If you wish to rename an image, delete the original and create a new one.
         """
     )
     argumentParser.add_argument(
         "-f", "--file",
-        required=True,
+        required=False,
         help="Full path to a jpg or png image file (s3 or local) to add to collection OR (if deleting) the file or username of the face to delete"
     )
     argumentParser.add_argument(
@@ -171,7 +368,24 @@ def main(argv):
         required=False,
         help="ID that the image will have inside the collection. If not specified then the filename is used"
     )
-    argDict = argumentParser.parse_args()
+    commons.addResponseArgument(argumentParser)
+    argDict = argumentParser.parse_args(argv)
+
+    if argDict.action == "rebuild":
+        index = rebuildFaceIndex()
+        return commons.respond(
+            messageType="SUCCESS",
+            message=f"Face index rebuilt with {len(index)} faces",
+            content={"PATH": faceIndexPath(), "FACES": len(index)},
+            code=0
+        )
+
+    if argDict.file is None:
+        return commons.respond(
+            messageType="ERROR",
+            message="-f was not given. Please provide the file or username of the face",
+            code=13
+        )
 
     if argDict.action == "delete":
         response = remove_face_from_collection(argDict.file)
@@ -183,7 +397,7 @@ def main(argv):
                 code=0
             )
         else:
-            commons.respond(
+            return commons.respond(
                 messageType="ERROR",
                 message=f"No face found in collection with object name {argDict.file}",
                 code=2
@@ -199,4 +413,6 @@ def main(argv):
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    responseFile = commons.parseResponseFile(sys.argv[1:])
+    commons.removeResponseFile(responseFile)
+    commons.emit(commons.invoke(main, sys.argv[1:]), responseFile)
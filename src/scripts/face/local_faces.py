@@ -0,0 +1,442 @@
+# -----------------------------------------------------------
+# Local index of face embeddings (computed with dlib) that identifies faces on the CPU, as a pre-filter for or an alternative to rekognition
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import os
+import sys
+import json
+import uuid
+import fcntl
+import argparse
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import ImageOps
+
+from dotenv import load_dotenv
+load_dotenv()
+
+sys.path.append(os.path.dirname(__file__) + "/..")
+import commons  # noqa: E402
+import images  # noqa: E402
+from face import index_photo  # noqa: E402
+
+s3Client = commons.LazyClient('s3')
+
+# Engine that compares faces: "rekognition", "prefilter" (rejects faces the local index does not match before asking rekognition) or "local" (only the local index)
+FACE_ENGINE = os.getenv("FACE_ENGINE", "rekognition")
+# Faces whose embeddings are further apart than this are different people. dlib recommends 0.6, lower values are stricter
+FACE_LOCAL_THRESHOLD = float(os.getenv("FACE_LOCAL_THRESHOLD", 0.6))
+# The index is a JSON file naming the users in row order and the raw float32 matrix of their embeddings next to it
+FACE_EMBEDDINGS_PATH = os.getenv("FACE_EMBEDDINGS_PATH", os.path.join(commons.CACHE_DIR, "face_embeddings.json"))
+# dlib's pretrained models (see http://dlib.net/files/), shape_predictor_5_face_landmarks.dat and dlib_face_recognition_resnet_model_v1.dat
+DLIB_SHAPE_PREDICTOR_PATH = os.getenv("DLIB_SHAPE_PREDICTOR_PATH", os.path.join(commons.CACHE_DIR, "shape_predictor_5_face_landmarks.dat"))
+DLIB_FACE_MODEL_PATH = os.getenv("DLIB_FACE_MODEL_PATH", os.path.join(commons.CACHE_DIR, "dlib_face_recognition_resnet_model_v1.dat"))
+
+EMBEDDING_SIZE = 128
+EMBEDDING_BYTES = EMBEDDING_SIZE * np.dtype(np.float32).itemsize
+# Images are shrunk to this before looking for faces, which is plenty for a face filling a camera frame
+MAX_DETECTION_DIMENSION = 800
+
+dlibModels = None
+dlibModelsLock = threading.Lock()
+
+
+def getDlibModels():
+    """getDlibModels() : Imports dlib and loads its face detector and models the first time they are needed, so nothing else depends on dlib being installed
+    :return: Tuple of the face detector, shape predictor and face recognition model
+    """
+    global dlibModels
+    with dlibModelsLock:
+        if dlibModels is None:
+            try:
+                import dlib
+            except ImportError:
+                return commons.respond(
+                    messageType="ERROR",
+                    message="dlib is not installed, which the local face engine needs. Install it with pip install dlib or set FACE_ENGINE=rekognition",
+                    code=2
+                )
+            for modelPath in [DLIB_SHAPE_PREDICTOR_PATH, DLIB_FACE_MODEL_PATH]:
+                if not os.path.isfile(modelPath):
+                    return commons.respond(
+                        messageType="ERROR",
+                        message=f"No dlib model at {modelPath}. Download it from http://dlib.net/files/ or set FACE_ENGINE=rekognition",
+                        code=8
+                    )
+            dlibModels = (
+                dlib.get_frontal_face_detector(),
+                dlib.shape_predictor(DLIB_SHAPE_PREDICTOR_PATH),
+                dlib.face_recognition_model_v1(DLIB_FACE_MODEL_PATH)
+            )
+        return dlibModels
+
+
+def computeEmbedding(image):
+    """computeEmbedding() : Computes the embedding of the largest face in an image
+    :param image: Path to a local image, ImageHandle or the image bytes
+    :return: Embedding as a float32 array OR None if no face was found
+    """
+    detector, shapePredictor, faceModel = getDlibModels()
+    with images.openImage(image) as opened:
+        if opened.format == "JPEG":
+            opened.draft("RGB", (MAX_DETECTION_DIMENSION, MAX_DETECTION_DIMENSION))
+        upright = ImageOps.exif_transpose(opened).convert("RGB")
+    upright.thumbnail((MAX_DETECTION_DIMENSION, MAX_DETECTION_DIMENSION))
+    pixels = np.asarray(upright)
+
+    faces = detector(pixels, 1)
+    if len(faces) == 0:
+        return None
+    largestFace = max(faces, key=lambda face: face.width() * face.height())
+    return np.asarray(faceModel.compute_face_descriptor(pixels, shapePredictor(pixels, largestFace)), dtype=np.float32)
+
+
+class FaceEmbeddingIndex:
+    """FaceEmbeddingIndex : Embeddings of every enrolled user in one contiguous matrix that is memory mapped from disk, so identifying a face is a single vectorised distance computation"""
+
+    def __init__(self, path=None):
+        self.path = path or FACE_EMBEDDINGS_PATH
+        self.usernames = []
+        self.rows = {}
+        self.embeddings = np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+        self.squaredNorms = np.zeros(0, dtype=np.float32)
+        self.embeddingsFile = None
+        self.modified = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # The JSON file is always replaced after the matrix it names has been written, so the two always match
+        try:
+            indexStat = os.stat(self.path)
+        except FileNotFoundError:
+            self.usernames, self.rows, self.embeddingsFile, self.modified = [], {}, None, None
+            self.embeddings = np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+            self.squaredNorms = np.zeros(0, dtype=np.float32)
+            return
+        if (indexStat.st_ino, indexStat.st_mtime_ns) == self.modified:
+            return
+
+        with open(self.path, "r") as indexFile:
+            index = json.load(indexFile)
+        if index["USERNAMES"] == []:
+            embeddings = np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+        else:
+            try:
+                # Rows past the users named in the index are left over from earlier changes and never read
+                embeddings = np.memmap(self.matrixPath(index["EMBEDDINGS"]), dtype=np.float32, mode="r", shape=(len(index["USERNAMES"]), EMBEDDING_SIZE))
+            except FileNotFoundError:
+                # The index was replaced (and its old matrix removed) while it was being read
+                replacedStat = os.stat(self.path)
+                if (replacedStat.st_ino, replacedStat.st_mtime_ns) == (indexStat.st_ino, indexStat.st_mtime_ns):
+                    raise
+                return self.load()
+        self.usernames = index["USERNAMES"]
+        self.rows = {username: row for row, username in enumerate(self.usernames)}
+        self.embeddings = embeddings
+        self.embeddingsFile = index["EMBEDDINGS"]
+        # Kept so that distances only need one matrix-vector product
+        self.squaredNorms = np.einsum("ij,ij->i", self.embeddings, self.embeddings)
+        self.modified = (indexStat.st_ino, indexStat.st_mtime_ns)
+
+    def matrixPath(self, embeddingsFile):
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), embeddingsFile)
+
+    @contextmanager
+    def locked(self):
+        """locked() : Holds the lock on the index (across threads and executions) and loads its latest version, so concurrent changes are not lost"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.lock, open(f"{self.path}.lock", "w") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            self.load()
+            yield
+
+    def update(self, update):
+        """update() : Applies a change to the index while holding a lock on it, so concurrent executions do not lose each other's changes. The whole matrix is rewritten, so make several changes in one update
+        :param update: Function given a dictionary of embeddings by username that changes it in place
+        """
+        with self.locked():
+            previousFile = self.embeddingsFile
+            embeddings = {username: np.array(self.embeddings[row]) for username, row in self.rows.items()}
+            update(embeddings)
+
+            # Write the matrix under a new name, then point the index at it
+            usernames = list(embeddings)
+            embeddingsFile = f"{os.path.splitext(os.path.basename(self.path))[0]}.{uuid.uuid4().hex[:8]}.f32"
+            matrix = np.zeros((len(usernames), EMBEDDING_SIZE), dtype=np.float32)
+            for row, username in enumerate(usernames):
+                matrix[row] = embeddings[username]
+            matrix.tofile(self.matrixPath(embeddingsFile))
+            commons.writeJsonFile(self.path, {"USERNAMES": usernames, "EMBEDDINGS": embeddingsFile})
+
+            # Executions that still have the old matrix mapped keep reading it until they reload
+            if previousFile is not None and previousFile != embeddingsFile:
+                try:
+                    os.remove(self.matrixPath(previousFile))
+                except FileNotFoundError:
+                    pass
+            self.load()
+
+    def add(self, username, embedding):
+        """add() : Enrols (or re-enrols) a user's face embedding, writing only their row of the matrix
+        :param username: User the face belongs to
+        :param embedding: Embedding of the user's face
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self.locked():
+            if self.embeddingsFile is None:
+                # Nothing to write into yet
+                usernames = [username]
+                self.embeddingsFile = f"{os.path.splitext(os.path.basename(self.path))[0]}.{uuid.uuid4().hex[:8]}.f32"
+                open(self.matrixPath(self.embeddingsFile), "wb").close()
+            else:
+                usernames = self.usernames if username in self.rows else self.usernames + [username]
+
+            # A new user is appended after the rows other executions may have mapped, a re-enrolled one is replaced where it is
+            with open(self.matrixPath(self.embeddingsFile), "r+b") as matrixFile:
+                matrixFile.seek(usernames.index(username) * EMBEDDING_BYTES)
+                matrixFile.write(embedding.tobytes())
+
+            # Rewritten even when only a row changed, so other executions reload their squared norms
+            commons.writeJsonFile(self.path, {"USERNAMES": usernames, "EMBEDDINGS": self.embeddingsFile})
+            self.load()
+
+    def remove(self, username):
+        """remove() : Removes a user's face embedding
+        :param username: User to remove
+        """
+        self.update(lambda embeddings: embeddings.pop(username, None))
+
+    def squaredDistances(self, embedding):
+        """squaredDistances() : Calculates the squared euclidean distance from a face embedding to every enrolled face. The square root is left out as it does not change which face is closest
+        :param embedding: Embedding of the face to compare
+        :return: Array of squared distances in the same order as usernames
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return self.squaredNorms - 2 * (self.embeddings @ embedding) + embedding @ embedding
+
+    def identify(self, embedding, threshold=None):
+        """identify() : Finds the enrolled user whose face is closest to a face embedding
+        :param embedding: Embedding of the face to identify
+        :param threshold: Largest distance that is still a match. Defaults to FACE_LOCAL_THRESHOLD
+        :return: Tuple of the matched username and distance OR None if nobody is close enough
+        """
+        with self.lock:
+            self.load()
+            if self.usernames == []:
+                return None
+            squaredDistances = self.squaredDistances(embedding)
+            closest = int(np.argmin(squaredDistances))
+            distance = float(np.sqrt(max(squaredDistances[closest], 0)))
+            if distance > (FACE_LOCAL_THRESHOLD if threshold is None else threshold):
+                return None
+            return self.usernames[closest], distance
+
+    def distance(self, embedding, username):
+        """distance() : Calculates the distance from a face embedding to a single user's enrolled face
+        :param embedding: Embedding of the face to compare
+        :param username: Enrolled user to compare against
+        :return: The distance OR None if the user is not enrolled
+        """
+        with self.lock:
+            self.load()
+            if username not in self.rows:
+                return None
+            enrolled = np.asarray(self.embeddings[self.rows[username]], dtype=np.float32)
+            return float(np.linalg.norm(enrolled - np.asarray(embedding, dtype=np.float32)))
+
+
+faceEmbeddingIndex = FaceEmbeddingIndex()
+
+
+def enabled():
+    return FACE_ENGINE != "rekognition"
+
+
+def enrolFace(username, image):
+    """enrolFace() : Computes and stores the embedding of a user's face in the local index
+    :param username: User the face belongs to
+    :param image: Path to a local image or the image bytes
+    :return: True if a face was enrolled, False if none was found in the image
+    """
+    embedding = computeEmbedding(image)
+    if embedding is None:
+        # Any face enrolled before (e.g. the one being replaced) must no longer be matched
+        faceEmbeddingIndex.remove(username)
+        print(f"[WARNING] No face was found for {username} by the local face engine, so they can only be matched by rekognition")
+        return False
+    faceEmbeddingIndex.add(username, embedding)
+    print(f"[SUCCESS] {username} was enrolled in the local face index")
+    return True
+
+
+def forgetFace(username):
+    """forgetFace() : Removes a user from the local index, if they are in it
+    :param username: User to remove
+    """
+    faceEmbeddingIndex.remove(username)
+
+
+def verifyFace(image, username, threshold=None):
+    """verifyFace() : Compares the face in an image with a user's enrolled face using the local index
+    :param image: Path to a local image or the image bytes
+    :param username: User to compare against
+    :param threshold: Largest distance that is still a match. Defaults to FACE_LOCAL_THRESHOLD
+    :return: JSON object of whether it is a MATCH and the DISTANCE OR None if the user is not enrolled locally or dlib found no face to compare
+    """
+    embedding = computeEmbedding(image)
+    if embedding is None:
+        # dlib misses faces rekognition can still find, so this is no reason to reject the face
+        return None
+    distance = faceEmbeddingIndex.distance(embedding, username)
+    if distance is None:
+        return None
+    return {"MATCH": distance <= (FACE_LOCAL_THRESHOLD if threshold is None else threshold), "DISTANCE": round(distance, 4)}
+
+
+def identifyFace(image, threshold=None):
+    """identifyFace() : Finds the enrolled user in an image using the local index
+    :param image: Path to a local image or the image bytes
+    :param threshold: Largest distance that is still a match. Defaults to FACE_LOCAL_THRESHOLD
+    :return: JSON object of the matched USERNAME and DISTANCE OR None if nobody was matched
+    """
+    embedding = computeEmbedding(image)
+    if embedding is None:
+        return None
+    match = faceEmbeddingIndex.identify(embedding, threshold)
+    if match is None:
+        return None
+    return {"USERNAME": match[0], "DISTANCE": round(match[1], 4)}
+
+
+def rebuildIndex(usernames):
+    """rebuildIndex() : Enrols users from their stored S3 faces, e.g. when first switching to the local face engine
+    :param usernames: Users to enrol
+    :return: List of the users that were enrolled
+    """
+    embeddings = {}
+    faceless = []
+    for username in usernames:
+        try:
+            faceObject = s3Client.get_object(Bucket=os.getenv('FACE_RECOG_BUCKET'), Key=f"users/{username}/{username}.jpg")
+        except s3Client.exceptions.NoSuchKey:
+            print(f"[WARNING] {username} has no stored face in S3, skipping them")
+            continue
+        embedding = computeEmbedding(faceObject["Body"].read())
+        if embedding is None:
+            print(f"[WARNING] No face was found for {username} by the local face engine, so they can only be matched by rekognition")
+            faceless.append(username)
+        else:
+            embeddings[username] = embedding
+
+    # Written in one go, rather than rewriting the index for every user
+    def enrolAll(indexed):
+        for username in faceless:
+            indexed.pop(username, None)
+        indexed.update(embeddings)
+    faceEmbeddingIndex.update(enrolAll)
+    print(f"[SUCCESS] {len(embeddings)} users were enrolled in the local face index")
+    return list(embeddings)
+
+
+#########
+# START #
+#########
+def main(argv):
+    """main() : Main method that parses the input opts and returns the result
+
+    :return: Response of the requested action. ERROR responses are raised as a ResponseError
+    """
+    argumentParser = argparse.ArgumentParser(
+        description="Manages and searches the local face embedding index",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    argumentParser.add_argument(
+        "-a", "--action",
+        required=True,
+        choices=["enrol", "remove", "identify", "rebuild"],
+        help="""Action to be conducted:\n\nenrol: Enrols the face in --file as the --profile.\n\nremove: Removes the --profile from the index.\n\nidentify: Finds the enrolled user in --file.\n\nrebuild: Enrols every --profile (or every user in the collection's face index) from their stored S3 face.
+        """
+    )
+    argumentParser.add_argument(
+        "-f", "--file",
+        required=False,
+        help="Path to a face image (enrol and identify only)"
+    )
+    argumentParser.add_argument(
+        "-p", "--profile",
+        required=False,
+        action="extend",
+        nargs="+",
+        help="Username(s) of the profiles to act on"
+    )
+    commons.addResponseArgument(argumentParser)
+    argDict = argumentParser.parse_args(argv)
+
+    if argDict.action in ["enrol", "identify"] and (argDict.file is None or not os.path.isfile(argDict.file)):
+        return commons.respond(
+            messageType="ERROR",
+            message=f"No such file {argDict.file}",
+            code=8
+        )
+    if argDict.action in ["enrol", "remove"] and not argDict.profile:
+        return commons.respond(
+            messageType="ERROR",
+            message="-p was not specified. Please pass in a user account name",
+            code=13
+        )
+
+    if argDict.action == "enrol":
+        if not enrolFace(argDict.profile[0], argDict.file):
+            return commons.respond(
+                messageType="ERROR",
+                message=f"No face was found in {argDict.file}",
+                code=10
+            )
+        return commons.respond(
+            messageType="SUCCESS",
+            message=f"{argDict.profile[0]} was enrolled in the local face index",
+            code=0
+        )
+    elif argDict.action == "remove":
+        forgetFace(argDict.profile[0])
+        return commons.respond(
+            messageType="SUCCESS",
+            message=f"{argDict.profile[0]} was removed from the local face index",
+            code=0
+        )
+    elif argDict.action == "identify":
+        match = identifyFace(argDict.file)
+        if match is None:
+            return commons.respond(
+                messageType="ERROR",
+                message=f"No enrolled face matched {argDict.file}",
+                code=10
+            )
+        return commons.respond(
+            messageType="SUCCESS",
+            message=f"{argDict.file} matched {match['USERNAME']}",
+            content=match,
+            code=0
+        )
+    else:
+        usernames = argDict.profile
+        if not usernames:
+            usernames = sorted({os.path.splitext(imageId)[0] for imageId in index_photo.updateFaceIndex()})
+        enrolled = rebuildIndex(usernames)
+        return commons.respond(
+            messageType="SUCCESS",
+            message=f"Enrolled {len(enrolled)} of {len(usernames)} users in the local face index",
+            content={"ENROLLED": enrolled},
+            code=0
+        )
+
+
+if __name__ == "__main__":
+    responseFile = commons.parseResponseFile(sys.argv[1:])
+    commons.removeResponseFile(responseFile)
+    commons.emit(commons.invoke(main, sys.argv[1:]), responseFile)
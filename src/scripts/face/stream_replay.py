@@ -0,0 +1,307 @@
+# -----------------------------------------------------------
+# Records the camera data stream to a file and replays recordings through the face search, without any AWS services
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import os
+import sys
+import json
+import gzip
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+load_dotenv()
+
+sys.path.append(os.path.dirname(__file__) + "/..")
+import commons  # noqa: E402
+import simulated  # noqa: E402
+from face import compare_faces  # noqa: E402
+from face import index_photo  # noqa: E402
+
+kinesis = commons.LazyClient("kinesis")
+
+# Placeholder names of the simulated data stream and bucket when the .env file does not name them
+REPLAY_NAMES = {"CAMERA_DATASTREAM_NAME": "replay", "FACE_RECOG_BUCKET": "replay"}
+
+
+class RecordingFeed:
+    """RecordingFeed : Puts the records of a recording on a simulated data stream once the face search is reading it, either as they originally arrived (realtime) or all at once, then closes the stream"""
+
+    def __init__(self, backend, streamName, records, shardIds, realtime=False):
+        self.backend = backend
+        self.streamName = streamName
+        self.records = sorted(records, key=lambda record: record["Offset"])
+        # Recorded shard ids to the simulated shard each is replayed on
+        self.shardIds = shardIds
+        self.realtime = realtime
+        self.startTime = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.feed, name="replayfeed", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def elapsed(self):
+        return time.monotonic() - self.startTime if self.startTime is not None else 0
+
+    def feed(self):
+        # The search only reads records that arrive after it started, so the recording starts once every shard is being read
+        while not self.backend.awaitReaders(self.streamName, len(self.shardIds), timeout=1):
+            if self.stopped.is_set():
+                return
+        self.startTime = time.monotonic()
+
+        for record in self.records:
+            if self.realtime and self.stopped.wait(max(0, record["Offset"] - self.elapsed())):
+                return
+            if self.stopped.is_set():
+                return
+            self.backend.putRecord(self.streamName, record["Data"].encode("utf-8"), record["PartitionKey"], self.shardIds[record["ShardId"]])
+        self.backend.closeDataStream(self.streamName)
+
+
+@contextmanager
+def replayNames():
+    """replayNames() : Fills in placeholder names for the simulated data stream and bucket if the .env file does not set them, removing them again afterwards"""
+    missing = [name for name in REPLAY_NAMES if not os.getenv(name)]
+    for name in missing:
+        os.environ[name] = REPLAY_NAMES[name]
+    try:
+        yield
+    finally:
+        for name in missing:
+            os.environ.pop(name, None)
+
+
+def matchedUsernames(data):
+    """matchedUsernames() : Finds the users whose faces were matched in a stream processor record
+    :param data: Decoded record data
+    :return: Set of usernames
+    """
+    usernames = set()
+    for searchResponse in json.loads(data).get("FaceSearchResponse", []):
+        for matchedFace in searchResponse.get("MatchedFaces", []):
+            usernames.add(os.path.splitext(matchedFace["Face"]["ExternalImageId"])[0])
+    return usernames
+
+
+def readRecording(recordingPath):
+    """readRecording() : Loads a recording made by record()
+    :param recordingPath: Path to the gzipped JSONL recording
+    :return: Tuple of the list of records and the dictionary of face details by username
+    """
+    records = []
+    faceDetails = {}
+    with gzip.open(recordingPath, "rt", encoding="utf-8") as recording:
+        for line in recording:
+            entry = json.loads(line)
+            if entry["Type"] == "RECORD":
+                records.append(entry)
+            elif entry["Type"] == "FACE_DETAILS":
+                faceDetails[entry["Username"]] = entry["FaceDetails"]
+    return records, faceDetails
+
+
+def record(recordingPath, seconds):
+    """record() : Records the camera data stream to a gzipped JSONL file, along with the face details of every user matched in it. The camera stream and stream processor must already be running
+    :param recordingPath: Path to write the recording to
+    :param seconds: How long to record for
+    :return: Dictionary describing the recording
+    """
+    shards = kinesis.list_shards(
+        StreamName=os.getenv('CAMERA_DATASTREAM_NAME'),
+        ShardFilter={
+            "Type": "AT_LATEST"
+        }
+    )["Shards"]
+    iterators = {shard["ShardId"]: compare_faces.createShardIterator(shard["ShardId"]) for shard in shards}
+    pollers = {shardId: compare_faces.ShardPoller() for shardId in iterators}
+
+    print(f"[INFO] Recording {len(shards)} shards of {os.getenv('CAMERA_DATASTREAM_NAME')} for {seconds}s...")
+    recorded = 0
+    usernames = set()
+    startTime = time.monotonic()
+    endTime = time.time() + seconds
+    with gzip.open(recordingPath, "wt", encoding="utf-8") as recording:
+        while iterators != {} and time.time() < endTime:
+            for shardId in list(iterators):
+                pollers[shardId].wait(endTime)
+                try:
+                    records = kinesis.get_records(ShardIterator=iterators[shardId])
+                except kinesis.exceptions.ProvisionedThroughputExceededException:
+                    pollers[shardId].throttled()
+                    continue
+                except kinesis.exceptions.ExpiredIteratorException:
+                    iterators[shardId] = compare_faces.createShardIterator(shardId)
+                    continue
+
+                pollers[shardId].update(records)
+                for shardRecord in records["Records"]:
+                    data = shardRecord["Data"].decode("utf-8")
+                    recording.write(json.dumps({
+                        "Type": "RECORD",
+                        "ShardId": shardId,
+                        "Offset": round(time.monotonic() - startTime, 4),
+                        "SequenceNumber": shardRecord["SequenceNumber"],
+                        "PartitionKey": shardRecord["PartitionKey"],
+                        "Data": data
+                    }) + "\n")
+                    usernames |= matchedUsernames(data)
+                    recorded += 1
+
+                if records.get("NextShardIterator") is None:
+                    del iterators[shardId]
+                else:
+                    iterators[shardId] = records["NextShardIterator"]
+
+        # Keep the matched users' face details so that replays never need S3 or Rekognition
+        for username in sorted(usernames):
+            recording.write(json.dumps({"Type": "FACE_DETAILS", "Username": username, "FaceDetails": index_photo.getFaceDetails(username)}) + "\n")
+
+    print(f"[SUCCESS] Recorded {recorded} records to {recordingPath}")
+    return {"PATH": recordingPath, "RECORDS": recorded, "SHARDS": len(shards), "USERS": sorted(usernames)}
+
+
+def replay(recordingPath, realtime=False, timeout=None):
+    """replay() : Feeds a recording through the face search, with the simulated AWS backend standing in for Kinesis, S3 and Rekognition
+    :param recordingPath: Path to a recording made by record()
+    :param realtime: If True, records become available as they originally arrived and reads are paced as they would be live. Otherwise they are read as fast as possible
+    :param timeout: Optional seconds after which the search is abandoned
+    :return: Dictionary of the matched FACE (or None), RECORDS read, SECONDS taken, RECORDS_PER_SECOND and TIME_TO_MATCH
+    """
+    records, faceDetails = readRecording(recordingPath)
+    recordedShardIds = sorted({record["ShardId"] for record in records})
+    if realtime:
+        backend = simulated.SimulatedAWS(iteratorSeconds=float("inf"))
+        newPoller = compare_faces.ShardPoller
+    else:
+        backend = simulated.SimulatedAWS(shardReadsPerSecond=float("inf"), iteratorSeconds=float("inf"))
+
+        def newPoller():
+            return compare_faces.ShardPoller(0, 0)
+
+    # The face details of the recorded users must come from the recording, not from anything cached before
+    for username in faceDetails:
+        index_photo.forgetFaceDetails(username)
+
+    try:
+        with replayNames(), backend.installed():
+            streamName = os.getenv('CAMERA_DATASTREAM_NAME')
+            backend.addDataStream(streamName, max(len(recordedShardIds), 1))
+            shards = kinesis.list_shards(StreamName=streamName)["Shards"]
+            for username, details in faceDetails.items():
+                commons.getClient("s3").put_object(
+                    Body=json.dumps(details).encode("utf-8"),
+                    Bucket=os.getenv("FACE_RECOG_BUCKET"),
+                    Key=index_photo.faceDetailsKey(username)
+                )
+
+            feed = RecordingFeed(backend, streamName, records, dict(zip(recordedShardIds, [shard["ShardId"] for shard in shards])), realtime)
+            feed.start()
+            deadline = time.time() + timeout if timeout is not None else None
+            try:
+                matchedFace = compare_faces.searchShards(shards, deadline, newPoller)
+            except TimeoutError:
+                matchedFace = None
+            finally:
+                feed.stop()
+            seconds = feed.elapsed()
+    finally:
+        for username in faceDetails:
+            index_photo.forgetFaceDetails(username)
+
+    served = backend.recordsRead[streamName]
+    return {
+        "FACE": matchedFace,
+        "RECORDS": served,
+        "SECONDS": round(seconds, 4),
+        "RECORDS_PER_SECOND": round(served / seconds, 1) if seconds > 0 else None,
+        "TIME_TO_MATCH": round(seconds, 4) if matchedFace is not None else None
+    }
+
+
+#########
+# START #
+#########
+def main(argv):
+    """main() : Main method that parses the input opts and returns the result
+
+    :return: Response of the requested action. ERROR responses are raised as a ResponseError
+    """
+    argumentParser = argparse.ArgumentParser(
+        description="Records the camera data stream so that it can be replayed through the face search offline",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    argumentParser.add_argument(
+        "-a", "--action",
+        required=True,
+        choices=["record", "replay"],
+        help="""Action to be conducted on the --file:\n\nrecord: Records the camera data stream to the --file for --seconds. The camera stream and stream processor must already be running.\n\nreplay: Replays the --file through the face search and reports how quickly it was read and how long a match took.
+        """
+    )
+    argumentParser.add_argument(
+        "-f", "--file",
+        required=True,
+        help="Path of the gzipped JSONL recording (e.g. session.jsonl.gz)"
+    )
+    argumentParser.add_argument(
+        "-s", "--seconds",
+        required=False,
+        type=float,
+        default=30,
+        help="How long to record for (record only). Defaults to 30"
+    )
+    argumentParser.add_argument(
+        "--realtime",
+        action="store_true",
+        required=False,
+        help="Replay records as they originally arrived instead of as fast as possible (replay only)"
+    )
+    commons.addResponseArgument(argumentParser)
+    argDict = argumentParser.parse_args(argv)
+
+    if argDict.action == "record":
+        result = record(argDict.file, argDict.seconds)
+        return commons.respond(
+            messageType="SUCCESS",
+            message=f"Recorded {result['RECORDS']} records to {argDict.file}",
+            content=result,
+            code=0
+        )
+
+    if not os.path.isfile(argDict.file):
+        return commons.respond(
+            messageType="ERROR",
+            message=f"No such file {argDict.file}",
+            code=8
+        )
+
+    result = replay(argDict.file, argDict.realtime)
+    if result["FACE"] is None:
+        return commons.respond(
+            messageType="ERROR",
+            message=f"No matching face was found in {result['RECORDS']} replayed records",
+            content=result,
+            code=10
+        )
+    return commons.respond(
+        messageType="SUCCESS",
+        message=f"Found a matching face after {result['TIME_TO_MATCH']}s ({result['RECORDS_PER_SECOND']} records/s)",
+        content=result,
+        code=0
+    )
+
+
+if __name__ == "__main__":
+    responseFile = commons.parseResponseFile(sys.argv[1:])
+    commons.removeResponseFile(responseFile)
+    commons.emit(commons.invoke(main, sys.argv[1:]), responseFile)
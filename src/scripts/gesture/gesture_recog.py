@@ -10,41 +10,138 @@ import os
 import argparse
 import time
 import json
-
-from PIL import Image
+import copy
+import uuid
+import fcntl
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 
-import boto3
 from botocore.exceptions import WaiterError, ClientError
 from ratelimit import limits
 
 sys.path.append(os.path.dirname(__file__) + "/..")
 import commons  # noqa: E402
-
-rekogClient = boto3.client('rekognition')
-s3Client = boto3.client('s3')
+import images  # noqa: E402
+import results  # noqa: E402
+import tracing  # noqa: E402
+from gesture import local_gestures  # noqa: E402
+
+rekogClient = commons.LazyClient('rekognition')
+s3Client = commons.LazyClient('s3')
+
+# Serialises model start/stop requests when several actions run in one process (see daemon.py)
+projectLock = threading.RLock()
+
+# Combination checks allowed per user within each period, so a daemon serving every user can't be locked out by one of them
+COMBINATION_CALLS = 30
+COMBINATION_PERIOD = 120
+combinationLimits = {}
+combinationLimitsLock = threading.Lock()
+
+# Users of the model are counted in this file so concurrent executions only stop it once the last one is done with it
+MODEL_STATE_PATH = os.getenv("GESTURE_MODEL_STATE_PATH", os.path.join(commons.CACHE_DIR, "model_state.json"))
+# Seconds the model is kept running after its last use. 0 stops it as soon as the last user is done, otherwise reapModel() stops it
+MODEL_IDLE_TIMEOUT = float(os.getenv("GESTURE_MODEL_IDLE_TIMEOUT", 0))
+modelStateLock = threading.Lock()
+
+# Seconds to wait for a model to stop, polling its status with delays doubling up to STOP_POLL_MAX_DELAY
+STOP_TIMEOUT = 300
+STOP_POLL_MAX_DELAY = 30
+# Seconds between checks on whether the last user has asked the model to stop yet
+MODEL_STOP_REQUEST_POLL = 0.5
+
+# Engine that identifies gestures (see GESTURE_ENGINES). "local" only falls back to the rekognition model when it is less than GESTURE_LOCAL_MIN_CONFIDENCE% sure
+GESTURE_ENGINE = os.getenv("GESTURE_ENGINE", "rekognition")
+LOCAL_MIN_CONFIDENCE = float(os.getenv("GESTURE_LOCAL_MIN_CONFIDENCE", 80))
+
+# Maximum number of images that have their gestures detected at the same time
+DETECTION_WORKERS = int(os.getenv("GESTURE_DETECTION_WORKERS", 4))
+
+# User gesture config files are kept for CONFIG_CACHE_TTL seconds, after which they are revalidated against S3 by their ETag
+CONFIG_CACHE_TTL = float(os.getenv("GESTURE_CONFIG_CACHE_TTL", 30))
+CONFIG_CACHE_SIZE = int(os.getenv("GESTURE_CONFIG_CACHE_SIZE", 256))
+configCache = OrderedDict()
+configCacheLock = threading.Lock()
+
+# The model's version details are reused for PROJECT_VERSIONS_CACHE_TTL seconds (across executions) unless we start or stop it ourselves
+projectVersionsCache = commons.DiskCache("project_versions", float(os.getenv("PROJECT_VERSIONS_CACHE_TTL", 10)))
+# The gesture labels only change when the model is retrained, so they are kept for GESTURE_TYPES_CACHE_TTL seconds
+gestureTypesCache = commons.DiskCache("gesture_types", float(os.getenv("GESTURE_TYPES_CACHE_TTL", 24 * 60 * 60)))
+GESTURE_TYPES_PREFIX = "gestureTraining/mixed/"
 
 load_dotenv()
 
 sys.path.append(os.path.dirname(__file__) + "/..")
 
 
+def cacheUserCombinationFile(username, gestureConfig, etag):
+    """cacheUserCombinationFile() : Stores a user's gesture configuration in the config cache, evicting the least recently used user if it is full
+    :param username: The user the config file belongs to
+    :param gestureConfig: Parsed contents of the config file
+    :param etag: S3 ETag of the config file object
+    """
+    with configCacheLock:
+        configCache[username] = {"CONFIG": copy.deepcopy(gestureConfig), "ETAG": etag, "FETCHED": time.monotonic()}
+        configCache.move_to_end(username)
+        while len(configCache) > CONFIG_CACHE_SIZE:
+            configCache.popitem(last=False)
+
+
+def invalidateUserCombinationFile(username):
+    """invalidateUserCombinationFile() : Removes a user's gesture configuration from the config cache so it is downloaded again on next use
+    :param username: The user to invalidate the config file for
+    """
+    with configCacheLock:
+        configCache.pop(username, None)
+
+
 def getUserCombinationFile(username):
-    """getUserCombinationFile() : Retrieves a user's gesture configuration file contents
+    """getUserCombinationFile() : Retrieves a user's gesture configuration file contents. Recently retrieved files are served from the config cache and older ones are only downloaded again if they have changed
     :param username: The user to retrieve the config file for
     """
+    with configCacheLock:
+        cached = configCache.get(username)
+        if cached is not None:
+            configCache.move_to_end(username)
+            cached = dict(cached)
+
+    if cached is not None and time.monotonic() - cached["FETCHED"] < CONFIG_CACHE_TTL:
+        return copy.deepcopy(cached["CONFIG"])
+
+    request = {
+        "Bucket": os.getenv('FACE_RECOG_BUCKET'),
+        "Key": f"users/{username}/gestures/GestureConfig.json"
+    }
+    if cached is not None:
+        request["IfNoneMatch"] = cached["ETAG"]
+
     try:
-        return json.loads(s3Client.get_object(
-            Bucket=os.getenv('FACE_RECOG_BUCKET'),
-            Key=f"users/{username}/gestures/GestureConfig.json"
-        )["Body"].read())
+        configObject = s3Client.get_object(**request)
+        gestureConfig = json.loads(configObject["Body"].read())
+        cacheUserCombinationFile(username, gestureConfig, configObject["ETag"])
+        return gestureConfig
     except s3Client.exceptions.NoSuchKey:
+        invalidateUserCombinationFile(username)
         return commons.respond(
             messageType="ERROR",
             message="No such user gesture config file exists in S3. Does this user exist?",
             code=9
         )
+    except ClientError as e:
+        # The cached config file is still the latest version
+        if cached is not None and e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304:
+            cacheUserCombinationFile(username, cached["CONFIG"], cached["ETAG"])
+            return copy.deepcopy(cached["CONFIG"])
+
+        return commons.respond(
+            messageType="ERROR",
+            message="Failed to retrieve user gesture config file. Please check your internet connection.",
+            content={"ERROR": str(e)},
+            code=2
+        )
     except Exception as e:
         return commons.respond(
             messageType="ERROR",
@@ -54,9 +151,33 @@ def getUserCombinationFile(username):
         )
 
 
-@limits(calls=30, period=120)
+def combinationLimit(username):
+    """combinationLimit() : Gets the rate limiter for a user's combination checks, forgetting limiters whose window has already passed
+    :param username: User whose gesture combination is being checked
+    :return: ratelimit limiter counting the user's recent checks
+    """
+    with combinationLimitsLock:
+        for name, limit in list(combinationLimits.items()):
+            if limit.clock() - limit.last_reset >= limit.period:
+                del combinationLimits[name]
+        if username not in combinationLimits:
+            combinationLimits[username] = limits(calls=COMBINATION_CALLS, period=COMBINATION_PERIOD)
+        return combinationLimits[username]
+
+
 def inUserCombination(gestureJson, username, locktype, position):
-    """inUserCombination() : Calculates if the given gesture is in the user's combination and in the correct position. This is ratelimited to try and avoid bruteforcing.
+    """inUserCombination() : Calculates if the given gesture is in the user's combination and in the correct position. This is ratelimited per user to try and avoid bruteforcing.
+    :param gestureJson: Identified gesture JSON object returned from AWS detect_custom_labels
+    :param username: User to pull gesture combination
+    :param locktype: Whether we are locking or unlocking
+    :param position: Position in the combination we are checking for the gestureJson
+    :return: Boolean denoting if the given gesture and position are both valid in the user's gesture combination
+    """
+    return combinationLimit(username)(checkUserCombination)(gestureJson, username, locktype, position)
+
+
+def checkUserCombination(gestureJson, username, locktype, position):
+    """checkUserCombination() : Calculates if the given gesture is in the user's combination and in the correct position, without any rate limit
     :param gestureJson: Identified gesture JSON object returned from AWS detect_custom_labels
     :param username: User to pull gesture combination
     :param locktype: Whether we are locking or unlocking
@@ -73,51 +194,96 @@ def inUserCombination(gestureJson, username, locktype, position):
         return False
 
 
-def getGestureTypes():
-    """getGestureTypes() : Gets a list of viable gesture types based off the rekognition project labels. Unfortunately, rekognition does not support pulling labels from a project directly so we will have to settle with pulling them from s3 instead
+def listGestureTypes():
+    """listGestureTypes() : Lists the gesture labels in s3, one folder per label under GESTURE_TYPES_PREFIX
     :return: List of viable gestures
     """
-    # This essentially retrieves all possible gestures, splits path by delimiter and removes the excess empty strings
-    prefixPathSplits = list(map(
-        lambda jsonObject: list(filter(None, jsonObject["Prefix"].split("/"))),
-        s3Client.list_objects_v2(
-            Bucket=os.getenv('FACE_RECOG_BUCKET'),
-            Prefix="gestureTraining/mixed/",  # TODO: CHECK THIS
-            Delimiter="/"
-        )["CommonPrefixes"]
-    ))
+    # This essentially retrieves all possible gestures (across every page), splits path by delimiter and removes the excess empty strings
+    prefixPathSplits = []
+    for page in s3Client.get_paginator("list_objects_v2").paginate(
+        Bucket=os.getenv('FACE_RECOG_BUCKET'),
+        Prefix=GESTURE_TYPES_PREFIX,
+        Delimiter="/"
+    ):
+        prefixPathSplits.extend(
+            list(filter(None, jsonObject["Prefix"].split("/"))) for jsonObject in page.get("CommonPrefixes", [])
+        )
     # Finally, we return only the middle folder (the label name) and discard the root folder name
     return list(map(lambda prefixPathSplit: prefixPathSplit[-1], prefixPathSplits))
 
 
-def checkForGestures(image):
-    """checkForGestures() : Queries the latest AWS Custom Label model for the gesture metadata. I.e. Does this image contain a gesture and if so, which one is it most likely?
+def getGestureTypes(refresh=False):
+    """getGestureTypes() : Gets a list of viable gesture types based off the rekognition project labels. Unfortunately, rekognition does not support pulling labels from a project directly so we will have to settle with pulling them from s3 instead
+    :param refresh: If True, the labels are listed again instead of being taken from the cache
+    :return: List of viable gestures
+    """
+    return gestureTypesCache.get(f"{os.getenv('FACE_RECOG_BUCKET')}/{GESTURE_TYPES_PREFIX}", listGestureTypes, refresh)
+
+
+def invalidateGestureTypes():
+    """invalidateGestureTypes() : Forgets the cached gesture labels (e.g. after retraining the model with new gestures)"""
+    gestureTypesCache.invalidate()
+
+
+@tracing.traced
+def checkLocally(image, cache=False):
+    """checkLocally() : Classifies the gesture in a local image with the local model (see local_gestures.py)
+    :param image: Locally stored image to scan for authentication gestures
+    :param cache: Unused, as local classification is cheaper than looking up a cached result
+    :return: JSON object containing the gesture OR None if the image can't be classified locally or the model is not confident enough
+    """
+    if not images.isLocalImage(image):
+        return None
+    foundGesture = local_gestures.classifyGesture(image)
+    if foundGesture is None:
+        print(f"[WARNING] No local gesture model has been trained at {local_gestures.MODEL_PATH}")
+        return None
+    if foundGesture["Confidence"] < LOCAL_MIN_CONFIDENCE:
+        print(f"[INFO] Local gesture model is only {foundGesture['Confidence']}% sure {image} is {foundGesture['Name']}")
+        return None
+    return foundGesture
+
+
+@tracing.traced
+def checkWithRekognition(image, cache=False):
+    """checkWithRekognition() : Queries the latest AWS Custom Label model for the gesture metadata. I.e. Does this image contain a gesture and if so, which one is it most likely?
     :param image: Locally stored image OR image bytes OR stream frame to scan for authentication gestures
+    :param cache: If True, the result for a local image is reused if the same model was already given the same image (see results.py)
     :return: JSON object containing the gesture with the highest confidence OR None if no recognised gesture was found
     """
     minConfidence = 50
     arn = os.getenv("LATEST_MODEL_ARN")
 
     # The param given is a local image file
-    if os.path.isfile(image):
-        with open(image, "rb") as fileBytes:
-            # This may throw a ImageTooLargeException as the max allowed by AWS in byte format is 4mb (we let the caller deal with that)
-            try:
-                detectedLabels = rekogClient.detect_custom_labels(
-                    Image={
-                        'Bytes': fileBytes.read(),
-                    },
-                    MinConfidence=minConfidence,
-                    ProjectVersionArn=arn
-                )['CustomLabels']
-            except ClientError as e:
-                # On rare occassions, image is too big for AWS and will fail to process client side rather than server side
-                return commons.respond(
-                    messageType="ERROR",
-                    message=f"An error occured while processing {image} prior to uploading. Image may be too large for AWS to handle, try cropping or compressing the problamatic image.",
-                    content={"ERROR": str(e)},
-                    code=25
-                )
+    if images.isLocalImage(image):
+        image = images.imageHandle(image)
+
+        # Images are fitted to the 4mb limit AWS allows in byte format before they are sent
+        def detectCustomLabels():
+            return rekogClient.detect_custom_labels(
+                Image={
+                    'Bytes': images.fitImage(image),
+                },
+                MinConfidence=minConfidence,
+                ProjectVersionArn=arn
+            )['CustomLabels']
+
+        try:
+            detectedLabels = results.cachedCall(
+                "detect_custom_labels",
+                image,
+                {"ProjectVersionArn": arn, "MinConfidence": minConfidence, "MaxBytes": images.MAX_IMAGE_BYTES, "MaxDimension": images.MAX_IMAGE_DIMENSION},
+                detectCustomLabels,
+                cache
+            )
+        except ClientError as e:
+            # On rare occassions, image is too big for AWS and will fail to process client side rather than server side
+            return commons.respond(
+                messageType="ERROR",
+                message=f"An error occured while processing {image} prior to uploading. Image may be too large for AWS to handle, try cropping or compressing the problamatic image.",
+                content={"ERROR": str(e)},
+                code=25
+            )
     else:
         # The param given is a file path to an image in s3
         print("[WARNING] Given parameter is not image bytes or a local image, likelihood is we are dealing with an s3 object path...")
@@ -153,17 +319,89 @@ def checkForGestures(image):
         return None
 
 
-def getProjectVersions():
+# Each engine tries its checks in order until one finds a gesture, using the answer of the last check regardless. Checks marked True need the rekognition model running
+GESTURE_ENGINES = {
+    "rekognition": [(checkWithRekognition, True)],
+    "local": [(checkLocally, False), (checkWithRekognition, True)]
+}
+
+
+def engineChecks(engine=None):
+    engine = engine or GESTURE_ENGINE
+    if engine not in GESTURE_ENGINES:
+        return commons.respond(
+            messageType="ERROR",
+            message=f"Invalid gesture engine {engine}. Valid engines = {list(GESTURE_ENGINES)}",
+            code=13
+        )
+    return GESTURE_ENGINES[engine]
+
+
+@tracing.traced
+def checkForGestures(image, engine=None, cache=False):
+    """checkForGestures() : Identifies the gesture in an image with the GESTURE_ENGINE. I.e. Does this image contain a gesture and if so, which one is it most likely?
+    :param image: Locally stored image OR image bytes OR stream frame to scan for authentication gestures
+    :param engine: Name of the engine in GESTURE_ENGINES to use. Defaults to GESTURE_ENGINE
+    :param cache: If True, previous results for the same image are reused (see results.py)
+    :return: JSON object containing the gesture Name and Confidence OR None if no recognised gesture was found
+    """
+    checks = engineChecks(engine)
+    for position, (check, needsModel) in enumerate(checks):
+        # The model is only started up front for engines that always need it
+        if needsModel and position > 0:
+            projectHandler(True)
+        foundGesture = check(image, cache)
+        if foundGesture is not None or position == len(checks) - 1:
+            return foundGesture
+
+
+@tracing.traced
+def detectGestures(gestureImages, detect, workers=None):
+    """detectGestures() : Runs gesture detection on several images at once, keeping the results in combination order. If any image fails, the failure of the earliest image in the combination is raised, just as if they had been checked one after another
+    :param gestureImages: Images (or gesture types) in combination order
+    :param detect: Function given the position (starting at 1) and image that returns its detection result
+    :param workers: Maximum number of detections in flight. Defaults to GESTURE_DETECTION_WORKERS
+    :return: List of detection results in combination order
+    """
+    if len(gestureImages) == 0:
+        return []
+
+    def timedDetect(position, image):
+        startTime = time.perf_counter()
+        result = detect(position, image)
+        print(f"[INFO] Gesture detection for position {position} took {time.perf_counter() - startTime:.3f}s")
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(workers or DETECTION_WORKERS, len(gestureImages)), thread_name_prefix="detect") as pool:
+        futures = [pool.submit(tracing.wrap(timedDetect), position, image) for position, image in enumerate(gestureImages, start=1)]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            # No need to check the rest of the combination
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def projectVersionsKey():
+    return f"{os.getenv('PROJECT_ARN')}/{os.getenv('LATEST_MODEL_VERSION')}"
+
+
+def getProjectVersions(refresh=False):
     """getProjectVersions() : Retrieves all versions of the custom labels model. Often, we will only use the first/latest version as that is generally the most accurate and up-to-date
+    :param refresh: If True, the versions are described again instead of being taken from the cache (e.g. while waiting for the status to change)
     :return: List of project version in chronological order (latest to oldest)
     """
-    try:
+    def describeProjectVersions():
         return rekogClient.describe_project_versions(
             ProjectArn=os.getenv("PROJECT_ARN"),
             VersionNames=[
                 os.getenv("LATEST_MODEL_VERSION"),
             ]
         )["ProjectVersionDescriptions"]
+
+    try:
+        return projectVersionsCache.get(projectVersionsKey(), describeProjectVersions, refresh)
     except Exception as e:
         return commons.respond(
             messageType="ERROR",
@@ -173,6 +411,11 @@ def getProjectVersions():
         )
 
 
+def invalidateProjectVersions():
+    """invalidateProjectVersions() : Forgets the cached version details of the model (e.g. after asking it to start or stop)"""
+    projectVersionsCache.invalidate(projectVersionsKey())
+
+
 def awaitProject(start):
     """awaitProject() : Halts execution while waiting for a project to start up or shutdown
     :param start: Boolean denoting whether we are starting or stopping the project
@@ -201,122 +444,331 @@ def awaitProject(start):
                 message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} FAILED to start properly before {timeoutSeconds}s timeout expired. Model is likely still booting up",
                 code=15
             )
+        finally:
+            # The status was last cached before the model started
+            invalidateProjectVersions()
     else:
         # Stopping a model takes less time than starting one
-        stopTimeout = 200
-        print(f"[INFO] Request to stop {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model was successfully sent! Waiting {stopTimeout}s for the model to stop...")
-        time.sleep(stopTimeout)
+        print(f"[INFO] Request to stop {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model was successfully sent! Waiting up to {STOP_TIMEOUT}s for the model to stop...")
+        pollProjectStopped()
 
 
-def projectHandler(start):
-    """projectHandler() : Starts or stops the custom labels project in AWS. It will wait for the project to boot up after starting and will verify the project actually stopped after stopping.
-    :param start: Boolean denoting whether we are starting or stopping the project
-    :return: Error code and execution exit if request failed. True otherwwise.
+def pollProjectStopped(timeoutSeconds=None):
+    """pollProjectStopped() : Polls the latest model's status until it has stopped, starting with short delays that double up to STOP_POLL_MAX_DELAY
+    :param timeoutSeconds: Seconds to give up after. Defaults to STOP_TIMEOUT
+    :return: The last status seen (STOPPED unless the timeout expired)
     """
-    # Only bother retrieving the newest version
-    versionDetails = getProjectVersions()[0]
+    deadline = time.monotonic() + (timeoutSeconds or STOP_TIMEOUT)
+    delay = 1
+    while True:
+        status = getProjectVersions(refresh=True)[0]["Status"]
+        remaining = deadline - time.monotonic()
+        if status == "STOPPED" or remaining <= 0:
+            return status
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, STOP_POLL_MAX_DELAY)
+
+
+def watchProjectStop():
+    """watchProjectStop() : Confirms in the background that a model that was asked to stop has stopped, logging the outcome"""
+    try:
+        status = pollProjectStopped()
+    except Exception as e:
+        print(f"[WARNING] Could not confirm {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model stopped: {e}")
+        return
 
-    if start:
-        # Verify that the latest rekognition model is running
-        print(f"[INFO] Checking if {os.getenv('GESTURE_RECOG_PROJECT_NAME')} has already been started...")
+    if status == "STOPPED":
+        print(f"[SUCCESS] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model was successfully stopped!")
+    else:
+        print(f"[WARNING] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model is still {status} {STOP_TIMEOUT}s after it was asked to stop")
 
-        if versionDetails["Status"] == "STOPPED" or versionDetails["Status"] == "TRAINING_COMPLETED":
-            print(f"[INFO] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} is not running. Starting latest model for this project (created at {versionDetails['CreationTimestamp']}) now...")
 
-            # Start it and wait to be in a usable state
-            try:
-                rekogClient.start_project_version(
-                    ProjectVersionArn=os.getenv("LATEST_MODEL_ARN"),
-                    MinInferenceUnits=1  # Stick to one unit to save money
-                )
-            except rekogClient.exceptions.ResourceInUseException:
-                return commons.respond(
-                    messageType="ERROR",
-                    message=f"Failed to start {os.getenv('GESTURE_RECOG_PROJECT_NAME')}. System is in use (e.g. starting or stopping).",
-                    code=14
-                )
-            except Exception as e:
-                return commons.respond(
-                    messageType="ERROR",
-                    message=f"Failed to start {os.getenv('GESTURE_RECOG_PROJECT_NAME')}.",
-                    content={"ERROR": str(e)},
-                    code=14
-                )
+@tracing.traced
+def projectHandler(start, wait=False):
+    """projectHandler() : Starts or stops the custom labels project in AWS. It will wait for the project to boot up after starting (first waiting for it to stop if it is still stopping). After stopping, it either waits to verify the project actually stopped or confirms it in the background.
+    :param start: Boolean denoting whether we are starting or stopping the project
+    :param wait: If True, stopping blocks until the project has stopped. Otherwise it returns as soon as the stop was requested
+    :return: Error code and execution exit if request failed. True otherwwise.
+    """
+    with projectLock:
+        # Only bother retrieving the newest version. Starting or stopping is decided on the current status, as another execution may have changed it since it was cached
+        versionDetails = getProjectVersions(refresh=True)[0]
+
+        if start:
+            # Verify that the latest rekognition model is running
+            print(f"[INFO] Checking if {os.getenv('GESTURE_RECOG_PROJECT_NAME')} has already been started...")
+
+            if versionDetails["Status"] == "STOPPING":
+                # Usually the previous user's stop, which is not waited on. It can only be started again once stopped
+                print(f"[INFO] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} is stopping. Waiting up to {STOP_TIMEOUT}s for it to stop before starting it again...")
+                status = pollProjectStopped()
+                if status != "STOPPED":
+                    return commons.respond(
+                        messageType="ERROR",
+                        message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} is still stopping. Please check again later when the process is not busy...",
+                        content={"STATUS": status},
+                        code=23
+                    )
+                versionDetails = dict(versionDetails, Status=status)
 
-            awaitProject(start)
-            print(f"[SUCCESS] Model {versionDetails['CreationTimestamp']} is running!")
-            return True
-        elif versionDetails["Status"] == "STOPPING":
-            return commons.respond(
-                messageType="ERROR",
-                message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} is stopping. Please check again later when the process is not busy...",
-                code=23
-            )
-        elif versionDetails["Status"] == "STARTING":
-            awaitProject(start)
-            print(f"[SUCCESS] Model {versionDetails['CreationTimestamp']} is running!")
-            return True
-        else:
-            # Model is already running
-            print(f"[SUCCESS] The latest model (created at {versionDetails['CreationTimestamp']} is already running!")
-            return True
+            if versionDetails["Status"] == "STOPPED" or versionDetails["Status"] == "TRAINING_COMPLETED":
+                print(f"[INFO] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} is not running. Starting latest model for this project (created at {versionDetails['CreationTimestamp']}) now...")
 
-    # Stop the model after recog is complete
-    else:
-        if (versionDetails["Status"] == "RUNNING"):
-            print(f"[INFO] Stopping latest {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model...")
-            try:
-                rekogClient.stop_project_version(
-                    ProjectVersionArn=os.getenv("LATEST_MODEL_ARN")
-                )
-            except Exception as e:
-                return commons.respond(
-                    messageType="ERROR",
-                    message=f"Failed to stop the latest model of {os.getenv('GESTURE_RECOG_PROJECT_NAME')}",
-                    content={"ERROR": str(e)},
-                    code=15
-                )
+                # Start it and wait to be in a usable state
+                try:
+                    rekogClient.start_project_version(
+                        ProjectVersionArn=os.getenv("LATEST_MODEL_ARN"),
+                        MinInferenceUnits=1  # Stick to one unit to save money
+                    )
+                except rekogClient.exceptions.ResourceInUseException:
+                    return commons.respond(
+                        messageType="ERROR",
+                        message=f"Failed to start {os.getenv('GESTURE_RECOG_PROJECT_NAME')}. System is in use (e.g. starting or stopping).",
+                        code=14
+                    )
+                except Exception as e:
+                    return commons.respond(
+                        messageType="ERROR",
+                        message=f"Failed to start {os.getenv('GESTURE_RECOG_PROJECT_NAME')}.",
+                        content={"ERROR": str(e)},
+                        code=14
+                    )
+                finally:
+                    # Whether it started or was already busy, the cached status is now out of date
+                    invalidateProjectVersions()
 
-            # Verify model was actually stopped
-            stoppingVersion = getProjectVersions()[0]
-            if stoppingVersion["Status"] != "RUNNING":
                 awaitProject(start)
-                stoppedVersion = getProjectVersions()[0]
+                print(f"[SUCCESS] Model {versionDetails['CreationTimestamp']} is running!")
+                return True
+            elif versionDetails["Status"] == "STARTING":
+                awaitProject(start)
+                print(f"[SUCCESS] Model {versionDetails['CreationTimestamp']} is running!")
+                return True
+            else:
+                # Model is already running
+                print(f"[SUCCESS] The latest model (created at {versionDetails['CreationTimestamp']} is already running!")
+                return True
 
-                if stoppedVersion["Status"] == "STOPPED":
-                    print(f"[SUCCESS] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model was successfully stopped!")
+        # Stop the model after recog is complete
+        else:
+            if (versionDetails["Status"] == "RUNNING"):
+                print(f"[INFO] Stopping latest {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model...")
+                try:
+                    rekogClient.stop_project_version(
+                        ProjectVersionArn=os.getenv("LATEST_MODEL_ARN")
+                    )
+                except Exception as e:
+                    return commons.respond(
+                        messageType="ERROR",
+                        message=f"Failed to stop the latest model of {os.getenv('GESTURE_RECOG_PROJECT_NAME')}",
+                        content={"ERROR": str(e)},
+                        code=15
+                    )
+                finally:
+                    invalidateProjectVersions()
+
+                # Verify model was actually stopped
+                stoppingVersion = getProjectVersions(refresh=True)[0]
+                if stoppingVersion["Status"] != "RUNNING" and wait is False:
+                    # Nothing is waiting on the model to stop, so don't hold up the response for it
+                    print(f"[INFO] Request to stop {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model was successfully sent! Confirming it stopped in the background...")
+                    # A daemon thread, so a command line execution exits as soon as it has responded. A model still stopping then is waited on by the next execution that needs it
+                    threading.Thread(target=watchProjectStop, name="watchstop", daemon=True).start()
                     return True
+                elif stoppingVersion["Status"] != "RUNNING":
+                    awaitProject(start)
+                    stoppedVersion = getProjectVersions(refresh=True)[0]
+
+                    if stoppedVersion["Status"] == "STOPPED":
+                        print(f"[SUCCESS] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model was successfully stopped!")
+                        return True
+                    else:
+                        return commons.respond(
+                            messageType="ERROR",
+                            message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} FAILED to stop properly before timeout expired",
+                            content={"STATUS": stoppedVersion["Status"]},
+                            code=15
+                        )
                 else:
                     return commons.respond(
                         messageType="ERROR",
-                        message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} FAILED to stop properly before timeout expired",
-                        content={"STATUS": stoppedVersion["Status"]},
-                        code=15
+                        message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} stop request was successfull but the latest model is still running.",
+                        content={"MODEL": stoppingVersion['CreationTimestamp'], "STATUS": stoppingVersion['Status']},
+                        code=1
                     )
-            else:
+            elif versionDetails["Status"] == "STARTING":
+                # Wait for the project to finish starting, then try and stop it again
+                awaitProject(True)
+                projectHandler(False, wait)
+            elif versionDetails["Status"] == "STOPPING":
                 return commons.respond(
                     messageType="ERROR",
-                    message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} stop request was successfull but the latest model is still running.",
-                    content={"MODEL": stoppingVersion['CreationTimestamp'], "STATUS": stoppingVersion['Status']},
-                    code=1
+                    message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} is already stopping",
+                    code=23
                 )
-        elif versionDetails["Status"] == "STARTING":
-            # Wait for the project to finish starting, then try and stop it again
-            awaitProject(True)
-            projectHandler(False)
-        elif versionDetails["Status"] == "STOPPING":
+            else:
+                print(f"[WARNING] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model has already stopped!")
+                return True
+
+
+def processAlive(pid):
+    """processAlive() : Checks whether a process is still running
+    :param pid: Process id to check
+    :return: True if the process exists, False otherwise
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists but belongs to someone else
+        return True
+    return True
+
+
+def updateModelState(update):
+    """updateModelState() : Applies a change to the model's state file while holding a lock on it, so concurrent executions agree on who is using the model. Users whose process has exited without releasing the model are dropped first
+    :param update: Function given the state dictionary (HOLDERS, RELEASED and STOPPING) that changes it in place and returns a result. Changes are kept even if it raises
+    :return: The result of update
+    """
+    os.makedirs(os.path.dirname(MODEL_STATE_PATH), exist_ok=True)
+    with modelStateLock, open(f"{MODEL_STATE_PATH}.lock", "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            with open(MODEL_STATE_PATH, "r") as stateFile:
+                state = json.load(stateFile)
+        except (FileNotFoundError, ValueError):
+            state = {"HOLDERS": {}, "RELEASED": None, "STOPPING": None}
+        state.setdefault("STOPPING", None)
+
+        if state["STOPPING"] is not None and processAlive(state["STOPPING"]["PID"]) is False:
+            print("[WARNING] Model was marked as stopping by an execution that exited before it was stopped")
+            state["STOPPING"] = None
+
+        for holder, details in list(state["HOLDERS"].items()):
+            if processAlive(details["PID"]) is False:
+                print(f"[WARNING] Model user {holder} exited without releasing the model")
+                del state["HOLDERS"][holder]
+                state["RELEASED"] = time.time()
+
+        try:
+            return update(state)
+        finally:
+            commons.writeJsonFile(MODEL_STATE_PATH, state)
+
+
+def acquireModel():
+    """acquireModel() : Registers this execution as a user of the model and makes sure the model is running (if the GESTURE_ENGINE always needs it). Every call must be paired with a releaseModel()
+    :return: Holder id to release the model with
+    """
+    holder = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def register(state):
+        state["HOLDERS"][holder] = {"PID": os.getpid(), "ACQUIRED": time.time()}
+        return len(state["HOLDERS"]), state["STOPPING"] is not None
+
+    holders, stopping = updateModelState(register)
+    print(f"[INFO] Acquired {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model ({holders} current users)")
+    try:
+        # The last user is stopping the model. Once it has asked to, start it again rather than have it stopped under us
+        if stopping:
+            awaitModelStopRequest()
+        # Otherwise checkForGestures() starts it if the engine ever falls back to it
+        if engineChecks()[0][1]:
+            projectHandler(True)
+    except BaseException:
+        releaseModel(holder, True)
+        raise
+    return holder
+
+
+def releaseModel(holder, maintain=False):
+    """releaseModel() : Unregisters a user of the model. Once the last user is done, the model is stopped straight away if GESTURE_MODEL_IDLE_TIMEOUT is 0, otherwise reapModel() stops it after that many idle seconds
+    :param holder: Holder id returned by acquireModel()
+    :param maintain: If True, the model is never stopped straight away
+    :return: True if the model was stopped, False otherwise
+    """
+    stopper = uuid.uuid4().hex[:8]
+
+    def unregister(state):
+        state["HOLDERS"].pop(holder, None)
+        state["RELEASED"] = time.time()
+        if state["HOLDERS"] != {}:
+            print(f"[INFO] Leaving {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model running for its {len(state['HOLDERS'])} other users")
+            return False
+        if maintain or MODEL_IDLE_TIMEOUT > 0:
+            return False
+
+        # Only mark it as stopping while holding the lock. Anyone acquiring it in the meantime starts it again once it has been stopped
+        state["STOPPING"] = {"PID": os.getpid(), "ID": stopper}
+        state["RELEASED"] = None
+        return True
+
+    if updateModelState(unregister) is False:
+        return False
+    stopModel(stopper)
+    return True
+
+
+def reapModel():
+    """reapModel() : Stops the model once nobody has used it for GESTURE_MODEL_IDLE_TIMEOUT seconds. Run periodically by daemon.py or with -a reap
+    :return: True if the model was stopped, False otherwise
+    """
+    stopper = uuid.uuid4().hex[:8]
+
+    def reap(state):
+        if state["HOLDERS"] != {} or state["RELEASED"] is None:
+            return False
+        idleSeconds = time.time() - state["RELEASED"]
+        if idleSeconds < MODEL_IDLE_TIMEOUT:
+            return False
+
+        print(f"[INFO] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model has been idle for {idleSeconds:.0f}s. Stopping it...")
+        state["STOPPING"] = {"PID": os.getpid(), "ID": stopper}
+        state["RELEASED"] = None
+        return True
+
+    if updateModelState(reap) is False:
+        return False
+    stopModel(stopper)
+    return True
+
+
+def stopModel(stopper):
+    """stopModel() : Asks the model to stop after it was marked as stopping, then removes the mark so anyone who acquired it in the meantime can start it again
+    :param stopper: Id the model was marked as stopping with
+    """
+    try:
+        projectHandler(False, wait=False)
+    finally:
+        def stopRequested(state):
+            if state["STOPPING"] is not None and state["STOPPING"]["ID"] == stopper:
+                state["STOPPING"] = None
+
+        updateModelState(stopRequested)
+
+
+def awaitModelStopRequest():
+    """awaitModelStopRequest() : Waits for the execution that marked the model as stopping to have asked it to stop, so it can be started again afterwards
+    :return: Error code and execution exit if it is still marked as stopping after STOP_TIMEOUT seconds
+    """
+    deadline = time.monotonic() + STOP_TIMEOUT
+    while updateModelState(lambda state: state["STOPPING"]) is not None:
+        if time.monotonic() > deadline:
             return commons.respond(
                 messageType="ERROR",
-                message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} is already stopping",
+                message=f"{os.getenv('GESTURE_RECOG_PROJECT_NAME')} is still being stopped by its last user. Please check again later when the process is not busy...",
                 code=23
             )
-        else:
-            print(f"[WARNING] {os.getenv('GESTURE_RECOG_PROJECT_NAME')} model has already stopped!")
-            return True
+        time.sleep(MODEL_STOP_REQUEST_POLL)
 
 
-def main(argv):
-    """main() : Main method that parses the input opts and returns the result"""
+def main(argv, stdin=None):
+    """main() : Main method that parses the input opts and returns the result
+    :param argv: Command line arguments
+    :param stdin: Binary file object that images given as "-" are read from, in order
+    :return: Response of the requested action. ERROR responses are raised as a ResponseError
+    """
     # Parse input parameters
     argumentParser = argparse.ArgumentParser(
         description="Runs gesture recognition of an image or video frame against an image and has the option of exapnding it to check if a specific user possesses said gesture",
@@ -325,8 +777,8 @@ def main(argv):
     argumentParser.add_argument(
         "-a", "--action",
         required=True,
-        choices=["gesture", "start", "stop"],
-        help="""Only one action can be performed at one time:\n\ngesture: Runs gesture recognition analysis against a set of images (paths seperated by spaces).\n\nstart: Starts the rekognition project\n\nstop: Stops the rekognition project.
+        choices=["gesture", "start", "stop", "reap", "refresh"],
+        help="""Only one action can be performed at one time:\n\ngesture: Runs gesture recognition analysis against a set of images (paths seperated by spaces).\n\nstart: Starts the rekognition project\n\nstop: Stops the rekognition project.\n\nreap: Stops the rekognition project if nobody has used it for GESTURE_MODEL_IDLE_TIMEOUT seconds (e.g. run from cron).\n\nrefresh: Forgets the cached model details and gesture types (e.g. after retraining the model).
         """
     )
     argumentParser.add_argument(
@@ -334,7 +786,7 @@ def main(argv):
         required=False,
         action="extend",
         nargs="+",
-        help="List of full paths (seperated by spaces) to a gesture combination (in order) that you would like to analyse."
+        help="List of full paths (seperated by spaces) to a gesture combination (in order) that you would like to analyse. Images can also be passed in memory as - (read from stdin), shm:<name> or a data: URI"
     )
     argumentParser.add_argument(
         "-m", "--maintain",
@@ -342,43 +794,54 @@ def main(argv):
         required=False,
         help="If this parameter is set, the gesture recognition project will not be closed after rekognition is complete (only applicable with -a gesture"
     )
-    argDict = argumentParser.parse_args()
+    commons.addResponseArgument(argumentParser)
+    argDict = argumentParser.parse_args(argv)
 
     if argDict.action == "gesture":
-        # Start Rekog project
-        projectHandler(True)
-
-        # Iterate through given images
-        foundGestures = []
+        # Images passed in memory are read before anything is started
         try:
-            for imagePath in argDict.files:
-                # We will always be using a local file (or it's file bytes) so no need to check if in s3 or not here
-                if os.path.isfile(imagePath):
-                    try:
-                        Image.open(imagePath)
-                    except IOError:
-                        return commons.respond(
-                            messageType="ERROR",
-                            message=f"File {imagePath} exists but is not an image. Only jpg and png files are valid",
-                            code=7
-                        )
-                    foundGesture = checkForGestures(imagePath)
+            argDict.files = images.loadImageSources(argDict.files, stdin)
+        except ValueError as e:
+            return commons.respond(
+                messageType="ERROR",
+                message=str(e),
+                code=8
+            )
 
-                    # We have found a gesture
-                    if foundGesture is not None:
-                        foundGestures.append({f"{imagePath}": foundGesture})
-                    else:
-                        print(f"[WARNING] No gesture was found within {imagePath} (Available gestures = {' '.join(getGestureTypes())})")
-                        foundGestures.append({f"{imagePath}": None})
-                else:
+        # Start Rekog project
+        holder = acquireModel()
+
+        # Check the given images concurrently
+        def findGesture(position, imagePath):
+            # We will always be using a local file (or it's file bytes) so no need to check if in s3 or not here
+            if images.isLocalImage(imagePath):
+                try:
+                    imagePath = images.verifyImage(imagePath)
+                except IOError:
                     return commons.respond(
                         messageType="ERROR",
-                        message=f"No such file {imagePath}",
-                        code=8
+                        message=f"File {imagePath} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid",
+                        code=7
                     )
+                foundGesture = checkForGestures(imagePath)
+
+                # We have found a gesture
+                if foundGesture is not None:
+                    return {f"{imagePath}": foundGesture}
+                else:
+                    print(f"[WARNING] No gesture was found within {imagePath} (Available gestures = {' '.join(getGestureTypes())})")
+                    return {f"{imagePath}": None}
+            else:
+                return commons.respond(
+                    messageType="ERROR",
+                    message=f"No such file {imagePath}",
+                    code=8
+                )
+
+        try:
+            foundGestures = detectGestures(argDict.files, findGesture)
         finally:
-            if argDict.maintain is False:
-                projectHandler(False)
+            releaseModel(holder, argDict.maintain)
 
         # Display results
         if foundGestures == []:
@@ -403,12 +866,33 @@ def main(argv):
             code=0
         )
     elif argDict.action == "stop":
-        projectHandler(False)
+        projectHandler(False, wait=True)
         return commons.respond(
             messageType="SUCCESS",
             message="Latest project model is now stopped!",
             code=0
         )
+    elif argDict.action == "reap":
+        if reapModel():
+            return commons.respond(
+                messageType="SUCCESS",
+                message="Latest project model was idle and is now stopped!",
+                code=0
+            )
+        return commons.respond(
+            messageType="SUCCESS",
+            message=f"Latest project model is in use or has been used in the last {MODEL_IDLE_TIMEOUT:.0f}s, leaving it as it is",
+            code=0
+        )
+    elif argDict.action == "refresh":
+        invalidateProjectVersions()
+        invalidateGestureTypes()
+        return commons.respond(
+            messageType="SUCCESS",
+            message="Cached model details and gesture types were cleared",
+            content={"GESTURES": getGestureTypes()},
+            code=0
+        )
     else:
         return commons.respond(
             messageType="ERROR",
@@ -418,4 +902,6 @@ def main(argv):
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    responseFile = commons.parseResponseFile(sys.argv[1:])
+    commons.removeResponseFile(responseFile)
+    commons.emit(commons.invoke(main, sys.argv[1:], sys.stdin.buffer), responseFile)
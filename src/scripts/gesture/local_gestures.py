@@ -0,0 +1,299 @@
+# -----------------------------------------------------------
+# Local gesture classifier that runs on the CPU, as an alternative to the rekognition custom labels model
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from dotenv import load_dotenv
+load_dotenv()
+
+sys.path.append(os.path.dirname(__file__) + "/..")
+import commons  # noqa: E402
+import images  # noqa: E402
+
+# Model file written by trainModel() and used by the local gesture engine
+MODEL_PATH = os.getenv("GESTURE_LOCAL_MODEL_PATH", os.path.join(commons.CACHE_DIR, "gesture_model.npz"))
+# Number of nearest training images that vote on the gesture of an image
+NEIGHBOURS = int(os.getenv("GESTURE_LOCAL_NEIGHBOURS", 5))
+
+# Images are compared as HOG (histogram of oriented gradients) features of a small greyscale copy
+FEATURE_SIZE = 64
+CELL_SIZE = 8
+BLOCK_CELLS = 2
+ORIENTATIONS = 9
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+loadedModels = {}
+loadedModelsLock = threading.Lock()
+
+
+def loadImage(image):
+    """loadImage() : Opens an image as a small upright greyscale array ready for feature extraction
+    :param image: Path to a local image, ImageHandle or an opened PIL image
+    :return: FEATURE_SIZE x FEATURE_SIZE float32 array
+    """
+    opened = images.openImage(image) if not isinstance(image, Image.Image) else image
+    try:
+        # Let the JPEG decoder downscale while decoding, as only a tiny copy is needed
+        if opened.format == "JPEG":
+            opened.draft("L", (FEATURE_SIZE * 2, FEATURE_SIZE * 2))
+        upright = ImageOps.exif_transpose(opened).convert("L").resize((FEATURE_SIZE, FEATURE_SIZE), Image.BILINEAR)
+        return np.asarray(upright, dtype=np.float32) / 255
+    finally:
+        if opened is not image:
+            opened.close()
+
+
+def hogFeatures(pixels):
+    """hogFeatures() : Describes an image by the histograms of its gradient directions, which captures the outline of a hand while ignoring lighting
+    :param pixels: Greyscale image array from loadImage()
+    :return: L2 normalised feature vector
+    """
+    gradientY, gradientX = np.gradient(pixels)
+    magnitude = np.hypot(gradientX, gradientY)
+    # Unsigned orientations (0-180 degrees), as a dark hand on a light background looks the same as the reverse
+    orientation = np.rad2deg(np.arctan2(gradientY, gradientX)) % 180
+    bins = np.minimum((orientation / (180 / ORIENTATIONS)).astype(np.int64), ORIENTATIONS - 1)
+
+    # Sum the gradient magnitudes of every cell into its orientation histogram
+    cells = FEATURE_SIZE // CELL_SIZE
+    cellIndex = (np.arange(FEATURE_SIZE) // CELL_SIZE)
+    flatIndex = (cellIndex[:, None] * cells + cellIndex[None, :]) * ORIENTATIONS + bins
+    histograms = np.bincount(flatIndex.ravel(), weights=magnitude.ravel(), minlength=cells * cells * ORIENTATIONS)
+    histograms = histograms.reshape(cells, cells, ORIENTATIONS)
+
+    # Normalise overlapping blocks of cells (L2-Hys) so the features do not depend on contrast
+    blocks = cells - BLOCK_CELLS + 1
+    blockFeatures = np.stack([
+        histograms[row:row + BLOCK_CELLS, column:column + BLOCK_CELLS].ravel()
+        for row in range(blocks)
+        for column in range(blocks)
+    ])
+    blockFeatures /= np.sqrt((blockFeatures ** 2).sum(axis=1, keepdims=True) + 1e-6)
+    blockFeatures = np.minimum(blockFeatures, 0.2)
+    blockFeatures /= np.sqrt((blockFeatures ** 2).sum(axis=1, keepdims=True) + 1e-6)
+
+    features = blockFeatures.ravel().astype(np.float32)
+    return features / max(np.linalg.norm(features), 1e-6)
+
+
+class LocalGestureModel:
+    """LocalGestureModel : k-nearest neighbours classifier over the HOG features of the training images"""
+
+    def __init__(self, features, labels, classes, neighbours=None):
+        self.features = np.asarray(features, dtype=np.float32)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.classes = [str(gestureClass) for gestureClass in classes]
+        self.neighbours = max(1, min(neighbours or NEIGHBOURS, len(self.labels)))
+
+    def classify(self, image):
+        """classify() : Finds the most likely gesture in an image
+        :param image: Path to a local image or an opened PIL image
+        :return: JSON object of the gesture Name and Confidence (0-100), in the same shape as detect_custom_labels
+        """
+        features = hogFeatures(loadImage(image))
+        # The features are normalised, so the dot product is the cosine similarity
+        similarities = self.features @ features
+        nearest = np.argpartition(-similarities, self.neighbours - 1)[:self.neighbours]
+
+        # Closer neighbours get a bigger say in the vote
+        votes = np.bincount(self.labels[nearest], weights=np.maximum(similarities[nearest], 0) + 1e-6, minlength=len(self.classes))
+        winner = int(np.argmax(votes))
+        return {"Name": self.classes[winner], "Confidence": round(float(votes[winner] / votes.sum()) * 100, 3)}
+
+    def save(self, modelPath):
+        """save() : Writes the model to a compressed .npz file. Features are stored at half precision to keep the file small
+        :param modelPath: Path of the model file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(modelPath)), exist_ok=True)
+        tempFile = f"{modelPath}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            tempFile,
+            FEATURES=self.features.astype(np.float16),
+            LABELS=self.labels.astype(np.uint16),
+            CLASSES=np.array(self.classes),
+            NEIGHBOURS=np.array(self.neighbours),
+            FEATURE_SIZE=np.array(FEATURE_SIZE)
+        )
+        os.replace(tempFile, modelPath)
+
+    @classmethod
+    def load(cls, modelPath):
+        """load() : Reads a model written by save()
+        :param modelPath: Path of the model file
+        :return: The model
+        """
+        with np.load(modelPath, allow_pickle=False) as modelFile:
+            if int(modelFile["FEATURE_SIZE"]) != FEATURE_SIZE:
+                raise ValueError(f"{modelPath} was trained with {int(modelFile['FEATURE_SIZE'])}px features, retrain it")
+            return cls(modelFile["FEATURES"], modelFile["LABELS"], modelFile["CLASSES"], int(modelFile["NEIGHBOURS"]))
+
+
+def trainModel(datasetPath, modelPath=None, neighbours=None):
+    """trainModel() : Trains the local classifier from a dataset laid out like the rekognition one (gestureTraining/mixed/<label>/<image>) and saves it
+    :param datasetPath: Local directory containing one folder of images per gesture label
+    :param modelPath: Path to save the model to. Defaults to GESTURE_LOCAL_MODEL_PATH
+    :param neighbours: Number of nearest training images that vote on a gesture. Defaults to GESTURE_LOCAL_NEIGHBOURS
+    :return: The trained model
+    """
+    modelPath = modelPath or MODEL_PATH
+    classes = sorted(
+        entry for entry in os.listdir(datasetPath)
+        if os.path.isdir(os.path.join(datasetPath, entry))
+    )
+    features = []
+    labels = []
+    for label, gestureClass in enumerate(classes):
+        classPath = os.path.join(datasetPath, gestureClass)
+        for imageName in sorted(os.listdir(classPath)):
+            if not imageName.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            try:
+                features.append(hogFeatures(loadImage(os.path.join(classPath, imageName))))
+            except OSError as e:
+                print(f"[WARNING] Skipping {os.path.join(classPath, imageName)} as it could not be read: {e}")
+                continue
+            labels.append(label)
+
+    if features == []:
+        raise ValueError(f"No training images were found in {datasetPath}")
+
+    model = LocalGestureModel(np.stack(features), labels, classes, neighbours)
+    model.save(modelPath)
+    print(f"[SUCCESS] Trained the local gesture model on {len(labels)} images of {len(classes)} gestures and saved it to {modelPath}")
+    return model
+
+
+def getModel(modelPath=None):
+    """getModel() : Loads the local gesture model once per process, loading it again if the model file is retrained
+    :param modelPath: Path of the model file. Defaults to GESTURE_LOCAL_MODEL_PATH
+    :return: The model, or None if it has not been trained
+    """
+    modelPath = modelPath or MODEL_PATH
+    try:
+        modified = os.stat(modelPath).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with loadedModelsLock:
+        loaded = loadedModels.get(modelPath)
+        if loaded is None or loaded[0] != modified:
+            loaded = (modified, LocalGestureModel.load(modelPath))
+            loadedModels[modelPath] = loaded
+        return loaded[1]
+
+
+def classifyGesture(image, modelPath=None):
+    """classifyGesture() : Classifies the gesture in a local image with the local model
+    :param image: Path to a local image
+    :param modelPath: Path of the model file. Defaults to GESTURE_LOCAL_MODEL_PATH
+    :return: JSON object of the gesture Name and Confidence OR None if the model has not been trained
+    """
+    model = getModel(modelPath)
+    if model is None:
+        return None
+    return model.classify(image)
+
+
+#########
+# START #
+#########
+def main(argv):
+    """main() : Main method that parses the input opts and returns the result
+
+    :return: Response of the requested action. ERROR responses are raised as a ResponseError
+    """
+    argumentParser = argparse.ArgumentParser(
+        description="Trains and runs the local gesture classifier",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    argumentParser.add_argument(
+        "-a", "--action",
+        required=True,
+        choices=["train", "classify"],
+        help="""Action to be conducted:\n\ntrain: Trains the local model from a --dataset directory containing one folder of images per gesture (e.g. a local copy of gestureTraining/mixed/).\n\nclassify: Classifies the gestures in the --files with the local model.
+        """
+    )
+    argumentParser.add_argument(
+        "-d", "--dataset",
+        required=False,
+        help="Directory containing one folder of images per gesture label (train only)"
+    )
+    argumentParser.add_argument(
+        "-f", "--files",
+        required=False,
+        action="extend",
+        nargs="+",
+        help="List of full paths (seperated by spaces) to images to classify (classify only)"
+    )
+    argumentParser.add_argument(
+        "-m", "--model",
+        required=False,
+        help="Path of the model file. Defaults to GESTURE_LOCAL_MODEL_PATH"
+    )
+    commons.addResponseArgument(argumentParser)
+    argDict = argumentParser.parse_args(argv)
+
+    if argDict.action == "train":
+        if argDict.dataset is None or not os.path.isdir(argDict.dataset):
+            return commons.respond(
+                messageType="ERROR",
+                message=f"No such dataset directory {argDict.dataset}",
+                code=8
+            )
+        try:
+            model = trainModel(argDict.dataset, argDict.model)
+        except ValueError as e:
+            return commons.respond(
+                messageType="ERROR",
+                message=str(e),
+                code=8
+            )
+        return commons.respond(
+            messageType="SUCCESS",
+            message="Trained the local gesture model",
+            content={"MODEL": argDict.model or MODEL_PATH, "GESTURES": model.classes, "IMAGES": len(model.labels)},
+            code=0
+        )
+
+    if getModel(argDict.model) is None:
+        return commons.respond(
+            messageType="ERROR",
+            message=f"No local gesture model at {argDict.model or MODEL_PATH}. Train one with -a train first",
+            code=8
+        )
+
+    foundGestures = []
+    for imagePath in argDict.files or []:
+        if not os.path.isfile(imagePath):
+            return commons.respond(
+                messageType="ERROR",
+                message=f"No such file {imagePath}",
+                code=8
+            )
+        startTime = time.perf_counter()
+        foundGestures.append(classifyGesture(imagePath, argDict.model))
+        print(f"[INFO] Classified {imagePath} in {time.perf_counter() - startTime:.4f}s")
+
+    return commons.respond(
+        messageType="SUCCESS",
+        message="Classified gestures!",
+        content={"GESTURES": foundGestures},
+        code=0
+    )
+
+
+if __name__ == "__main__":
+    responseFile = commons.parseResponseFile(sys.argv[1:])
+    commons.removeResponseFile(responseFile)
+    commons.emit(commons.invoke(main, sys.argv[1:]), responseFile)
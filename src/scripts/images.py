@@ -0,0 +1,405 @@
+# -----------------------------------------------------------
+# Reads local images (files or images passed in memory) and prepares them so they always fit within the byte limits of the Rekognition APIs
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import io
+import os
+import mmap
+import base64
+import struct
+import hashlib
+import threading
+import urllib.parse
+from multiprocessing import resource_tracker, shared_memory
+
+from PIL import Image, ImageOps
+from dotenv import load_dotenv
+load_dotenv()
+
+# Rekognition rejects image bytes over 4MB (as ImageTooLargeException) so we keep under that
+MAX_IMAGE_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 4 * 1024 * 1024))
+# Larger images do not improve face or gesture detection, they only make the request bigger
+MAX_IMAGE_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1920))
+
+# Images can be passed in memory instead of as files. "-" reads the next frame from stdin (a 4 byte big endian length, then that many image bytes), "shm:<name>[:<length>]" copies a shared memory segment (e.g. /dev/shm/<name>) and "data:" decodes a data URI
+STDIN_SOURCE = "-"
+SHARED_MEMORY_PREFIX = "shm:"
+DATA_URI_PREFIX = "data:"
+FRAME_HEADER = struct.Struct(">I")
+
+# Files of this many bytes and over are memory mapped rather than read, so the pages are only touched by what actually needs them
+MMAP_MIN_BYTES = int(os.getenv("IMAGE_MMAP_BYTES", 4 * 1024 * 1024))
+
+# Formats are sniffed from the first bytes of an image instead of decoding it. Anything other than JPEG and PNG (the only formats Rekognition reads) is converted to JPEG before it is sent or uploaded
+REKOGNITION_FORMATS = ["JPEG", "PNG"]
+SUPPORTED_FORMATS = "jpg, png, gif, bmp, tiff and webp"
+MAGIC_BYTES = [
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+    (b"RIFF", "WEBP")
+]
+MAGIC_BYTES_LENGTH = 12
+
+MIN_JPEG_QUALITY = 40
+MAX_JPEG_QUALITY = 95
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageHandle:
+    """ImageHandle : Local image (a file, or one passed in memory) that is read once and then shared by validation, preprocessing, Rekognition and S3 uploads. Its format, dimensions, hash and fitted bytes are worked out once and cached"""
+
+    def __init__(self, name, data=None, path=None):
+        self.name = name
+        self.path = path
+        self.loaded = data
+        self.cache = {}
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        # Named after where it came from, so it reads like a path in logs and responses
+        return self.name
+
+    def __len__(self):
+        if self.loaded is None and self.path is not None:
+            return os.path.getsize(self.path)
+        return len(self.data)
+
+    def cached(self, key, compute):
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = compute()
+            return self.cache[key]
+
+    @property
+    def data(self):
+        """Bytes of the image (or a read only memory map of them for files of IMAGE_MMAP_BYTES and over), read on first use"""
+        if self.loaded is not None:
+            return self.loaded
+        with self.lock:
+            if self.loaded is None:
+                with open(self.path, "rb") as imageFile:
+                    size = os.fstat(imageFile.fileno()).st_size
+                    if size >= MMAP_MIN_BYTES:
+                        self.loaded = mmap.mmap(imageFile.fileno(), 0, access=mmap.ACCESS_READ)
+                    else:
+                        self.loaded = imageFile.read()
+            return self.loaded
+
+    @property
+    def format(self):
+        """PIL name of the image's format from its magic bytes (e.g. JPEG), or None if it is not an image"""
+        def sniff():
+            header = bytes(self.data[:MAGIC_BYTES_LENGTH])
+            for magic, imageFormat in MAGIC_BYTES:
+                if header.startswith(magic) and (imageFormat != "WEBP" or header[8:12] == b"WEBP"):
+                    return imageFormat
+            return None
+        return self.cached("format", sniff)
+
+    @property
+    def dimensions(self):
+        """Width and height of the image, read from its header without decoding it"""
+        def header():
+            with Image.open(self.open()) as image:
+                return image.size
+        return self.cached("dimensions", header)
+
+    @property
+    def digest(self):
+        """SHA256 hex digest of the image bytes"""
+        return self.cached("digest", lambda: hashlib.sha256(self.data).hexdigest())
+
+    def bytes(self):
+        """bytes() : Gets the image as bytes, copying it out of its memory map if it has one
+
+        :return: Image bytes
+        """
+        data = self.data
+        return data if isinstance(data, bytes) else bytes(data)
+
+    def open(self):
+        """open() : Opens the image as a file object of its own, without copying or reading it again
+
+        :return: Seekable binary file object of the image bytes
+        """
+        data = self.data
+        if isinstance(data, mmap.mmap):
+            # Every reader gets a separate mapping of the same pages, so their positions are independent
+            with open(self.path, "rb") as imageFile:
+                return mmap.mmap(imageFile.fileno(), 0, access=mmap.ACCESS_READ)
+        return io.BytesIO(data)
+
+
+def imageHandle(image):
+    """imageHandle() : Gets the handle of a local image, so it is only read once however many times it is used
+
+    :param image: ImageHandle, path or bytes
+
+    :return: ImageHandle of the image
+    """
+    if isinstance(image, ImageHandle):
+        return image
+    if isinstance(image, (bytes, bytearray)):
+        return ImageHandle("image bytes", data=bytes(image))
+    return ImageHandle(os.fspath(image), path=image)
+
+
+def isImageSource(argument):
+    """isImageSource() : Checks whether an argument passes an image in memory rather than naming a file or gesture
+
+    :param argument: Command line argument
+
+    :return: True if it is read with loadImageSource(), False otherwise
+    """
+    return isinstance(argument, str) and (argument == STDIN_SOURCE or argument.startswith((SHARED_MEMORY_PREFIX, DATA_URI_PREFIX)))
+
+
+def readFrame(stream):
+    """readFrame() : Reads the next length prefixed image from a stream (e.g. stdin or a socket)
+
+    :param stream: Binary file object to read from
+
+    :return: Image bytes
+    """
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError("No more image frames to read")
+    length = FRAME_HEADER.unpack(header)[0]
+    data = stream.read(length)
+    if len(data) < length:
+        raise ValueError(f"Image frame ended after {len(data)} of its {length} bytes")
+    return data
+
+
+def readSharedMemory(reference):
+    """readSharedMemory() : Copies an image out of a POSIX shared memory segment. The segment is left for whoever created it to remove
+
+    :param reference: shm:<name>, optionally followed by :<length> where segments are rounded up to whole pages (e.g. macOS)
+
+    :return: Image bytes
+    """
+    name, _, length = reference[len(SHARED_MEMORY_PREFIX):].partition(":")
+    try:
+        segment = shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching registers the segment to be removed when we exit
+        segment = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(segment._name, "shared_memory")
+    try:
+        size = int(length) if length else segment.size
+        return bytes(segment.buf[:size])
+    finally:
+        segment.close()
+
+
+def readDataUri(uri):
+    """readDataUri() : Decodes the image in a data URI (e.g. a browser capture)
+
+    :param uri: data:[<media type>][;base64],<data>
+
+    :return: Image bytes
+    """
+    header, separator, payload = uri[len(DATA_URI_PREFIX):].partition(",")
+    if separator == "":
+        raise ValueError("Data URI has no data")
+    if header.endswith(";base64"):
+        return base64.b64decode(payload, validate=True)
+    return urllib.parse.unquote_to_bytes(payload)
+
+
+def loadImageSource(argument, stdin=None, position=None):
+    """loadImageSource() : Gets the handle of a local image, reading it first if it is passed in memory. Anything else (S3 paths or gesture names) is returned as it is
+
+    :param argument: Command line argument
+
+    :param stdin: Binary file object that "-" reads frames from
+
+    :param position: Optional number of the frame being read from stdin, for naming it
+
+    :return: ImageHandle of the image, or the argument if it is not a local image
+    """
+    if isLocalImage(argument):
+        # Files are only read when they are first used
+        return imageHandle(argument)
+    if not isImageSource(argument):
+        return argument
+    try:
+        if argument == STDIN_SOURCE:
+            if stdin is None:
+                raise ValueError("There is no stdin to read image frames from")
+            return ImageHandle(f"stdin:{position or 1}", data=readFrame(stdin))
+        if argument.startswith(SHARED_MEMORY_PREFIX):
+            return ImageHandle(argument, data=readSharedMemory(argument))
+        return ImageHandle(f"{argument.split(',', 1)[0]},...", data=readDataUri(argument))
+    except (OSError, ValueError, base64.binascii.Error) as e:
+        raise ValueError(f"Could not read image from {argument[:64]}: {e}")
+
+
+def loadImageSources(arguments, stdin=None):
+    """loadImageSources() : Gets the handles of every local image among some arguments, reading the images passed in memory in order. See loadImageSource()
+
+    :param arguments: List of command line arguments (or a single argument, or None)
+
+    :param stdin: Binary file object that "-" reads frames from
+
+    :return: The arguments, with the local images replaced by ImageHandles
+    """
+    if arguments is None:
+        return None
+    if not isinstance(arguments, list):
+        return loadImageSources([arguments], stdin)[0]
+
+    loaded = []
+    frames = 0
+    for argument in arguments:
+        if argument == STDIN_SOURCE:
+            frames += 1
+        loaded.append(loadImageSource(argument, stdin, frames))
+    return loaded
+
+
+def isLocalImage(image):
+    """isLocalImage() : Checks whether an image is available locally, either in memory or as a file
+
+    :param image: ImageHandle or path
+
+    :return: True if it can be read with imageHandle(), False otherwise (e.g. it is an S3 path or gesture name)
+    """
+    return isinstance(image, ImageHandle) or (isinstance(image, str) and os.path.isfile(image))
+
+
+def verifyImage(image):
+    """verifyImage() : Checks a local image is an image from its magic bytes, without decoding it
+
+    :param image: ImageHandle or path
+
+    :return: ImageHandle of the image. Raises an IOError if it is not an image
+    """
+    handle = imageHandle(image)
+    if handle.format is None:
+        raise IOError(f"{handle} is not a supported image format")
+    return handle
+
+
+def readImage(image):
+    """readImage() : Reads the bytes of a local image
+
+    :param image: ImageHandle, path or bytes
+
+    :return: Image bytes
+    """
+    return imageHandle(image).bytes()
+
+
+def openImage(image):
+    """openImage() : Opens a local image with PIL, without reading it from disk again if it is already in memory
+
+    :param image: ImageHandle, path or bytes
+
+    :return: Opened (but not yet loaded) PIL image
+    """
+    return Image.open(imageHandle(image).open())
+
+
+def needsFitting(image, size, maxBytes, maxDimension):
+    """needsFitting() : Checks whether an image can be sent as it is or has to be re-encoded first
+
+    :param image: Opened (but not yet loaded) PIL image
+
+    :param size: Size of the image file in bytes
+
+    :param maxBytes: Byte budget the image has to fit in
+
+    :param maxDimension: Maximum width and height of the image
+
+    :return: True if the image is too big or needs rotating, False otherwise
+    """
+    if size > maxBytes or max(image.size) > maxDimension:
+        return True
+    if image.format not in REKOGNITION_FORMATS:
+        return True
+    return image.getexif().get(EXIF_ORIENTATION, 1) != 1
+
+
+def encodeJpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def fitJpeg(image, maxBytes):
+    """fitJpeg() : Encodes an image as a JPEG with the highest quality that fits the byte budget, shrinking the image if even the lowest quality does not fit
+
+    :param image: RGB PIL image to encode
+
+    :param maxBytes: Byte budget the encoded image has to fit in
+
+    :return: The encoded JPEG bytes
+
+    :raises ValueError: If the budget is too small for even a 1x1 JPEG
+    """
+    while True:
+        # Binary search for the best quality that still fits
+        low, high = MIN_JPEG_QUALITY, MAX_JPEG_QUALITY
+        best = None
+        while low <= high:
+            quality = (low + high) // 2
+            encoded = encodeJpeg(image, quality)
+            if len(encoded) <= maxBytes:
+                best = encoded
+                low = quality + 1
+            else:
+                high = quality - 1
+
+        if best is not None:
+            return best
+        if image.width == 1 and image.height == 1:
+            raise ValueError(f"A {maxBytes} byte budget is too small for any JPEG image")
+
+        print(f"[WARNING] Image does not fit in {maxBytes} bytes at {image.width}x{image.height}, shrinking it further...")
+        image = image.resize((max(1, int(image.width * 0.75)), max(1, int(image.height * 0.75))), Image.LANCZOS)
+
+
+def fitImage(imagePath, maxBytes=None, maxDimension=None):
+    """fitImage() : Gets the bytes of a local image that are ready to be sent to Rekognition. Images that are too large, too big in resolution or rotated by their EXIF data are re-encoded as an upright JPEG within the byte budget, everything else is returned untouched. The result is cached on the image's handle
+
+    :param imagePath: Path to the local image, ImageHandle or image bytes
+
+    :param maxBytes: Byte budget of the returned image. Defaults to IMAGE_MAX_BYTES
+
+    :param maxDimension: Maximum width and height of the returned image. Defaults to IMAGE_MAX_DIMENSION
+
+    :return: Image bytes
+    """
+    maxBytes = maxBytes or MAX_IMAGE_BYTES
+    maxDimension = maxDimension or MAX_IMAGE_DIMENSION
+    handle = imageHandle(imagePath)
+    return handle.cached(("fitted", maxBytes, maxDimension), lambda: fitHandle(handle, maxBytes, maxDimension))
+
+
+def fitHandle(handle, maxBytes, maxDimension):
+    with Image.open(handle.open()) as image:
+        handle.cache.setdefault("dimensions", image.size)
+        if not needsFitting(image, len(handle), maxBytes, maxDimension):
+            return handle.bytes()
+
+        # Let the JPEG decoder downscale while decoding (by powers of 2), which is far cheaper than decoding at full size
+        if image.format == "JPEG":
+            image.draft("RGB", (maxDimension, maxDimension))
+
+        fitted = ImageOps.exif_transpose(image)
+        fitted.thumbnail((maxDimension, maxDimension), Image.LANCZOS)
+        if fitted.mode != "RGB":
+            fitted = fitted.convert("RGB")
+
+    fittedBytes = fitJpeg(fitted, maxBytes)
+    print(f"[INFO] Fitted {handle} from {len(handle)} to {len(fittedBytes)} bytes ({fitted.width}x{fitted.height})")
+    return fittedBytes
@@ -5,11 +5,10 @@
 # Released under GNU GPL v3 License
 # -----------------------------------------------------------
 
-import boto3
 from botocore.exceptions import ClientError, EndpointConnectionError
-from boto3.s3.transfer import TransferConfig
 from ratelimit import RateLimitException
 
+import io
 import sys
 import argparse
 import os
@@ -17,91 +16,110 @@ import time
 import subprocess
 import signal
 import json
-import random
 import logging
-from PIL import Image
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 from face import index_photo
 from face import compare_faces
+from face import local_faces
 from gesture import gesture_recog
 import commons
+import images
+import results
+import tracing
 
 # GLOBALS
-s3Client = boto3.client('s3')
-rekogClient = boto3.client('rekognition')
+s3Client = commons.LazyClient('s3')
+rekogClient = commons.LazyClient('rekognition')
 logger = logging.getLogger()
 TIMEOUT_SECONDS = 20
+# Whether rekognition results are reused for identical images (see results.py) when enrolling gestures and when checking a login
+ENROLMENT_RESULT_CACHE = os.getenv("RESULT_CACHE_ENROLMENT", "true").lower() == "true"
+LOGIN_RESULT_CACHE = os.getenv("RESULT_CACHE_LOGIN", "false").lower() == "true"
+# This is appended to an upload error messsage in case the user is creating an account and something goes wrong
+UPLOAD_ERROR_SUFFIX = "WARNING: If you are executing this via manager.py -a create your profile has been partially created on s3. To ensure you do not suffer hard to debug problems, please ensure you delete your profile with -a delete before trying -a create again"
+# Most batches of keys (delete_objects takes up to DELETE_BATCH_SIZE) and profiles that are deleted at the same time
+DELETE_WORKERS = int(os.getenv("S3_DELETE_WORKERS", 8))
+DELETE_BATCH_SIZE = 1000
+# There is only one camera stream so stream comparisons have to take turns when served concurrently
+streamLock = threading.Lock()
 load_dotenv()
 
 
-def delete_file(fileName):
-    """delete_file() : Deletes a S3 object file
+def delete_prefix(prefix):
+    """delete_prefix() : Deletes every S3 object under a prefix. Each page of the listing is deleted with one delete_objects call (of up to 1000 keys) in the background while the next page is listed
 
-    :param fileName: S3 Path to file to be deleted
+    :param prefix: S3 prefix to empty (e.g. users/foobar/)
 
-    :return: S3 file object path that was successfully deleted
+    :return: List of the S3 object keys that were deleted
     """
+    bucket = os.getenv("FACE_RECOG_BUCKET")
 
-    try:
-        print("[INFO] Deleting...")
-        s3Client.delete_object(
-            Bucket=os.getenv("FACE_RECOG_BUCKET"),
-            Key=fileName
+    def deleteBatch(keys):
+        response = s3Client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
         )
+        # Quiet deletes only report the keys that failed
+        return response.get("Errors", [])
+
+    deleted = []
+    errors = []
+    try:
+        print(f"[INFO] Deleting everything under {prefix}...")
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS, thread_name_prefix="delete") as pool:
+            batches = []
+            for page in s3Client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": DELETE_BATCH_SIZE}):
+                keys = [entry["Key"] for entry in page.get("Contents", [])]
+                if keys != []:
+                    batches.append((keys, pool.submit(tracing.wrap(deleteBatch), keys)))
+            for keys, batch in batches:
+                batchErrors = batch.result()
+                failedKeys = {error["Key"] for error in batchErrors}
+                errors.extend(batchErrors)
+                deleted.extend(key for key in keys if key not in failedKeys)
     except EndpointConnectionError:
         return commons.respond(
             messageType="ERROR",
-            message="FAILED to delete object from S3. Could not establish a connection to AWS",
+            message="FAILED to delete objects from S3. Could not establish a connection to AWS",
             code=3
         )
 
-    # Verify the object was deleted
-    try:
-        deletionRequest = s3Client.get_object_acl(
-            Bucket=os.getenv("FACE_RECOG_BUCKET"),
-            Key=fileName
-        )
-    except s3Client.exceptions.NoSuchKey:
-        print(f"[SUCCESS] {fileName} has been successfully deleted from S3!")
-        return fileName
-    except EndpointConnectionError:
+    if errors != []:
         return commons.respond(
             messageType="ERROR",
-            message="FAILED to verify if object was successfully deleted from S3. Could not establish a connection to AWS",
-            code=2
+            message=f"FAILED to delete {len(errors)} objects under {prefix} from S3",
+            content={"ERRORS": errors},
+            code=4
         )
 
-    return commons.respond(
-        messageType="ERROR",
-        message=f"FAILED to verify if {fileName} object was successfully deleted from S3",
-        content=deletionRequest,
-        code=4
-    )
+    print(f"[SUCCESS] {len(deleted)} objects under {prefix} have been successfully deleted from S3!")
+    return deleted
 
 
-def upload_file(fileName, username, locktype=None, s3Name=None):
-    """upload_file() : Uploads a file to an S3 bucket based off the input params entered.
+def start_upload(fileName, username, locktype=None, s3Name=None):
+    """start_upload() : Verifies a file is an image and starts uploading it to the user's S3 folder in the background, using the shared transfer manager
 
-    :param fileName: Path to file to be uploaded
+    :param fileName: Path to file (or ImageHandle) to be uploaded
 
     :param username: User to upload the new face details to
 
+    :param locktype: If given, the file is a gesture uploaded to this combination's folder
+
     :param s3Name: S3 object name and or path. If not specified then the filename is used
 
-    :return: S3 object path to the uploaded object
+    :return: Tuple of the S3 object path being uploaded to and the upload's future
     """
-    # This is appended to an error messsage in case the user is creating an account and something goes wrong
-    errorSuffix = "WARNING: If you are executing this via manager.py -a create your profile has been partially created on s3. To ensure you do not suffer hard to debug problems, please ensure you delete your profile with -a delete before trying -a create again"
-
     # Verify file exists
-    if os.path.isfile(fileName):
+    if images.isLocalImage(fileName):
         try:
-            Image.open(fileName)
+            fileName = images.verifyImage(fileName)
         except IOError:
             return commons.respond(
                 messageType="ERROR",
-                message=f"File {fileName} exists but is not an image. Only jpg and png files are valid. {errorSuffix}",
+                message=f"File {fileName} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid. {UPLOAD_ERROR_SUFFIX}",
                 code=7
             )
     else:
@@ -110,7 +128,7 @@ def upload_file(fileName, username, locktype=None, s3Name=None):
 
     # If S3 name was not specified, use fileName
     if s3Name is None:
-        objectName = commons.parseObjectName(fileName)
+        objectName = commons.parseObjectName(str(fileName))
     else:
         objectName = commons.parseImageObject(s3Name)
 
@@ -120,39 +138,140 @@ def upload_file(fileName, username, locktype=None, s3Name=None):
     else:
         objectName = f"users/{username}/{objectName}"
 
-    # Upload the file
+    # Uploaded straight from the image's buffer, which validating it already read. Rekognition only reads JPEG and PNG objects from S3, so anything else is stored converted
+    if fileName.format in images.REKOGNITION_FORMATS:
+        source = fileName.open()
+    else:
+        source = io.BytesIO(images.fitImage(fileName))
+    print(f"[INFO] Uploading {fileName}...")
+    return objectName, commons.getTransferManager().upload(source, os.getenv("FACE_RECOG_BUCKET"), objectName)
+
+
+@tracing.traced
+def finish_upload(fileName, upload):
+    """finish_upload() : Waits for a background upload started by start_upload() to complete
+
+    :param fileName: Path to the file being uploaded
+
+    :param upload: Future of the upload
+    """
     try:
-        print(f"[INFO] Uploading {fileName}...")
         # Sometimes this will time out on a first file upload
-        with open(fileName, "rb") as fileBytes:
-            s3Client.upload_fileobj(
-                Fileobj=fileBytes,
-                Bucket=os.getenv("FACE_RECOG_BUCKET"),
-                Key=objectName,
-                Config=TransferConfig(
-                    multipart_threshold=16777216,
-                    max_concurrency=20,
-                    num_download_attempts=10
-                )
-            )
+        upload.result()
     except ClientError as e:
         return commons.respond(
             messageType="ERROR",
-            message=f"{fileName} FAILED to upload to S3. {errorSuffix}",
+            message=f"{fileName} FAILED to upload to S3. {UPLOAD_ERROR_SUFFIX}",
             content={"ERROR": str(e)},
             code=3
         )
     except EndpointConnectionError as e:
         return commons.respond(
             messageType="ERROR",
-            message=f"{fileName} FAILED to upload to S3. Could not establish a connection to AWS. {errorSuffix}",
+            message=f"{fileName} FAILED to upload to S3. Could not establish a connection to AWS. {UPLOAD_ERROR_SUFFIX}",
             content={"ERROR": str(e)},
             code=3
         )
 
+
+@tracing.traced
+def upload_file(fileName, username, locktype=None, s3Name=None):
+    """upload_file() : Uploads a file to an S3 bucket based off the input params entered.
+
+    :param fileName: Path to file to be uploaded
+
+    :param username: User to upload the new face details to
+
+    :param s3Name: S3 object name and or path. If not specified then the filename is used
+
+    :return: S3 object path to the uploaded object
+    """
+    objectName, upload = start_upload(fileName, username, locktype, s3Name)
+    finish_upload(fileName, upload)
     return objectName
 
 
+class PendingUploads:
+    """PendingUploads : Background uploads of a single action, so that they can overlap with the rest of the action and then be waited on (or removed again) together"""
+
+    def __init__(self, username):
+        self.username = username
+        self.uploads = []
+        self.written = []
+        self.lock = threading.Lock()
+
+    def add(self, fileName, locktype=None, s3Name=None):
+        """add() : Starts uploading a file in the background
+
+        :param fileName: Path to file to be uploaded
+
+        :param locktype: If given, the file is a gesture uploaded to this combination's folder
+
+        :param s3Name: S3 object name and or path. If not specified then the filename is used
+
+        :return: S3 object path the file is being uploaded to
+        """
+        try:
+            objectName, upload = start_upload(fileName, self.username, locktype, s3Name)
+        except FileNotFoundError:
+            return commons.respond(
+                messageType="ERROR",
+                message=f"Could no longer find file {fileName}",
+                code=8
+            )
+
+        with self.lock:
+            self.uploads.append((fileName, objectName, upload))
+        return objectName
+
+    def track(self, objectName):
+        """track() : Records an object written to S3 outside of the background uploads, so that it is removed on rollback too
+
+        :param objectName: S3 object key that is (or may be) written
+        """
+        with self.lock:
+            self.written.append(objectName)
+
+    @tracing.traced
+    def wait(self):
+        """wait() : Waits for every upload to complete, raising the error of the first one that failed"""
+        with self.lock:
+            uploads = list(self.uploads)
+
+        for fileName, objectName, upload in uploads:
+            finish_upload(fileName, upload)
+        print(f"[SUCCESS] {len(uploads)} files uploaded to S3!")
+
+    def rollback(self):
+        """rollback() : Cancels any unfinished uploads and deletes everything uploaded so far. This is best effort, failures are only logged"""
+        with self.lock:
+            uploads = list(self.uploads)
+            written = list(self.written)
+            self.uploads = []
+            self.written = []
+        if uploads == [] and written == []:
+            return
+
+        for fileName, objectName, upload in uploads:
+            upload.cancel()
+        for fileName, objectName, upload in uploads:
+            try:
+                upload.result()
+            except Exception:
+                # Cancelled or failed, either way the object is removed below in case it was partly written
+                pass
+
+        objectNames = [objectName for fileName, objectName, upload in uploads] + written
+        print(f"[INFO] Removing {len(objectNames)} uploaded files from S3...")
+        try:
+            s3Client.delete_objects(
+                Bucket=os.getenv("FACE_RECOG_BUCKET"),
+                Delete={"Objects": [{"Key": objectName} for objectName in objectNames], "Quiet": True}
+            )
+        except Exception as e:
+            print(f"[WARNING] Failed to remove uploaded files from S3: {e}")
+
+
 def streamHandler(start, sleepTime=None):
     """streamHandler() : Starts or stops the live stream to AWS, sleeping after starting briefly to allow it to get situated. It will also check the error codes of the respective start and stop shell scripts to verify the stream actually started/stopped.
 
@@ -194,6 +313,7 @@ def timeoutHandler(signum, stackFrame):
     raise TimeoutError
 
 
+@tracing.traced
 def adjustConfigFramework(imagePaths, username, locktype, previousFramework=None):
     """adjustConfigFramework() : Modifies a gesture configuration file according to the user's edit changes
 
@@ -231,26 +351,22 @@ def adjustConfigFramework(imagePaths, username, locktype, previousFramework=None
         newGestureUnlockConfig = constructGestureFramework(imagePaths, username, locktype, previousFramework)
         newGestureConfig = {"lock": oldFullConfig["lock"], "unlock": newGestureUnlockConfig}
 
-    # Upload new gestures, adjusting the path of the config file to be s3 relative
+    # Upload new gestures all at once, adjusting the path of the config file to be s3 relative
+    uploads = PendingUploads(username)
     for position, details in newGestureConfig[locktype].items():
-        try:
-            gestureObjectPath = upload_file(details["path"], username, locktype, f"{locktype.capitalize()}Gesture{position}")
-        except FileNotFoundError:
-            return commons.respond(
-                messageType="ERROR",
-                message=f"Could no longer find file {details['path']}",
-                code=8
-            )
-        newGestureConfig[locktype][position]["path"] = gestureObjectPath
+        newGestureConfig[locktype][position]["path"] = uploads.add(details["path"], locktype, f"{locktype.capitalize()}Gesture{position}")
+    uploads.wait()
 
     # Upload gesture configuration file
     try:
-        s3Client.put_object(
+        uploadedConfig = s3Client.put_object(
             Body=json.dumps(newGestureConfig, indent=2).encode("utf-8"),
             Bucket=os.getenv("FACE_RECOG_BUCKET"),
             Key=f"users/{username}/gestures/GestureConfig.json"
         )
+        gesture_recog.cacheUserCombinationFile(username, newGestureConfig, uploadedConfig["ETag"])
     except Exception as e:
+        gesture_recog.invalidateUserCombinationFile(username)
         return commons.respond(
             messageType="ERROR",
             message="Failed to upload updated gesture configuration file",
@@ -261,8 +377,9 @@ def adjustConfigFramework(imagePaths, username, locktype, previousFramework=None
     return newGestureConfig
 
 
-def constructGestureFramework(imagePaths, username, locktype, previousFramework=None):
-    """constructGestureFramework() : Uploads gesture recognition images and config file to the user's S3 folder
+@tracing.traced
+def constructGestureFramework(imagePaths, username, locktype, previousFramework=None, uploads=None):
+    """constructGestureFramework() : Identifies the gestures of a combination and checks it meets the combination rules, building its part of the gestures.json config
 
     :param imagePaths: List of images paths or gesture types (in combination order)
 
@@ -272,37 +389,25 @@ def constructGestureFramework(imagePaths, username, locktype, previousFramework=
 
     :param previousFramework: If a framework has already been created, we will run tests against both it and the soon to be created framework in tandem
 
+    :param uploads: Optional PendingUploads that each image is added to as soon as its gesture is identified. The config paths are then the S3 paths of the images
+
     :returns: A completed gestures.json config
     """
-    position = 1
-    gestureConfig = {}
-    for path in imagePaths:
-        if os.path.isfile(path):
+    def identifyGesture(position, path):
+        if images.isLocalImage(path):
             # Verify local file is an actual image
             try:
-                Image.open(path)
+                path = images.verifyImage(path)
             except IOError:
                 return commons.respond(
                     messageType="ERROR",
-                    message=f"File {path} exists but is not an image. Only jpg and png files are valid",
+                    message=f"File {path} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid",
                     code=7
                 )
 
-            # Identify the gesture type
+            # Identify the gesture type (oversized images are fitted to the AWS limits before they are sent)
             print(f"[INFO] Identifying gesture type for {path}")
-            try:
-                gestureType = gesture_recog.checkForGestures(path)
-            except rekogClient.exceptions.ImageTooLargeException:
-                print(f"[WARNING] {path} is too large (>4MB) to check for gestures directly. Uploading to S3 first and then checking for gestures.")
-                try:
-                    gestureObjectPath = upload_file(path, username, locktype, f"{locktype.capitalize()}Gesture{position}")
-                except FileNotFoundError:
-                    return commons.respond(
-                        messageType="ERROR",
-                        message=f"Could no longer find file {path}",
-                        code=8
-                    )
-                gestureType = gesture_recog.checkForGestures(gestureObjectPath)
+            gestureType = gesture_recog.checkForGestures(path, cache=ENROLMENT_RESULT_CACHE)
 
             if gestureType is not None:
                 # Extract the actual gesture type here since error's will return None above
@@ -328,9 +433,15 @@ def constructGestureFramework(imagePaths, username, locktype, previousFramework=
             else:
                 print(f"[SUCCESS] Gesture type identified as {gestureType}")
 
-        # We leave path empty for now as it's updated when we uploaded the files
-        gestureConfig[str(position)] = {"gesture": gestureType, "path": path}
-        position += 1
+        # Start uploading straight away so it overlaps with identifying the rest of the images
+        if uploads is not None:
+            path = uploads.add(path, locktype, f"{locktype.capitalize()}Gesture{position}")
+
+        return {"gesture": gestureType, "path": path}
+
+    # Images are identified concurrently but any error is reported for the earliest failing position, as if done in order
+    identifiedGestures = gesture_recog.detectGestures(imagePaths, identifyGesture)
+    gestureConfig = {str(position): details for position, details in enumerate(identifiedGestures, start=1)}
 
     # Finally, verify we are not using bad "password" practices (e.g. all the same values)
     print("[INFO] Checking combination meets rule requirements...")
@@ -389,7 +500,6 @@ def parseArgs(args):
 
     :return: A dictionary of args by name
     """
-    global TIMEOUT_SECONDS
     argumentParser = argparse.ArgumentParser(
         description="Welcome to the eye of horus facial and gesture recognition authentication system! Please see the command options below for the usage of this tool outside of a website environment.",
         formatter_class=argparse.RawTextHelpFormatter
@@ -399,27 +509,27 @@ def parseArgs(args):
         "-a", "--action",
         required=True,
         choices=["create", "edit", "delete", "compare", "gesture"],
-        help="""Only one action can be performed at one time:\n\ncreate: Creates a new user --profile in s3 and uploads and indexes the --face file alongside the ----lock-gestures (OPTIONAL) and --unlock-gestures image files. --name can optionally be added if the name of the --face file is not what it should be in S3.\n\nedit: Edits a user --profile account's --face, --lock or --unlock feature. If you wish to delete your lock combination, specify --lock DELETE in lieu of entering a combination of gesture types to change your combination to. Note: It is not possible to rename a user --profile. Please delete your account and create a new one if you wish to do so.\n\ndelete: Deletes a user --profile account inside S3 by doing the reverse of --action create.\n\ncompare: Starts streaming and executes the facial comparison library against ALL users in the database. Alternatively, you can specify a --face to compare against a --profile's. Or you can specify a --profile on it's own to compare the captured face with that profile's stored face. You can alter the length of the stream search timeout with --timeout.\n\ngesture: Takes a number of --lock OR --unlock images as input for authenticating with the gesture recognition client against the user --profile.
+        help="""Only one action can be performed at one time:\n\ncreate: Creates a new user --profile in s3 and uploads and indexes the --face file alongside the ----lock-gestures (OPTIONAL) and --unlock-gestures image files. --name can optionally be added if the name of the --face file is not what it should be in S3.\n\nedit: Edits a user --profile account's --face, --lock or --unlock feature. If you wish to delete your lock combination, specify --lock DELETE in lieu of entering a combination of gesture types to change your combination to. Note: It is not possible to rename a user --profile. Please delete your account and create a new one if you wish to do so.\n\ndelete: Deletes a user --profile account inside S3 by doing the reverse of --action create. Everything in the user's S3 folder is deleted. Several --profile accounts can be deleted at once.\n\ncompare: Starts streaming and executes the facial comparison library against ALL users in the database. Alternatively, you can specify a --face to compare against a --profile's. Or you can specify a --profile on it's own to compare the captured face with that profile's stored face. You can alter the length of the stream search timeout with --timeout.\n\ngesture: Takes a number of --lock OR --unlock images as input for authenticating with the gesture recognition client against the user --profile.
         """
     )
     argumentParser.add_argument(
         "-f", "--face",
         required=False,
-        help="Path to the jpg or png image file to use as your facial recognition face to compare against when running the kinesis stream"
+        help="Path to the jpg or png image file to use as your facial recognition face to compare against when running the kinesis stream. Images can also be passed in memory as - (read from stdin), shm:<name> or a data: URI"
     )
     argumentParser.add_argument(
         "-l", "--lock",
         required=False,
         action="extend",
         nargs="+",
-        help="ABSOLUTE Paths to jpg or png image files (seperated with spaces) to use as the --profile user's lock gesture recognition combination (OPTIONAL). Use with -a edit/create to construct a new combination or to delete an existing one by specifying DELETE in lieu OR with -a gesture to attempt to authenticate with the matching gestures"
+        help="ABSOLUTE Paths to jpg or png image files (seperated with spaces) to use as the --profile user's lock gesture recognition combination (OPTIONAL). Use with -a edit/create to construct a new combination or to delete an existing one by specifying DELETE in lieu OR with -a gesture to attempt to authenticate with the matching gestures. Like --face, images can be passed in memory"
     )
     argumentParser.add_argument(
         "-u", "--unlock",
         required=False,
         action="extend",
         nargs="+",
-        help="ABSOLUTE Paths to jpg or png image files (seperated with spaces) to use as the --profile user's unlock gesture recognition combination. Use with -a edit/create to construct a new combination OR with -a gesture to attempt to authenticate with the matching gestures"
+        help="ABSOLUTE Paths to jpg or png image files (seperated with spaces) to use as the --profile user's unlock gesture recognition combination. Use with -a edit/create to construct a new combination OR with -a gesture to attempt to authenticate with the matching gestures. Like --face, images can be passed in memory"
     )
     argumentParser.add_argument(
         "-n", "--name",
@@ -435,7 +545,9 @@ def parseArgs(args):
     argumentParser.add_argument(
         "-p", "--profile",
         required=False,
-        help="Username to perform the -a action upon. Result depends on the action chosen"
+        action="extend",
+        nargs="+",
+        help="Username to perform the -a action upon. Result depends on the action chosen. -a delete accepts several usernames (seperated by spaces) and deletes them all"
     )
     argumentParser.add_argument(
         "-m", "--maintain",
@@ -443,530 +555,757 @@ def parseArgs(args):
         required=False,
         help="If this parameter is set, the gesture recognition project will not be shutdown after rekognition is complete (only applicable with -a create,gesture,edit)"
     )
+    commons.addResponseArgument(argumentParser)
+    argumentParser.add_argument(
+        "--trace",
+        action="store_true",
+        required=False,
+        help="Times the action, its helpers and every AWS call it makes and adds the totals to the response CONTENT as TRACE. Always on if TRACE=true"
+    )
+    argumentParser.add_argument(
+        "--trace-output",
+        required=False,
+        help="Path to write the trace to as Chrome trace JSON (e.g. to open in chrome://tracing). Defaults to TRACE_OUTPUT"
+    )
     argDict = argumentParser.parse_args(args)
     print("[INFO] Parsed arguments:")
     print(f"{argDict}\n")
     return argDict
 
 
-#########
-# START #
-#########
-def main(parsedArgs=None):
-    """main() : Main method that parses the input opts and returns the result"""
-    global TIMEOUT_SECONDS
-    # Delete old response file if it exists
-    if os.path.isfile(os.getenv("RESPONSE_FILE_PATH")):
-        try:
-            os.remove(os.getenv("RESPONSE_FILE_PATH"))
-        except Exception as e:
-            print(f"[WARNING] Failed to delete old response json file\n{e}")
+def create_user(profile, face, unlock, lock=None, name=None, maintain=False):
+    """create_user() : Creates a new user profile in the rekognition collection and s3
 
-    # Parse input parameters
-    if parsedArgs is None:
-        # Parse with sys args if running by command line
-        argDict = parseArgs(sys.argv[1:])
-    else:
-        # Assume the args have already been parsed
-        argDict = parsedArgs
+    :param profile: Username of the new account
 
-    # Create a new user profile in the rekognition collection and s3
-    if argDict.action == "create":
-        # Verify we have a face to create
-        if argDict.face is None:
-            return commons.respond(
-                messageType="ERROR",
-                message="-f was not given. Please provide a face to be used in recognition for your account.",
-                code=13
-            )
-        else:
-            if os.path.isfile(argDict.face):
-                try:
-                    Image.open(argDict.face)
-                except IOError:
-                    return commons.respond(
-                        messageType="ERROR",
-                        message=f"File {argDict.face} exists but is not an image. Only jpg and png files are valid",
-                        code=7
-                    )
-            else:
+    :param face: Path to the face image to index and upload
+
+    :param unlock: Image paths or gesture types of the unlocking combination (in order)
+
+    :param lock: Optional image paths or gesture types of the locking combination (in order)
+
+    :param name: S3 name of the face image. Defaults to the profile name
+
+    :param maintain: If True, the gesture recognition project is left running afterwards
+
+    :return: SUCCESS Response, raising a ResponseError otherwise
+    """
+    # Verify we have a face to create
+    if face is None:
+        return commons.respond(
+            messageType="ERROR",
+            message="-f was not given. Please provide a face to be used in recognition for your account.",
+            code=13
+        )
+    else:
+        if images.isLocalImage(face):
+            try:
+                face = images.verifyImage(face)
+            except IOError:
                 return commons.respond(
                     messageType="ERROR",
-                    message=f"Could not find file {argDict.face}",
-                    code=8
+                    message=f"File {face} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid",
+                    code=7
                 )
-        # Verify we have a unlock gesture combination
-        if argDict.unlock is None:
-            return commons.respond(
-                messageType="ERROR",
-                message="-l or -u was not given. Please provide a unlocking (-u) gesture combination so your user account can be created.",
-                code=13
-            )
-        # Verify we have a username to upload the object to
-        if argDict.profile is None:
+        else:
             return commons.respond(
                 messageType="ERROR",
-                message="-p was not given. Please provide a profile username for your account.",
-                code=13
+                message=f"Could not find file {face}",
+                code=8
             )
+    # Verify we have a unlock gesture combination
+    if unlock is None:
+        return commons.respond(
+            messageType="ERROR",
+            message="-l or -u was not given. Please provide a unlocking (-u) gesture combination so your user account can be created.",
+            code=13
+        )
+    # Verify we have a username to upload the object to
+    if profile is None:
+        return commons.respond(
+            messageType="ERROR",
+            message="-p was not given. Please provide a profile username for your account.",
+            code=13
+        )
+    # Verify the profile is not taken, as a failed create removes everything it wrote under the profile
+    existing = s3Client.list_objects_v2(
+        Bucket=os.getenv("FACE_RECOG_BUCKET"),
+        Prefix=f"users/{profile}/",
+        MaxKeys=1
+    )
+    if existing["KeyCount"] > 0:
+        return commons.respond(
+            messageType="ERROR",
+            message=f"User {profile} already exists. Use -a edit to change it, or -a delete to remove it first.",
+            code=29
+        )
+
+    # Images are uploaded in the background as soon as they are verified, the config file is only uploaded once everything else has succeeded
+    uploads = PendingUploads(profile)
+    indexedImageId = None
+    try:
+        # Upload face while it is indexed and the gestures are identified
+        if name is not None:
+            uploads.add(face, None, name)
+        else:
+            uploads.add(face, None, f"{profile}.jpg")
 
         # uploadedImage will the objectName so no need to check if there is a user in this function
-        if (argDict.name is not None):
-            index_photo.add_face_to_collection(argDict.face, argDict.name)
+        indexedImageId = commons.parseImageObject(name if name is not None else profile)
+        uploads.track(index_photo.faceDetailsKey(profile))
+        if (name is not None):
+            index_photo.add_face_to_collection(face, name, profile)
         else:
-            index_photo.add_face_to_collection(argDict.face, argDict.profile)
+            index_photo.add_face_to_collection(face, profile, profile)
+        if local_faces.enabled():
+            local_faces.enrolFace(profile, face)
 
         # First, start the rekog project so we can actually analyse the given images
-        gesture_recog.projectHandler(True)
+        modelHolder = gesture_recog.acquireModel()
 
         try:
-            # Now iterate over lock and unlock image files, processing one a time while constructing our gestures.json
+            # Now iterate over lock and unlock image files while constructing our gestures.json, uploading each image once its gesture is known
             lockGestureConfig = {}
-            if argDict.lock is not None:
-                lockGestureConfig = constructGestureFramework(argDict.lock, argDict.profile, "lock")
-                unlockGestureConfig = constructGestureFramework(argDict.unlock, argDict.profile, "unlock", lockGestureConfig)
+            if lock is not None:
+                lockGestureConfig = constructGestureFramework(lock, profile, "lock", uploads=uploads)
+                unlockGestureConfig = constructGestureFramework(unlock, profile, "unlock", lockGestureConfig, uploads)
             else:
-                unlockGestureConfig = constructGestureFramework(argDict.unlock, argDict.profile, "unlock")
+                unlockGestureConfig = constructGestureFramework(unlock, profile, "unlock", uploads=uploads)
             gestureConfig = {"lock": lockGestureConfig, "unlock": unlockGestureConfig}
+        finally:
+            # Close down the rekog project if specified (and nobody else is using it)
+            gesture_recog.releaseModel(modelHolder, maintain)
 
-            # Finally, upload all the files featured in these processes (including the gesture config file)
-            print("[INFO] All tests passed and profiles constructed. Uploading all files to database...")
+        # Finally, wait for all the files featured in these processes and then upload the gesture config file
+        print("[INFO] All tests passed and profiles constructed. Waiting for all files to finish uploading to database...")
+        uploads.wait()
 
-            # Upload face
+        try:
+            gestureConfigStr = json.dumps(gestureConfig, indent=2).encode("utf-8")
+            uploadedConfig = s3Client.put_object(
+                Body=gestureConfigStr,
+                Bucket=os.getenv("FACE_RECOG_BUCKET"),
+                Key=f"users/{profile}/gestures/GestureConfig.json"
+            )
+            gesture_recog.cacheUserCombinationFile(profile, gestureConfig, uploadedConfig["ETag"])
+        except Exception as e:
+            gesture_recog.invalidateUserCombinationFile(profile)
+            return commons.respond(
+                messageType="ERROR",
+                message="Failed to upload the gesture configuration file. Everything created for the user has been removed again, try remaking it.",
+                content={"ERROR": str(e)},
+                code=3
+            )
+    except BaseException:
+        # Don't leave the images, face details, collection face (or local face) of a half created profile behind
+        uploads.rollback()
+        index_photo.forgetFaceDetails(profile)
+        if indexedImageId is not None:
             try:
-                if argDict.name is not None:
-                    upload_file(argDict.face, argDict.profile, None, argDict.name)
-                else:
-                    upload_file(argDict.face, argDict.profile, None, f"{argDict.profile}.jpg")
-            except FileNotFoundError:
-                return commons.respond(
-                    messageType="ERROR",
-                    message=f"No such file {argDict.face}",
-                    code=8
-                )
+                index_photo.remove_face_from_collection(indexedImageId)
+            except Exception as e:
+                print(f"[WARNING] Failed to remove {indexedImageId} from {os.getenv('FACE_RECOG_COLLECTION')}: {e}")
+        if local_faces.enabled():
+            local_faces.forgetFace(profile)
+        raise
 
-            # Upload gestures, adjusting the path of the config file to be s3 relative
-            for locktype in gestureConfig.keys():
-                if gestureConfig[locktype] != {}:
-                    for position, details in gestureConfig[locktype].items():
-                        try:
-                            gestureObjectPath = upload_file(details["path"], argDict.profile, locktype, f"{locktype.capitalize()}Gesture{position}")
-                        except FileNotFoundError:
-                            return commons.respond(
-                                messageType="ERROR",
-                                message=f"Could no longer find file {details['path']}",
-                                code=8
-                            )
-                        gestureConfig[locktype][position]["path"] = gestureObjectPath
+    print("[SUCCESS] Config file uploaded!")
+    return commons.respond(
+        messageType="SUCCESS",
+        message="Facial recognition and gesture recognition images and configs files have been successfully uploaded!",
+        code=0
+    )
 
-            try:
-                gestureConfigStr = json.dumps(gestureConfig, indent=2).encode("utf-8")
-                s3Client.put_object(
-                    Body=gestureConfigStr,
-                    Bucket=os.getenv("FACE_RECOG_BUCKET"),
-                    Key=f"users/{argDict.profile}/gestures/GestureConfig.json"
-                )
-            except Exception as e:
-                return commons.respond(
-                    messageType="ERROR",
-                    message="Failed to upload the gesture configuration file. Gesture and face images have already been uploaded. Recommend you delete your user account with -a delete and try remaking it.",
-                    content={"ERROR": str(e)},
-                    code=3
-                )
 
-            print("[SUCCESS] Config file uploaded!")
-            return commons.respond(
-                messageType="SUCCESS",
-                message="Facial recognition and gesture recognition images and configs files have been successfully uploaded!",
-                code=0
-            )
+def edit_user(profile, face=None, lock=None, unlock=None, name=None, maintain=False):
+    """edit_user() : Replaces an existing user's face and/or gesture combinations
 
-        finally:
-            # Finally, close down the rekog project if specified
-            if argDict.maintain is False:
-                gesture_recog.projectHandler(False)
+    :param profile: Username of the account to edit
 
-    elif argDict.action == "edit":
-        # Verify we have a user to edit
-        if argDict.profile is None:
+    :param face: Optional path to the replacement face image
+
+    :param lock: Optional replacement locking combination. ["DELETE"] removes the locking combination
+
+    :param unlock: Optional replacement unlocking combination
+
+    :param name: Collection name of the replacement face image
+
+    :param maintain: If True, the gesture recognition project is left running afterwards
+
+    :return: SUCCESS Response, raising a ResponseError otherwise
+    """
+    # Verify we have a user to edit
+    if profile is None:
+        return commons.respond(
+            messageType="ERROR",
+            message="-p was not given. Please provide a profile username for your account.",
+            code=13
+        )
+    else:
+        try:
+            s3Client.get_object_acl(
+                Bucket=os.getenv("FACE_RECOG_BUCKET"),
+                Key=f"users/{profile}/{profile}.jpg"
+            )
+        except s3Client.exceptions.NoSuchKey:
             return commons.respond(
                 messageType="ERROR",
-                message="-p was not given. Please provide a profile username for your account.",
-                code=13
+                message=f"User {profile} does not exist or failed to find face file",
+                code=9
             )
-        else:
+    if face is None and lock is None and unlock is None:
+        # Verify at least one editable feature was given
+        return commons.respond(
+            messageType="ERROR",
+            message="Neither -f, -u or -l was given. Please provide a profile feature to edit.",
+            code=13
+        )
+
+    if face is not None:
+        # Check that face file exists now as it will try to delete from collection without verify otherwise
+        if images.isLocalImage(face):
             try:
-                s3Client.get_object_acl(
-                    Bucket=os.getenv("FACE_RECOG_BUCKET"),
-                    Key=f"users/{argDict.profile}/{argDict.profile}.jpg"
-                )
-            except s3Client.exceptions.NoSuchKey:
+                face = images.verifyImage(face)
+            except IOError:
                 return commons.respond(
                     messageType="ERROR",
-                    message=f"User {argDict.profile} does not exist or failed to find face file",
-                    code=9
+                    message=f"File {face} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid",
+                    code=7
                 )
-        if argDict.face is None and argDict.lock is None and argDict.unlock is None:
-            # Verify at least one editable feature was given
+        else:
             return commons.respond(
                 messageType="ERROR",
-                message="Neither -f, -u or -l was given. Please provide a profile feature to edit.",
-                code=13
+                message=f"Could not find file {face}",
+                code=8
             )
 
-        if argDict.face is not None:
-            # Check that face file exists now as it will try to delete from collection without verify otherwise
-            if os.path.isfile(argDict.face):
-                try:
-                    Image.open(argDict.face)
-                except IOError:
-                    return commons.respond(
-                        messageType="ERROR",
-                        message=f"File {argDict.face} exists but is not an image. Only jpg and png files are valid",
-                        code=7
-                    )
+        # Delete old user image from collection
+        print(f"[INFO] Removing old face from {os.getenv('FACE_RECOG_COLLECTION')} for user {profile}")
+        deletedFace = index_photo.remove_face_from_collection(f"{profile}.jpg")
+        if deletedFace is None:
+            # This can sometimes happen if deletion was attempted before but was not completed
+            print(f"[WARNING] No face found in {os.getenv('FACE_RECOG_COLLECTION')} for user {profile}. We will assume it has already been removed.")
+        index_photo.add_face_to_collection(face, name, profile)
+        if local_faces.enabled():
+            local_faces.enrolFace(profile, face)
+
+        # Replace user face in S3
+        try:
+            upload_file(face, profile, None, f"{profile}.jpg")
+        except FileNotFoundError:
+            return commons.respond(
+                messageType="ERROR",
+                message=f"No such file {face}",
+                code=8
+            )
+        print(f"[SUCCESS] {face} has successfully replaced user {profile} face!")
+
+    # Encase within two conditionals to avoid pointless running of gesture project
+    if lock is not None or unlock is not None:
+        # Start gesture project to allow for gesture recognition
+        modelHolder = gesture_recog.acquireModel()
+        try:
+            if lock is not None and unlock is not None:
+                # We are editing both combinations so run rules and construction sequentially
+                adjustedLock = adjustConfigFramework(lock, profile, "lock")
+                print(f"[SUCCESS] Lock gesture combination has been successfully replaced for user {profile}")
+                adjustConfigFramework(unlock, profile, "unlock", adjustedLock["lock"])
+                print(f"[SUCCESS] Unlock gesture combination has been successfully replaced for user {profile}")
             else:
-                return commons.respond(
-                    messageType="ERROR",
-                    message=f"Could not find file {argDict.face}",
-                    code=8
-                )
+                # Get user config to compare edited rules against
+                currentConfig = gesture_recog.getUserCombinationFile(profile)
+                if lock is not None:
+                    adjustConfigFramework(lock, profile, "lock", currentConfig["unlock"])
+                    print(f"[SUCCESS] Lock gesture combination has been successfully replaced for user {profile}")
+                else:
+                    adjustConfigFramework(unlock, profile, "unlock", currentConfig["lock"])
+                    print(f"[SUCCESS] Unlock gesture combination has been successfully replaced for user {profile}")
 
-            # Delete old user image from collection
-            print(f"[INFO] Removing old face from {os.getenv('FACE_RECOG_COLLECTION')} for user {argDict.profile}")
-            deletedFace = index_photo.remove_face_from_collection(f"{argDict.profile}.jpg")
-            if deletedFace is None:
-                # This can sometimes happen if deletion was attempted before but was not completed
-                print(f"[WARNING] No face found in {os.getenv('FACE_RECOG_COLLECTION')} for user {argDict.profile}. We will assume it has already been removed.")
-            index_photo.add_face_to_collection(argDict.face, argDict.name)
+        finally:
+            gesture_recog.releaseModel(modelHolder, maintain)
 
-            # Replace user face in S3
-            try:
-                upload_file(argDict.face, argDict.profile, None, f"{argDict.profile}.jpg")
-            except FileNotFoundError:
+    return commons.respond(
+        messageType="SUCCESS",
+        message="All done!",
+        code=0
+    )
+
+
+def delete_user(profile):
+    """delete_user() : Ensures the user account exists, then deletes its data from both the collection and S3
+
+    :param profile: Username of the account to delete
+
+    :return: SUCCESS Response containing the deleted face details, raising a ResponseError otherwise
+    """
+    # Verify we have a username to delete
+    if profile is None or profile == "":
+        return commons.respond(
+            messageType="ERROR",
+            message="-p was not specified. Please pass in a user account name to delete.",
+            code=13
+        )
+
+    # Remove relevant face from rekog collection
+    print(f"[INFO] Removing face from {os.getenv('FACE_RECOG_COLLECTION')} for user {profile}")
+    deletedFace = index_photo.remove_face_from_collection(f"{profile}.jpg")
+    if deletedFace is None:
+        # This can sometimes happen if deletion was attempted before but was not completed
+        print(f"[WARNING] No face found in {os.getenv('FACE_RECOG_COLLECTION')} for user {profile}. We will assume it has already been removed.")
+    if local_faces.enabled():
+        local_faces.forgetFace(profile)
+
+    # Delete the whole user folder (face, face details, gestures and gesture config). The trailing slash keeps other users sharing the name as a prefix safe
+    print(f"[INFO] Deleting user folder for {profile} from s3...")
+    deletedObjects = delete_prefix(f"users/{profile}/")
+    index_photo.forgetFaceDetails(profile)
+    gesture_recog.invalidateUserCombinationFile(profile)
+    if deletedObjects == []:
+        return commons.respond(
+            messageType="ERROR",
+            message="No such user profile exists",
+            code=9
+        )
+
+    return commons.respond(
+        messageType="SUCCESS",
+        message=f"User profile for {profile} ({len(deletedObjects)} objects) was successfully removed from S3 and respective face reference removed from the Rekognition Collection.",
+        content=deletedFace,
+        code=0
+    )
+
+
+def delete_users(profiles):
+    """delete_users() : Deletes several user accounts in one go (see delete_user()), DELETE_WORKERS at a time
+
+    :param profiles: Usernames of the accounts to delete
+
+    :return: SUCCESS Response summarising which profiles were DELETED and which did not exist (MISSING), raising a ResponseError if any FAILED
+    """
+    def deleteProfile(profile):
+        try:
+            return profile, commons.invoke(delete_user, profile)
+        except (ClientError, EndpointConnectionError) as e:
+            # One profile failing should not stop the rest from being deleted
+            return profile, commons.Response("ERROR", 1, str(e))
+
+    summary = {"DELETED": [], "MISSING": [], "FAILED": {}}
+    with ThreadPoolExecutor(max_workers=min(DELETE_WORKERS, len(profiles)), thread_name_prefix="profile") as pool:
+        for profile, response in pool.map(tracing.wrap(deleteProfile), profiles):
+            if response.code == 0:
+                summary["DELETED"].append(profile)
+            elif response.code == 9:
+                summary["MISSING"].append(profile)
+            else:
+                summary["FAILED"][profile] = {"MESSAGE": response.message, "CODE": response.code}
+
+    if summary["FAILED"] != {}:
+        return commons.respond(
+            messageType="ERROR",
+            message=f"FAILED to delete {len(summary['FAILED'])} of {len(profiles)} user profiles",
+            content=summary,
+            code=4
+        )
+    if summary["DELETED"] == []:
+        return commons.respond(
+            messageType="ERROR",
+            message="None of the user profiles exist",
+            content=summary,
+            code=9
+        )
+    return commons.respond(
+        messageType="SUCCESS",
+        message=f"{len(summary['DELETED'])} of {len(profiles)} user profiles were successfully removed from S3 and the Rekognition Collection",
+        content=summary,
+        code=0
+    )
+
+
+def compare_face(profile, face):
+    """compare_face() : Compares a face image against the stored face of a user. Without a profile, the user is first identified by the local face index (if FACE_ENGINE uses it)
+
+    :param profile: Username whose stored face is compared against. If None, the closest user in the local face index is compared against
+
+    :param face: Path to the face image to compare
+
+    :return: SUCCESS Response if the faces match, raising a ResponseError otherwise
+    """
+    # Verify params
+    if (profile is None or profile == "") and not local_faces.enabled():
+        return commons.respond(
+            messageType="ERROR",
+            message="-p was not specified. Please pass in a user account name, or set FACE_ENGINE to identify the user with the local face index",
+            code=13
+        )
+
+    if images.isLocalImage(face):
+        try:
+            face = images.verifyImage(face)
+        except IOError:
+            return commons.respond(
+                messageType="ERROR",
+                message=f"File {face} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid",
+                code=7
+            )
+    else:
+        return commons.respond(
+            messageType="ERROR",
+            message=f"Could not find file {face}",
+            code=8
+        )
+
+    # Check the local face index first, which can reject (or with FACE_ENGINE=local, decide) without calling rekognition
+    if local_faces.enabled():
+        if profile is None or profile == "":
+            # Find whose face it is (1:N), then carry on as if they had been given
+            identified = local_faces.identifyFace(face)
+            if identified is None:
                 return commons.respond(
                     messageType="ERROR",
-                    message=f"No such file {argDict.face}",
-                    code=8
+                    message=f"Input face {face} does not match any user in the local face index",
+                    code=10
                 )
-            print(f"[SUCCESS] {argDict.face} has successfully replaced user {argDict.profile} face!")
-
-        # Encase within two conditionals to avoid pointless running of gesture project
-        if argDict.lock is not None or argDict.unlock is not None:
-            try:
-                # Start gesture project to allow for gesture recognition
-                gesture_recog.projectHandler(True)
-
-                if argDict.lock is not None and argDict.unlock is not None:
-                    # We are editing both combinations so run rules and construction sequentially
-                    adjustedLock = adjustConfigFramework(argDict.lock, argDict.profile, "lock")
-                    print(f"[SUCCESS] Lock gesture combination has been successfully replaced for user {argDict.profile}")
-                    adjustConfigFramework(argDict.unlock, argDict.profile, "unlock", adjustedLock["lock"])
-                    print(f"[SUCCESS] Unlock gesture combination has been successfully replaced for user {argDict.profile}")
-                else:
-                    # Get user config to compare edited rules against
-                    currentConfig = gesture_recog.getUserCombinationFile(argDict.profile)
-                    if argDict.lock is not None:
-                        adjustConfigFramework(argDict.lock, argDict.profile, "lock", currentConfig["unlock"])
-                        print(f"[SUCCESS] Lock gesture combination has been successfully replaced for user {argDict.profile}")
-                    else:
-                        adjustConfigFramework(argDict.unlock, argDict.profile, "unlock", currentConfig["lock"])
-                        print(f"[SUCCESS] Unlock gesture combination has been successfully replaced for user {argDict.profile}")
-
-            finally:
-                if argDict.maintain is False:
-                    gesture_recog.projectHandler(False)
+            profile = identified["USERNAME"]
+            print(f"[INFO] Input face {face} was identified as {profile} by the local face index")
+            localMatch = {"MATCH": True, "DISTANCE": identified["DISTANCE"]}
+        else:
+            localMatch = local_faces.verifyFace(face, profile)
+        if localMatch is None:
+            print(f"[WARNING] Input face {face} could not be compared with {profile} by the local face index, comparing with rekognition instead")
+        elif localMatch["MATCH"] is False:
+            return commons.respond(
+                messageType="ERROR",
+                message=f"Input face {face} does not match stored user's {profile} face",
+                content={"DISTANCE": localMatch["DISTANCE"]},
+                code=10
+            )
+        elif local_faces.FACE_ENGINE == "local":
+            return commons.respond(
+                messageType="SUCCESS",
+                message=f"Input face {face} matched successfully with stored user's {profile} face",
+                content={"USERNAME": profile, "DISTANCE": localMatch["DISTANCE"]},
+                code=0
+            )
 
-        return commons.respond(
-            messageType="SUCCESS",
-            message="All done!",
-            code=0
+    # Run face comparison
+    print(f"[INFO] Running facial comparison library to compare {face} against the stored face for {profile}")
+    faceCompare = compare_faces.compareFaces(face, profile)
+    if faceCompare["FaceMatches"] is not [] and len(faceCompare["FaceMatches"]) == 1:
+
+        # Get source landmarks
+        sourceFaceDetails = results.cachedCall(
+            "detect_faces",
+            face,
+            {"MaxBytes": images.MAX_IMAGE_BYTES, "MaxDimension": images.MAX_IMAGE_DIMENSION},
+            lambda: rekogClient.detect_faces(Image={"Bytes": images.fitImage(face)})["FaceDetails"],
+            LOGIN_RESULT_CACHE
         )
 
-    # Ensure the user account to be edited or deleted exists. Then, delete the data from both the collection and S3
-    elif argDict.action == "delete":
+        # Check if face is a presentation attack by checking details are close enough
+        sourceLandmarks = sourceFaceDetails[0]["Landmarks"]
+        targetLandmarks = index_photo.getFaceDetails(profile)["Landmarks"]
 
-        # Verify we have a username to delete
-        if argDict.profile is None or "":
+        if compare_faces.checkPresentationAttack(sourceLandmarks, targetLandmarks, profile) is False:
+            return commons.respond(
+                messageType="SUCCESS",
+                message=f"Input face {face} matched successfully with stored user's {profile} face",
+                code=0
+            )
+        else:
             return commons.respond(
                 messageType="ERROR",
-                message="-p was not specified. Please pass in a user account name to delete.",
-                code=13
+                message=f"Input face {face} does not match stored user's {profile} face, try adjusting your camera's viewpoint so it more closely matches your profile's stored face",
+                code=10
             )
 
-        # Remove relevant face from rekog collection
-        print(f"[INFO] Removing face from {os.getenv('FACE_RECOG_COLLECTION')} for user {argDict.profile}")
-        deletedFace = index_photo.remove_face_from_collection(f"{argDict.profile}.jpg")
-        if deletedFace is None:
-            # This can sometimes happen if deletion was attempted before but was not completed
-            print(f"[WARNING] No face found in {os.getenv('FACE_RECOG_COLLECTION')} for user {argDict.profile}. We will assume it has already been removed.")
+    else:
+        return commons.respond(
+            messageType="ERROR",
+            message=f"Input face {face} does not match stored user's {profile} face",
+            code=10
+        )
+
+
+def find_face(profile=None, timeout=None):
+    """find_face() : Runs face comparison on the live stream until a known face is found or the timeout expires
+
+    :param profile: Optional username the captured face must belong to
+
+    :param timeout: Seconds to search the stream for. Defaults to TIMEOUT_SECONDS
+
+    :return: SUCCESS Response containing the matched face, raising a ResponseError otherwise
+    """
+    timeoutSeconds = TIMEOUT_SECONDS
+    if timeout is not None:
+        timeoutSeconds = timeout
+
+    if profile is None:
+        print(f"[INFO] Running facial comparison library to check for any known faces in current stream (timing out after {timeoutSeconds}s)...")
+    else:
+        print(f"[INFO] Running facial comparison library to check for {profile} stored face in current stream (timing out after {timeoutSeconds}s)...")
+
+    # Signal alarms can only be set from the main thread, worker threads (e.g. daemon.py) rely on the deadline instead
+    useAlarm = threading.current_thread() is threading.main_thread()
 
-        # Check the user's folder actually exists in s3
-        print(f"[INFO] Deleting user folder for {argDict.profile} from s3...")
-        s3FilePath = f"users/{argDict.profile}/{argDict.profile}.jpg"
+    # Start/end stream
+    with streamLock:
+        streamHandler(True, 3)
+
+        # Start comparing, timing out if no face is found within the limit
         try:
-            s3Client.get_object_acl(
-                Bucket=os.getenv('FACE_RECOG_BUCKET'),
-                Key=s3FilePath
+            if useAlarm:
+                signal.signal(signal.SIGALRM, timeoutHandler)
+                signal.alarm(timeoutSeconds)
+            matchedFace = compare_faces.checkForFaces(time.time() + timeoutSeconds)
+
+            # If a profile has been specified, check if the face belongs to that user
+            if profile is not None:
+                if profile not in matchedFace['Face']['ExternalImageId']:
+                    return commons.respond(
+                        messageType="ERROR",
+                        message=f"Captured face in stream does not match the stored face for {profile}",
+                        content=matchedFace,
+                        code=27
+                    )
+
+            # By this point, we have found a face so cancel the timeout and return the matched face
+            if useAlarm:
+                signal.alarm(0)
+            return commons.respond(
+                messageType="SUCCESS",
+                message="Found a matching face!",
+                content=matchedFace,
+                code=0
             )
-        except s3Client.exceptions.NoSuchKey:
+        except TimeoutError:
             return commons.respond(
                 messageType="ERROR",
-                message="No such user profile exists",
-                code=9
+                message=f"TIMEOUT FIRED AFTER {timeoutSeconds}s, NO FACES WERE FOUND IN THE STREAM!",
+                code=10
             )
+        finally:
+            # Reset signal handler everytime
+            if useAlarm:
+                signal.alarm(0)
+                signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            streamHandler(False)
+
+
+def verify_gestures(profile, lock=None, unlock=None, maintain=False):
+    """verify_gestures() : Runs gesture recognition against the given images and checks they match a user's combination
+
+    :param profile: Username whose combination is checked
 
-        # Delete user folder
-        delete_file(s3FilePath)
+    :param lock: Image paths of an attempt at the locking combination (in order)
 
+    :param unlock: Image paths of an attempt at the unlocking combination (in order)
+
+    :param maintain: If True, the gesture recognition project is left running afterwards
+
+    :return: SUCCESS Response if the combination matched, raising a ResponseError otherwise
+    """
+    if profile is None:
         return commons.respond(
-            messageType="SUCCESS",
-            message=f"User profile for {argDict.profile} was successfully removed from S3 and respective face reference removed from the Rekognition Collection.",
-            content=deletedFace,
-            code=0
+            messageType="ERROR",
+            message="-p was not given. Please pass a user profile to conduct gesture recognition against",
+            code=13
         )
 
-    # Run face comparison on stream
-    elif argDict.action == "compare":
-        if argDict.face is not None:
-            # Verify params
-            if argDict.profile is None or "":
-                return commons.respond(
-                    messageType="ERROR",
-                    message="-p was not specified. Please pass in a user account name",
-                    code=13
-                )
+    # We can't try to unlock AND lock the system at the same time
+    if lock is not None and unlock is not None:
+        return commons.respond(
+            messageType="ERROR",
+            message="Cannot lock (-l) and unlock (-u) at the same time.",
+            code=13
+        )
+    # Likewise, we cannot try to find a gesture if we don't know which locktype to authenticate with
+    elif lock is None and unlock is None:
+        return commons.respond(
+            messageType="ERROR",
+            message="Neither Lock (-l) or Unlock (-u) indicator was given.",
+            code=13
+        )
+    # Otherwise, figure out if we are locking or unlocking
+    else:
+        if lock is not None:
+            locktype = "lock"
+            imagePaths = lock
+        else:
+            locktype = "unlock"
+            imagePaths = unlock
+
+    # Start rekognition model
+    modelHolder = gesture_recog.acquireModel()
+    try:
+        # Get user's combination length to identify when we have filled the combination
+        userComboLength = int(max(gesture_recog.getUserCombinationFile(profile)[locktype]))
 
-            if os.path.isfile(argDict.face):
+        # No lock file for this user
+        if userComboLength == 0 and locktype == "lock":
+            return commons.respond(
+                messageType="SUCCESS",
+                message=f"No lock combination for {profile}, skipping authentication",
+                code=0
+            )
+
+        print(f"[INFO] Running gesture recognition library to check for the correct {locktype}ing gestures performed in the given images...")
+
+        def findGesture(position, path):
+            # Verify file exists
+            if images.isLocalImage(path):
                 try:
-                    Image.open(argDict.face)
+                    path = images.verifyImage(path)
                 except IOError:
                     return commons.respond(
                         messageType="ERROR",
-                        message=f"File {argDict.face} exists but is not an image. Only jpg and png files are valid",
+                        message=f"File {path} exists but is not an image. Only {images.SUPPORTED_FORMATS} files are valid.",
                         code=7
                     )
             else:
                 return commons.respond(
                     messageType="ERROR",
-                    message=f"Could not find file {argDict.face}",
+                    message=f"File does not exist at {path}",
                     code=8
                 )
 
-            # Run face comparison
-            print(f"[INFO] Running facial comparison library to compare {argDict.face} against the stored face for {argDict.profile}")
-            faceCompare = compare_faces.compareFaces(argDict.face, argDict.profile)
-            if faceCompare["FaceMatches"] is not [] and len(faceCompare["FaceMatches"]) == 1:
-
-                # Get source landmarks
-                with open(argDict.face, "rb") as fileBytes:
-                    sourceFaceAttr = rekogClient.detect_faces(Image={"Bytes": fileBytes.read()})
-
-                # Check if face is a presentation attack by checking details are close enough
-                sourceLandmarks = sourceFaceAttr["FaceDetails"][0]["Landmarks"]
-                targetLandmarks = rekogClient.detect_faces(
-                    Image={'S3Object': {
-                        'Bucket': os.getenv('FACE_RECOG_BUCKET'),
-                        'Name': f"users/{argDict.profile}/{argDict.profile}.jpg"
-                    }}
-                )["FaceDetails"][0]["Landmarks"]
-
-                if compare_faces.checkPresentationAttack(sourceLandmarks, targetLandmarks, argDict.profile) is False:
-                    return commons.respond(
-                        messageType="SUCCESS",
-                        message=f"Input face {argDict.face} matched successfully with stored user's {argDict.profile} face",
-                        code=0
-                    )
-                else:
+            # Run gesture recog lib (oversized images are fitted to the AWS limits before they are sent)
+            return gesture_recog.checkForGestures(path, cache=LOGIN_RESULT_CACHE)
+
+        # Detect every gesture concurrently, then walk the results in combination order
+        foundGestures = gesture_recog.detectGestures(imagePaths, findGesture)
+
+        matchedGestures = 1
+        for path, foundGesture in zip(imagePaths, foundGestures):
+            if foundGesture is not None:
+                print(f"[INFO] Checking if the {locktype} combination contains the same gesture at position {matchedGestures}...")
+                try:
+                    hasGesture = gesture_recog.inUserCombination(foundGesture, profile, locktype, str(matchedGestures))
+                except RateLimitException:
                     return commons.respond(
                         messageType="ERROR",
-                        message=f"Input face {argDict.face} does not match stored user's {argDict.profile} face, try adjusting your camera's viewpoint so it more closely matches your profile's stored face",
-                        code=10
+                        message="Too many user requests in too short a time. Please try again later",
+                        code=26
                     )
 
+                # User has same gesture and in right position, don't dump log as malicious users could figure out which gestures are correct
+                if hasGesture is True:
+                    matchedGestures += 1
+                    continue
             else:
                 return commons.respond(
                     messageType="ERROR",
-                    message=f"Input face {argDict.face} does not match stored user's {argDict.profile} face",
-                    code=10
-                )
-        else:
-            if argDict.timeout is not None:
-                TIMEOUT_SECONDS = argDict.timeout
-
-            if argDict.profile is None:
-                print(f"[INFO] Running facial comparison library to check for any known faces in current stream (timing out after {TIMEOUT_SECONDS}s)...")
-            else:
-                print(f"[INFO] Running facial comparison library to check for {argDict.profile} stored face in current stream (timing out after {TIMEOUT_SECONDS}s)...")
-
-            # Start/end stream
-            streamHandler(True, 3)
-
-            # Start comparing, timing out if no face is found within the limit
-            try:
-                signal.signal(signal.SIGALRM, timeoutHandler)
-                signal.alarm(TIMEOUT_SECONDS)
-                matchedFace = compare_faces.checkForFaces()
-
-                # If a profile has been specified, check if the face belongs to that user
-                if argDict.profile is not None:
-                    if argDict.profile not in matchedFace['Face']['ExternalImageId']:
-                        return commons.respond(
-                            messageType="ERROR",
-                            message=f"Captured face in stream does not match the stored face for {argDict.profile}",
-                            content=matchedFace,
-                            code=27
-                        )
-
-                # By this point, we have found a face so cancel the timeout and return the matched face
-                signal.alarm(0)
-                return commons.respond(
-                    messageType="SUCCESS",
-                    message="Found a matching face!",
-                    content=matchedFace,
-                    code=0
-                )
-            except TimeoutError:
-                signal.signal(signal.SIGALRM, signal.SIG_DFL)
-                return commons.respond(
-                    messageType="ERROR",
-                    message=f"TIMEOUT FIRED AFTER {TIMEOUT_SECONDS}s, NO FACES WERE FOUND IN THE STREAM!",
-                    code=10
+                    message=f"No gesture was found in image {path}",
+                    code=17
                 )
-            finally:
-                # Reset signal handler everytime
-                signal.signal(signal.SIGALRM, signal.SIG_DFL)
-                streamHandler(False)
-
-    # Run gesture recognition against given images
-    elif argDict.action == "gesture":
-        if argDict.profile is None:
-            return commons.respond(
-                messageType="ERROR",
-                message="-p was not given. Please pass a user profile to conduct gesture recognition against",
-                code=13
-            )
 
-        # We can't try to unlock AND lock the system at the same time
-        if argDict.lock is not None and argDict.unlock is not None:
+        if matchedGestures - 1 == userComboLength:
             return commons.respond(
-                messageType="ERROR",
-                message="Cannot lock (-l) and unlock (-u) at the same time.",
-                code=13
+                messageType="SUCCESS",
+                message=f"Matched {locktype} gesture combination for user {profile}",
+                code=0
             )
-        # Likewise, we cannot try to find a gesture if we don't know which locktype to authenticate with
-        elif argDict.lock is None and argDict.unlock is None:
+        else:
+            # Include this check just in case something goes wrong with the timeout handler
             return commons.respond(
                 messageType="ERROR",
-                message="Neither Lock (-l) or Unlock (-u) indicator was given.",
-                code=13
+                message="Incorrect gesture combination was given",
+                code=18
             )
-        # Otherwise, figure out if we are locking or unlocking
-        else:
-            if argDict.lock is not None:
-                locktype = "lock"
-                imagePaths = argDict.lock
-            else:
-                locktype = "unlock"
-                imagePaths = argDict.unlock
 
-        try:
-            # Start rekognition model
-            gesture_recog.projectHandler(True)
+    finally:
+        gesture_recog.releaseModel(modelHolder, maintain)
 
-            # Get user's combination length to identify when we have filled the combination
-            userComboLength = int(max(gesture_recog.getUserCombinationFile(argDict.profile)[locktype]))
 
-            # No lock file for this user
-            if userComboLength == 0 and locktype == "lock":
-                return commons.respond(
-                    messageType="SUCCESS",
-                    message=f"No lock combination for {argDict.profile}, skipping authentication",
-                    code=0
-                )
+#########
+# START #
+#########
+def main(parsedArgs=None, stdin=None):
+    """main() : Main method that parses the input opts and returns the result
 
-            print(f"[INFO] Running gesture recognition library to check for the correct {locktype}ing gestures performed in the given images...")
-
-            matchedGestures = 1
-            for path in imagePaths:
-                # Verify file exists
-                if os.path.isfile(path):
-                    try:
-                        Image.open(path)
-                    except IOError:
-                        return commons.respond(
-                            messageType="ERROR",
-                            message=f"File {path} exists but is not an image. Only jpg and png files are valid.",
-                            code=7
-                        )
-                else:
-                    return commons.respond(
-                        messageType="ERROR",
-                        message=f"File does not exist at {path}",
-                        code=8
-                    )
+    :param parsedArgs: Arguments produced by parseArgs(). If not given, the command line arguments are parsed
 
-                # Run gesture recog lib
-                try:
-                    foundGesture = gesture_recog.checkForGestures(path)
-                except rekogClient.exceptions.ImageTooLargeException:
-                    print(f"[WARNING] {path} is too large (>4MB) to check for gestures directly. Uploading to S3 first and then checking for gestures...")
-
-                    # The s3 filename is going to be temporarily added and then deleted
-                    s3FilePath = f"temp/image_{str(random.randrange(1,1000000))}.jpg"
-                    try:
-                        gestureObjectPath = upload_file(path, argDict.profile, None, s3FilePath)
-                    except FileNotFoundError:
-                        return commons.respond(
-                            messageType="ERROR",
-                            message=f"Could not find file at {path}",
-                            code=8
-                        )
-                    delete_file(s3FilePath)
-                    foundGesture = gesture_recog.checkForGestures(gestureObjectPath)
-
-                if foundGesture is not None:
-                    print(f"[INFO] Checking if the {locktype} combination contains the same gesture at position {matchedGestures}...")
-                    try:
-                        hasGesture = gesture_recog.inUserCombination(foundGesture, argDict.profile, locktype, str(matchedGestures))
-                    except RateLimitException:
-                        return commons.respond(
-                            messageType="ERROR",
-                            message="Too many user requests in too short a time. Please try again later",
-                            code=26
-                        )
-
-                    # User has same gesture and in right position, don't dump log as malicious users could figure out which gestures are correct
-                    if hasGesture is True:
-                        matchedGestures += 1
-                        continue
-                else:
-                    return commons.respond(
-                        messageType="ERROR",
-                        message=f"No gesture was found in image {path}",
-                        code=17
-                    )
+    :param stdin: Binary file object that images given as "-" are read from, in order (face, then lock, then unlock)
 
-            if matchedGestures - 1 == userComboLength:
-                return commons.respond(
-                    messageType="SUCCESS",
-                    message=f"Matched {locktype} gesture combination for user {argDict.profile}",
-                    code=0
-                )
-            else:
-                # Include this check just in case something goes wrong with the timeout handler
-                return commons.respond(
-                    messageType="ERROR",
-                    message="Incorrect gesture combination was given",
-                    code=18
-                )
+    :return: Response of the requested action, whether it succeeded or not
+    """
+    # Parse input parameters
+    if parsedArgs is None:
+        # Parse with sys args if running by command line
+        argDict = parseArgs(sys.argv[1:])
+    else:
+        # Assume the args have already been parsed
+        argDict = parsedArgs
 
-        finally:
-            if argDict.maintain is False:
-                gesture_recog.projectHandler(False)
+    # Tracing is off unless asked for, in which case the timings are added to the response
+    with tracing.tracing(argDict.action, getattr(argDict, "trace", False) or None) as trace:
+        response = runAction(argDict, stdin)
+    return tracing.attach(response, trace, getattr(argDict, "trace_output", None))
+
+
+def runAction(argDict, stdin=None):
+    """runAction() : Runs the action given in the parsed arguments
+
+    :param argDict: Arguments produced by parseArgs()
+
+    :param stdin: Binary file object that images given as "-" are read from
+
+    :return: Response of the requested action, whether it succeeded or not
+    """
+    # Local images get a handle here so each one is only read once, however many times the action uses it. Images passed in memory (piped in, in shared memory or as data URIs) are read straight away
+    try:
+        stdinImages = images.loadImageSources([argDict.face] + (argDict.lock or []) + (argDict.unlock or []), stdin)
+    except ValueError as e:
+        return commons.invoke(
+            commons.respond,
+            messageType="ERROR",
+            message=str(e),
+            code=8
+        )
+    lockCount = len(argDict.lock or [])
+    argDict.face = stdinImages[0]
+    argDict.lock = stdinImages[1:1 + lockCount] if argDict.lock is not None else None
+    argDict.unlock = stdinImages[1 + lockCount:] if argDict.unlock is not None else None
+
+    # Only deletion accepts several profiles, every other action is for one user
+    profiles = argDict.profile or []
+    if isinstance(profiles, str):
+        profiles = [profiles]
+    if len(profiles) > 1 and argDict.action != "delete":
+        return commons.invoke(
+            commons.respond,
+            messageType="ERROR",
+            message=f"-a {argDict.action} only accepts one -p profile, but {len(profiles)} were given",
+            code=13
+        )
+    profile = profiles[0] if profiles != [] else None
+
+    # Create a new user profile in the rekognition collection and s3
+    if argDict.action == "create":
+        return commons.invoke(create_user, profile, argDict.face, argDict.unlock, argDict.lock, argDict.name, argDict.maintain)
+
+    elif argDict.action == "edit":
+        return commons.invoke(edit_user, profile, argDict.face, argDict.lock, argDict.unlock, argDict.name, argDict.maintain)
+
+    # Ensure the user account to be edited or deleted exists. Then, delete the data from both the collection and S3
+    elif argDict.action == "delete":
+        if len(profiles) > 1:
+            return commons.invoke(delete_users, profiles)
+        return commons.invoke(delete_user, profile)
+
+    # Run face comparison against a given face, or on the stream if there isn't one
+    elif argDict.action == "compare":
+        if argDict.face is not None:
+            return commons.invoke(compare_face, profile, argDict.face)
+        else:
+            return commons.invoke(find_face, profile, argDict.timeout)
+
+    # Run gesture recognition against given images
+    elif argDict.action == "gesture":
+        return commons.invoke(verify_gestures, profile, argDict.lock, argDict.unlock, argDict.maintain)
 
     else:
-        return commons.respond(
+        return commons.invoke(
+            commons.respond,
             messageType="ERROR",
             message=f"Invalid action type - {argDict.action}",
             code=13
@@ -974,4 +1313,6 @@ def main(parsedArgs=None):
 
 
 if __name__ == "__main__":
-    main()
+    argDict = parseArgs(sys.argv[1:])
+    commons.removeResponseFile(argDict.response)
+    commons.emit(main(argDict, sys.stdin.buffer), argDict.response)
@@ -0,0 +1,199 @@
+# -----------------------------------------------------------
+# Caches the results of rekognition calls by the content of the image they were given, so identical requests never reach the network
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import os
+import json
+import time
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import commons  # noqa: E402
+import images  # noqa: E402
+
+# Results are kept for RESULT_CACHE_TTL seconds. At most RESULT_CACHE_SIZE are kept on disk and RESULT_CACHE_MEMORY_SIZE in memory, evicting the least recently used
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 24 * 60 * 60))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 2048))
+RESULT_CACHE_MEMORY_SIZE = int(os.getenv("RESULT_CACHE_MEMORY_SIZE", 128))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(commons.CACHE_DIR, "results"))
+
+
+def resultKey(operation, imageBytes, params):
+    """resultKey() : Builds the cache key of a call from the content of its image and everything else that changes its result
+
+    :param operation: Name of the API operation (e.g. detect_faces)
+
+    :param imageBytes: Bytes or ImageHandle of the image the call is made with. Handles reuse the digest they already worked out
+
+    :param params: JSON serialisable dictionary of the other parameters (e.g. the model ARN)
+
+    :return: Hex digest identifying the call
+    """
+    digest = hashlib.sha256()
+    digest.update(operation.encode("utf-8"))
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    digest.update(images.imageHandle(imageBytes).digest.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """ResultCache : Least recently used cache of API results, kept in memory and as one JSON file per result on disk so later executions can reuse them"""
+
+    def __init__(self, path=None, ttl=None, maxEntries=None, maxMemoryEntries=None):
+        self.path = path or RESULT_CACHE_DIR
+        self.ttl = RESULT_CACHE_TTL if ttl is None else ttl
+        self.maxEntries = RESULT_CACHE_SIZE if maxEntries is None else maxEntries
+        self.maxMemoryEntries = RESULT_CACHE_MEMORY_SIZE if maxMemoryEntries is None else maxMemoryEntries
+        self.memory = OrderedDict()
+        # Number of results on disk, counted on the first store and then kept up to date so the directory is only scanned to evict
+        self.diskEntries = None
+        self.stats = {"HITS": 0, "DISK_HITS": 0, "MISSES": 0, "EVICTIONS": 0}
+        self.lock = threading.Lock()
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxMemoryEntries:
+            self.memory.popitem(last=False)
+
+    def lookup(self, key):
+        # Memory first, then disk. Hits on disk are touched so that eviction is least recently used
+        entry = self.memory.get(key)
+        if entry is not None and time.time() - entry["STORED"] < self.ttl:
+            self.memory.move_to_end(key)
+            self.stats["HITS"] += 1
+            return entry
+
+        entryPath = os.path.join(self.path, f"{key}.json")
+        try:
+            with open(entryPath, "r") as entryFile:
+                entry = json.load(entryFile)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry["STORED"] >= self.ttl:
+            return None
+        try:
+            os.utime(entryPath)
+        except FileNotFoundError:
+            pass
+        self.remember(key, entry)
+        self.stats["HITS"] += 1
+        self.stats["DISK_HITS"] += 1
+        return entry
+
+    def store(self, key, value):
+        entry = {"VALUE": value, "STORED": time.time()}
+        self.remember(key, entry)
+        entryPath = os.path.join(self.path, f"{key}.json")
+        if self.diskEntries is None:
+            self.diskEntries = len(self.scanEntries())
+        if not os.path.exists(entryPath):
+            self.diskEntries += 1
+        commons.writeJsonFile(entryPath, entry)
+        if self.diskEntries > self.maxEntries:
+            self.evict()
+
+    def scanEntries(self):
+        """scanEntries() : Lists the results stored on disk
+
+        :return: List of the last used time (in ns) and path of every stored result
+        """
+        entries = []
+        try:
+            with os.scandir(self.path) as scanned:
+                for entry in scanned:
+                    if entry.name.endswith(".json"):
+                        try:
+                            entries.append((entry.stat().st_mtime_ns, entry.path))
+                        except FileNotFoundError:
+                            continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def evict(self):
+        """evict() : Removes the least recently used results from disk until there are at most maxEntries. Other executions store results in the same directory, so the count is corrected from the scan"""
+        entries = self.scanEntries()
+        self.diskEntries = len(entries)
+        if len(entries) <= self.maxEntries:
+            return
+        entries.sort()
+        for _, entryPath in entries[:len(entries) - self.maxEntries]:
+            try:
+                os.remove(entryPath)
+                self.stats["EVICTIONS"] += 1
+            except FileNotFoundError:
+                pass
+            self.diskEntries -= 1
+
+    def get(self, key, fetch):
+        """get() : Retrieves the cached result of a call, making the call and storing its result if it is not cached
+
+        :param key: Key of the call from resultKey()
+
+        :param fetch: Function that makes the call and returns its JSON serialisable result
+
+        :return: A copy of the result
+        """
+        with self.lock:
+            entry = self.lookup(key)
+            if entry is not None:
+                return copy.deepcopy(entry["VALUE"])
+            self.stats["MISSES"] += 1
+
+        value = fetch()
+        with self.lock:
+            self.store(key, value)
+        return copy.deepcopy(value)
+
+    def clear(self):
+        """clear() : Removes every cached result from memory and disk"""
+        with self.lock:
+            self.memory.clear()
+            self.diskEntries = None
+            if os.path.isdir(self.path):
+                for entryName in os.listdir(self.path):
+                    if entryName.endswith(".json"):
+                        os.remove(os.path.join(self.path, entryName))
+
+    def getStats(self):
+        """getStats() : Reports how effective the cache has been in this process
+
+        :return: Dictionary of the HITS (and how many of them were DISK_HITS), MISSES, EVICTIONS and the HIT_RATE
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        calls = stats["HITS"] + stats["MISSES"]
+        stats["HIT_RATE"] = round(stats["HITS"] / calls, 4) if calls > 0 else None
+        return stats
+
+
+rekognitionResults = ResultCache()
+
+
+def cachedCall(operation, imageBytes, params, call, cache):
+    """cachedCall() : Makes an API call with an image, reusing its result if the exact same call was made before. Every call site has to opt in, so checks that must always ask AWS (e.g. security sensitive ones) are never cached by accident
+
+    :param operation: Name of the API operation (e.g. detect_faces)
+
+    :param imageBytes: Bytes or ImageHandle identifying the image the call is made with
+
+    :param params: JSON serialisable dictionary of the other parameters that change the result
+
+    :param call: Function that makes the call and returns its JSON serialisable result
+
+    :param cache: If True, the result is reused and stored. If False, the call is always made and its result is not stored
+
+    :return: The result of the call
+    """
+    if not cache:
+        return call()
+    return rekognitionResults.get(resultKey(operation, imageBytes, params), call)
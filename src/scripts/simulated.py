@@ -0,0 +1,763 @@
+# -----------------------------------------------------------
+# In-process stand-in for the S3, Rekognition and Kinesis APIs the scripts use, with injected latencies and failures, for benchmarking and load testing without AWS
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import io
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import datetime
+import functools
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import boto3
+from botocore.awsrequest import AWSResponse, HeadersDict
+from botocore.response import StreamingBody
+
+import commons
+import tracing
+
+SIMULATED_REGION = "eu-west-1"
+SIMULATED_ACCOUNT = "123456789012"
+SIMULATED_SERVICES = ["s3", "rekognition", "kinesis", "kinesisvideo"]
+KEY_LANDMARKS = ["eyeLeft", "eyeRight", "nose", "mouthLeft", "mouthRight"]
+# Rekognition refuses images over 5MB sent as bytes, and over 15MB read from S3
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_S3_IMAGE_BYTES = 15 * 1024 * 1024
+# What each service answers with when it is called faster than it allows, and the status of errors that are not the caller's fault
+THROTTLING_ERRORS = {
+    "s3": ("SlowDown", 503),
+    "rekognition": ("ProvisionedThroughputExceededException", 400),
+    "kinesis": ("ProvisionedThroughputExceededException", 400),
+    "kinesisvideo": ("ClientLimitExceededException", 400)
+}
+SERVER_ERRORS = {"InternalError": 500, "InternalServerError": 500, "InternalFailure": 500, "ServiceUnavailable": 503, "SlowDown": 503}
+# Models and stream processors that are STARTING or STOPPING settle into these once they have taken long enough
+TRANSITIONS = {"STARTING": "RUNNING", "STOPPING": "STOPPED"}
+
+
+def snakeCase(operationName):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", operationName).lower()
+
+
+def imageHash(imageBytes):
+    return hashlib.sha256(imageBytes).hexdigest()
+
+
+def profileValue(table, serviceName, operationName):
+    # Profiles are keyed by "service.Operation" or just "Operation"
+    return table.get(f"{serviceName}.{operationName}", table.get(operationName))
+
+
+class SimulatedError(Exception):
+    """SimulatedError : Raised by a simulated operation to answer with an AWS error, which the client raises as the matching botocore exception"""
+
+    def __init__(self, code, message=None, status=400):
+        super().__init__(message or code)
+        self.code = code
+        self.message = message or code
+        self.status = status
+
+
+class SimulatedBody(io.BytesIO):
+    """SimulatedBody : Raw HTTP body of a simulated response"""
+
+    def stream(self, *args, **kwargs):
+        yield self.read()
+
+
+class LatencyProfile:
+    """LatencyProfile : Lognormal latency of each simulated operation, given as its median and spread in seconds"""
+
+    def __init__(self, latencies=None, seed=None):
+        # e.g. {"rekognition.DetectCustomLabels": (0.3, 0.25)}
+        self.latencies = latencies or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self, serviceName, operationName):
+        """sample() : Draws the latency of one call
+        :param serviceName: boto3 service name
+        :param operationName: API operation name (e.g. DetectFaces)
+        :return: Seconds the call takes
+        """
+        latency = profileValue(self.latencies, serviceName, operationName)
+        if latency is None:
+            return 0
+        median, spread = latency
+        with self.lock:
+            return median * self.random.lognormvariate(0, spread)
+
+
+class FaultProfile:
+    """FaultProfile : How often each simulated operation fails, and how many calls a second each one allows before it is throttled"""
+
+    def __init__(self, errorRates=None, rateLimits=None, seed=None):
+        # Keyed like LatencyProfile, e.g. errorRates {"DetectCustomLabels": {"InternalServerError": 0.05}} and rateLimits {"rekognition.DetectCustomLabels": 5}
+        self.errorRates = errorRates or {}
+        self.rateLimits = rateLimits or {}
+        self.random = random.Random(seed)
+        self.recentCalls = {}
+        self.lock = threading.Lock()
+
+    def fault(self, serviceName, operationName):
+        """fault() : Decides whether one call fails
+        :param serviceName: boto3 service name
+        :param operationName: API operation name (e.g. DetectFaces)
+        :return: Tuple of the error code and HTTP status the call fails with, or None if it succeeds
+        """
+        limit = profileValue(self.rateLimits, serviceName, operationName)
+        errorRates = profileValue(self.errorRates, serviceName, operationName) or {}
+        now = time.monotonic()
+        with self.lock:
+            if limit is not None:
+                # Throttled calls are turned away without using up any of the budget
+                calls = self.recentCalls.setdefault(f"{serviceName}.{operationName}", deque())
+                while calls and now - calls[0] >= 1:
+                    calls.popleft()
+                if len(calls) >= limit:
+                    return THROTTLING_ERRORS.get(serviceName, ("ThrottlingException", 400))
+                calls.append(now)
+            for code, rate in errorRates.items():
+                if self.random.random() < rate:
+                    return code, SERVER_ERRORS.get(code, 400)
+        return None
+
+
+class SimulatedAWS:
+    """SimulatedAWS : Keeps the state of a simulated S3 bucket, face collection, custom labels model, stream processors and Kinesis streams, and answers the calls of real boto3 clients from it"""
+
+    def __init__(self, latency=None, gestures=None, faults=None, modelStatus="RUNNING", modelBootSeconds=0, modelStopSeconds=0, processorSeconds=0, shardReadsPerSecond=5, iteratorSeconds=300):
+        self.latency = latency or LatencyProfile()
+        self.faults = faults or FaultProfile()
+        # Labels the model answers with, for images it has not been told the label of with labelImage()
+        self.gestures = gestures or ["FIST", "PALM", "THUMBS_UP", "PEACE", "OK"]
+        self.processorSeconds = processorSeconds
+        self.shardReadsPerSecond = shardReadsPerSecond
+        self.iteratorSeconds = iteratorSeconds
+        self.objects = {}
+        self.faces = {}
+        self.labels = {}
+        self.identities = {}
+        self.model = {"STATUS": modelStatus, "CHANGED": time.monotonic(), "SECONDS": {"STARTING": modelBootSeconds, "STOPPING": modelStopSeconds}}
+        self.processors = {}
+        self.dataStreams = {}
+        self.videoStreams = {}
+        self.sequenceNumber = 0
+        self.responses = {}
+        # Every request made (including retries), and every error answered, by operation
+        self.calls = Counter()
+        self.failures = Counter()
+        # Records returned by get_records, by data stream
+        self.recordsRead = Counter()
+        self.lock = threading.RLock()
+        self.readersChanged = threading.Condition(self.lock)
+
+    # Set up
+
+    def labelImage(self, imageBytes, label):
+        """labelImage() : Sets the gesture the model finds in an image
+        :param imageBytes: Bytes of the image
+        :param label: Gesture label, or None for an image without a gesture
+        """
+        with self.lock:
+            self.labels[imageHash(imageBytes)] = label
+
+    def identifyImage(self, imageBytes, identity):
+        """identifyImage() : Sets whose face is in an image, so different images of the same person match each other
+        :param imageBytes: Bytes of the image
+        :param identity: Any name for the person
+        """
+        with self.lock:
+            self.identities[imageHash(imageBytes)] = identity
+
+    def setModelStatus(self, status):
+        """setModelStatus() : Puts the custom labels model into a status (e.g. STOPPED), as if another process had left it there
+        :param status: Status of the model
+        """
+        self.setStatus(self.model, status)
+
+    def addVideoStream(self, name):
+        """addVideoStream() : Creates a Kinesis video stream for stream processors to read the camera from
+        :param name: Name of the stream
+        :return: ARN of the stream
+        """
+        with self.lock:
+            self.videoStreams[name] = {
+                "ARN": f"arn:aws:kinesisvideo:{SIMULATED_REGION}:{SIMULATED_ACCOUNT}:stream/{name}/1614556800000",
+                "CREATED": datetime.datetime.now(datetime.timezone.utc)
+            }
+            return self.videoStreams[name]["ARN"]
+
+    def addDataStream(self, name, shardCount=1):
+        """addDataStream() : Creates a Kinesis data stream for stream processors to write their results to
+        :param name: Name of the stream
+        :param shardCount: How many shards the stream has
+        :return: ARN of the stream
+        """
+        with self.lock:
+            self.dataStreams[name] = {
+                "ARN": f"arn:aws:kinesis:{SIMULATED_REGION}:{SIMULATED_ACCOUNT}:stream/{name}",
+                "CREATED": datetime.datetime.now(datetime.timezone.utc),
+                "SHARDS": {f"shardId-{position:012d}": {"RECORDS": [], "READS": deque(), "CLOSED": False} for position in range(shardCount)},
+                "READERS": 0
+            }
+            return self.dataStreams[name]["ARN"]
+
+    def putRecord(self, streamName, data, partitionKey="simulated", shardId=None):
+        """putRecord() : Adds a record to a data stream, on the shard its partition key hashes to
+        :param streamName: Name of the data stream
+        :param data: Bytes of the record
+        :param partitionKey: Partition key of the record
+        :param shardId: Shard to add the record to instead (e.g. to replay a recording)
+        :return: ID of the shard the record was added to
+        """
+        with self.lock:
+            shards = self.dataStreams[streamName]["SHARDS"]
+            if shardId is None:
+                shardId = sorted(shards)[int(hashlib.md5(partitionKey.encode("utf-8")).hexdigest(), 16) % len(shards)]
+            self.sequenceNumber += 1
+            shards[shardId]["RECORDS"].append({
+                "SequenceNumber": f"{self.sequenceNumber:056d}",
+                "ApproximateArrivalTimestamp": datetime.datetime.now(datetime.timezone.utc),
+                "Data": data,
+                "PartitionKey": partitionKey,
+                "ARRIVED": time.monotonic()
+            })
+            return shardId
+
+    def closeDataStream(self, streamName):
+        """closeDataStream() : Closes every shard of a data stream, as resharding does. Readers get no next shard iterator once they have read the last record
+        :param streamName: Name of the data stream
+        """
+        with self.lock:
+            for shard in self.dataStreams[streamName]["SHARDS"].values():
+                shard["CLOSED"] = True
+
+    def awaitReaders(self, streamName, readers, timeout=None):
+        """awaitReaders() : Waits until shard iterators have been handed out for a data stream, so that records put afterwards are seen even by readers that started at LATEST
+        :param streamName: Name of the data stream
+        :param readers: How many shard iterators to wait for
+        :param timeout: Optional seconds to give up after
+        :return: True once they have been handed out, False if the timeout expired first
+        """
+        with self.readersChanged:
+            return self.readersChanged.wait_for(lambda: self.dataStreams[streamName]["READERS"] >= readers, timeout)
+
+    def showFace(self, imageBytes, videoStreamName=None):
+        """showFace() : Shows a face to the camera. Every running stream processor reading the camera searches its collection for the face and writes what it found to its data stream
+        :param imageBytes: Bytes of an image of the face
+        :param videoStreamName: Video stream of the camera. Defaults to every video stream
+        :return: How many records were written
+        """
+        written = 0
+        for name, processor in list(self.processors.items()):
+            if self.status(processor) != "RUNNING":
+                continue
+            with self.lock:
+                videoStream = next((streamName for streamName, stream in self.videoStreams.items() if stream["ARN"] == processor["INPUT"]["KinesisVideoStream"]["Arn"]), None)
+                dataStream = next((streamName for streamName, stream in self.dataStreams.items() if stream["ARN"] == processor["OUTPUT"]["KinesisDataStream"]["Arn"]), None)
+                if dataStream is None or (videoStreamName is not None and videoStream != videoStreamName):
+                    continue
+                faceSearch = processor["SETTINGS"]["FaceSearch"]
+                identity = self.identity(imageBytes)
+                matchedFaces = [
+                    {"Similarity": 99.5, "Face": stored["FACE"]}
+                    for stored in self.faces.values()
+                    if stored["COLLECTION"] == faceSearch["CollectionId"] and stored["IDENTITY"] == identity and faceSearch.get("FaceMatchThreshold", 80) <= 99.5
+                ]
+            record = {
+                "InputInformation": {"KinesisVideo": {
+                    "StreamArn": processor["INPUT"]["KinesisVideoStream"]["Arn"],
+                    "FragmentNumber": str(uuid.uuid4().int),
+                    "ServerTimestamp": time.time(),
+                    "ProducerTimestamp": time.time(),
+                    "FrameOffsetInSeconds": 0.0
+                }},
+                "StreamProcessorInformation": {"Status": "RUNNING"},
+                "FaceSearchResponse": [{"DetectedFace": self.faceDetail(imageBytes), "MatchedFaces": matchedFaces}]
+            }
+            self.putRecord(dataStream, json.dumps(record).encode("utf-8"), partitionKey=name)
+            written += 1
+        return written
+
+    # Clients
+
+    def client(self, serviceName):
+        """client() : Builds a real boto3 client whose requests are answered by the simulation instead of AWS. Requests are still built, signed, retried and parsed by botocore
+        :param serviceName: boto3 service name
+        :return: The client
+        """
+        client = boto3.client(serviceName, region_name=SIMULATED_REGION, aws_access_key_id="simulated", aws_secret_access_key="simulated", config=commons.CLIENT_CONFIG)
+        client.meta.events.register("before-parameter-build", self.captureParams, unique_id="simulated-params")
+        client.meta.events.register("before-send", functools.partial(self.answer, client.meta.service_model), unique_id="simulated-send")
+        client.meta.events.register("before-parse", self.parsedResponse, unique_id="simulated-parse")
+        return client
+
+    @contextmanager
+    def installed(self, serviceNames=None):
+        """installed() : Swaps the shared AWS clients for simulated ones, putting the previous clients back afterwards
+        :param serviceNames: Services to simulate. Defaults to every simulated service
+        """
+        serviceNames = serviceNames or SIMULATED_SERVICES
+        previousClients = {serviceName: commons.awsClients.get(serviceName) for serviceName in serviceNames}
+        for serviceName in serviceNames:
+            commons.setClient(serviceName, tracing.instrumentClient(self.client(serviceName)))
+        try:
+            yield self
+        finally:
+            for serviceName, client in previousClients.items():
+                commons.setClient(serviceName, client)
+
+    def captureParams(self, params, context, **kwargs):
+        context["simulatedParams"] = dict(params)
+
+    def answer(self, serviceModel, request, event_name, **kwargs):
+        # event_name is before-send.<service id>.<operation>
+        serviceName = serviceModel.service_name
+        operationName = event_name.rsplit(".", 1)[1]
+        with self.lock:
+            self.calls[f"{serviceName}.{operationName}"] += 1
+        time.sleep(self.latency.sample(serviceName, operationName))
+
+        try:
+            fault = self.faults.fault(serviceName, operationName)
+            if fault is not None:
+                raise SimulatedError(fault[0], f"Simulated {fault[0]}", fault[1])
+            operation = getattr(self, f"{serviceName}_{snakeCase(operationName)}", None)
+            if operation is None:
+                raise SimulatedError("InvalidAction", f"{serviceName}.{operationName} is not simulated")
+            parsed = operation(**request.context.get("simulatedParams", {}))
+        except SimulatedError as e:
+            with self.lock:
+                self.failures[f"{serviceName}.{operationName}.{e.code}"] += 1
+            if serviceModel.protocol == "rest-xml":
+                body = f"<Error><Code>{e.code}</Code><Message>{e.message}</Message></Error>"
+            else:
+                body = json.dumps({"__type": e.code, "message": e.message})
+            return AWSResponse(request.url, e.status, HeadersDict(), SimulatedBody(body.encode("utf-8")))
+
+        # botocore parses an empty body, then parsedResponse() swaps in the simulated response
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.responses[token] = parsed
+        return AWSResponse(request.url, 200, HeadersDict({"x-simulated-response": token}), SimulatedBody(b""))
+
+    def parsedResponse(self, response_dict, customized_response_dict, **kwargs):
+        token = response_dict["headers"].get("x-simulated-response")
+        if token is not None:
+            with self.lock:
+                customized_response_dict.update(self.responses.pop(token))
+
+    # Helpers
+
+    def readBody(self, body):
+        if isinstance(body, (bytes, bytearray)):
+            return bytes(body)
+        if isinstance(body, str):
+            return body.encode("utf-8")
+        # botocore may have read the body already (e.g. to checksum it)
+        body.seek(0)
+        return body.read()
+
+    def imageBytes(self, image):
+        if "Bytes" in image:
+            imageBytes = bytes(image["Bytes"])
+            if len(imageBytes) > MAX_IMAGE_BYTES:
+                raise SimulatedError("ImageTooLargeException", f"Image size is too large. Images sent as bytes must be under {MAX_IMAGE_BYTES} bytes")
+        else:
+            key = (image["S3Object"]["Bucket"], image["S3Object"]["Name"])
+            with self.lock:
+                if key not in self.objects:
+                    raise SimulatedError("InvalidS3ObjectException", f"Unable to get object metadata from S3. Check object key, region and/or access permissions. ({key[1]})")
+                imageBytes = self.objects[key]["BODY"]
+            if len(imageBytes) > MAX_S3_IMAGE_BYTES:
+                raise SimulatedError("ImageTooLargeException", f"Image size is too large. Images in S3 must be under {MAX_S3_IMAGE_BYTES} bytes")
+        if not imageBytes.startswith((b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")):
+            raise SimulatedError("InvalidImageFormatException", "Request has invalid image format")
+        return imageBytes
+
+    def identity(self, imageBytes):
+        digest = imageHash(imageBytes)
+        return self.identities.get(digest, digest)
+
+    def faceDetail(self, imageBytes):
+        # Landmarks are derived from whose face it is, so every image of the same person has the same face
+        seed = random.Random(self.identity(imageBytes))
+        return {
+            "BoundingBox": {"Width": 0.4, "Height": 0.5, "Left": 0.3, "Top": 0.2},
+            "Landmarks": [{"Type": landmark, "X": round(seed.uniform(0.3, 0.7), 4), "Y": round(seed.uniform(0.3, 0.7), 4)} for landmark in KEY_LANDMARKS],
+            "Pose": {"Roll": 0.0, "Yaw": 0.0, "Pitch": 0.0},
+            "Quality": {"Brightness": 80.0, "Sharpness": 90.0},
+            "Confidence": 99.9
+        }
+
+    def status(self, resource):
+        with self.lock:
+            settled = TRANSITIONS.get(resource["STATUS"])
+            if settled is not None and time.monotonic() - resource["CHANGED"] >= resource["SECONDS"][resource["STATUS"]]:
+                resource["STATUS"] = settled
+                resource["CHANGED"] = time.monotonic()
+            return resource["STATUS"]
+
+    def setStatus(self, resource, status):
+        with self.lock:
+            resource["STATUS"] = status
+            resource["CHANGED"] = time.monotonic()
+
+    def streamProcessor(self, name):
+        with self.lock:
+            if name not in self.processors:
+                raise SimulatedError("ResourceNotFoundException", f"Stream processor {name} not found")
+            return self.processors[name]
+
+    def dataStream(self, streamName=None, streamArn=None):
+        with self.lock:
+            for name, stream in self.dataStreams.items():
+                if name == streamName or stream["ARN"] == streamArn:
+                    return name, stream
+        raise SimulatedError("ResourceNotFoundException", f"Stream {streamName or streamArn} under account {SIMULATED_ACCOUNT} not found.")
+
+    def shardDescriptions(self, stream):
+        shardIds = sorted(stream["SHARDS"])
+        hashRange = 2 ** 128 // len(shardIds)
+        return [
+            {
+                "ShardId": shardId,
+                "HashKeyRange": {
+                    "StartingHashKey": str(position * hashRange),
+                    "EndingHashKey": str(2 ** 128 - 1 if position == len(shardIds) - 1 else (position + 1) * hashRange - 1)
+                },
+                "SequenceNumberRange": {"StartingSequenceNumber": f"{0:056d}"}
+            }
+            for position, shardId in enumerate(shardIds)
+        ]
+
+    def token(self, *values):
+        # Opaque tokens (e.g. shard iterators) carry their state, like the ones AWS hands out
+        return base64.b64encode(json.dumps(values).encode("utf-8")).decode("utf-8")
+
+    def untoken(self, token):
+        try:
+            return json.loads(base64.b64decode(token))
+        except ValueError:
+            raise SimulatedError("InvalidArgumentException", f"Invalid token {token}")
+
+    # S3
+
+    def s3_put_object(self, Bucket, Key, Body=b"", **kwargs):
+        body = self.readBody(Body)
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self.lock:
+            self.objects[(Bucket, Key)] = {"BODY": body, "ETAG": etag, "MODIFIED": datetime.datetime.now(datetime.timezone.utc)}
+        return {"ETag": etag}
+
+    def s3_get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        with self.lock:
+            stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise SimulatedError("NoSuchKey", "The specified key does not exist.", 404)
+        if IfNoneMatch is not None and IfNoneMatch == stored["ETAG"]:
+            raise SimulatedError("304", "Not Modified", 304)
+        return {
+            "Body": StreamingBody(io.BytesIO(stored["BODY"]), len(stored["BODY"])),
+            "ContentLength": len(stored["BODY"]),
+            "ETag": stored["ETAG"],
+            "LastModified": stored["MODIFIED"]
+        }
+
+    def s3_head_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise SimulatedError("404", "Not Found", 404)
+        return {"ContentLength": len(stored["BODY"]), "ETag": stored["ETAG"], "LastModified": stored["MODIFIED"]}
+
+    def s3_get_object_acl(self, Bucket, Key, **kwargs):
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise SimulatedError("NoSuchKey", "The specified key does not exist.", 404)
+        return {"Owner": {"ID": "simulated"}, "Grants": []}
+
+    def s3_delete_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def s3_delete_objects(self, Bucket, Delete, **kwargs):
+        if len(Delete["Objects"]) > 1000:
+            raise SimulatedError("MalformedXML", "The XML you provided was not well-formed or did not validate against our published schema")
+        deleted = []
+        with self.lock:
+            for deleteObject in Delete["Objects"]:
+                self.objects.pop((Bucket, deleteObject["Key"]), None)
+                deleted.append({"Key": deleteObject["Key"]})
+        return {} if Delete.get("Quiet") else {"Deleted": deleted}
+
+    def s3_list_objects_v2(self, Bucket, Prefix="", Delimiter=None, MaxKeys=1000, ContinuationToken=None, **kwargs):
+        with self.lock:
+            sizes = {key: len(stored["BODY"]) for (bucket, key), stored in self.objects.items() if bucket == Bucket and key.startswith(Prefix)}
+        # Keys sharing a prefix up to the delimiter are rolled up into one common prefix
+        entries = []
+        for key in sorted(sizes):
+            if Delimiter is not None and Delimiter in key[len(Prefix):]:
+                commonPrefix = key[:len(Prefix) + key[len(Prefix):].index(Delimiter) + len(Delimiter)]
+                if entries == [] or entries[-1] != ("PREFIX", commonPrefix):
+                    entries.append(("PREFIX", commonPrefix))
+            else:
+                entries.append(("KEY", key))
+
+        # Like S3, tokens carry the last key listed rather than a position, so objects deleted between pages never shift the listing
+        if ContinuationToken is not None:
+            lastKey = base64.b64decode(ContinuationToken).decode("utf-8")
+            entries = [entry for entry in entries if entry[1] > lastKey]
+        page = entries[:MaxKeys]
+        response = {
+            "KeyCount": len(page),
+            "IsTruncated": MaxKeys < len(entries),
+            "Contents": [{"Key": key, "Size": sizes[key]} for kind, key in page if kind == "KEY"],
+            "CommonPrefixes": [{"Prefix": prefix} for kind, prefix in page if kind == "PREFIX"]
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = base64.b64encode(page[-1][1].encode("utf-8")).decode("utf-8")
+        return response
+
+    # Rekognition
+
+    def rekognition_index_faces(self, CollectionId, Image, ExternalImageId=None, **kwargs):
+        imageBytes = self.imageBytes(Image)
+        face = {
+            "FaceId": str(uuid.uuid4()),
+            "ImageId": str(uuid.uuid4()),
+            "ExternalImageId": ExternalImageId,
+            "Confidence": 99.9,
+            "BoundingBox": {"Width": 0.4, "Height": 0.5, "Left": 0.3, "Top": 0.2}
+        }
+        with self.lock:
+            self.faces[face["FaceId"]] = {"FACE": face, "COLLECTION": CollectionId, "IDENTITY": self.identity(imageBytes)}
+        return {"FaceRecords": [{"Face": face, "FaceDetail": self.faceDetail(imageBytes)}], "UnindexedFaces": []}
+
+    def rekognition_list_faces(self, CollectionId, MaxResults=1000, NextToken=None, **kwargs):
+        with self.lock:
+            faces = [stored["FACE"] for stored in self.faces.values() if stored["COLLECTION"] == CollectionId]
+        start = int(NextToken or 0)
+        response = {"Faces": faces[start:start + MaxResults]}
+        if start + MaxResults < len(faces):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+    def rekognition_delete_faces(self, CollectionId, FaceIds, **kwargs):
+        deleted = []
+        with self.lock:
+            for faceId in FaceIds:
+                if faceId in self.faces and self.faces[faceId]["COLLECTION"] == CollectionId:
+                    del self.faces[faceId]
+                    deleted.append(faceId)
+        return {"DeletedFaces": deleted}
+
+    def rekognition_detect_faces(self, Image, **kwargs):
+        return {"FaceDetails": [self.faceDetail(self.imageBytes(Image))]}
+
+    def rekognition_compare_faces(self, SourceImage, TargetImage, SimilarityThreshold=80, **kwargs):
+        sourceBytes = self.imageBytes(SourceImage)
+        targetBytes = self.imageBytes(TargetImage)
+        sourceFace = {"BoundingBox": {"Width": 0.4, "Height": 0.5, "Left": 0.3, "Top": 0.2}, "Confidence": 99.9}
+        if self.identity(sourceBytes) != self.identity(targetBytes):
+            return {"SourceImageFace": sourceFace, "FaceMatches": [], "UnmatchedFaces": [{"Confidence": 99.9}]}
+        return {"SourceImageFace": sourceFace, "FaceMatches": [{"Similarity": 99.5, "Face": {"Confidence": 99.9}}], "UnmatchedFaces": []}
+
+    def rekognition_detect_custom_labels(self, ProjectVersionArn, Image, MinConfidence=None, **kwargs):
+        if self.status(self.model) != "RUNNING":
+            raise SimulatedError("ResourceNotReadyException", f"ProjectVersion {ProjectVersionArn} is not running")
+        digest = imageHash(self.imageBytes(Image))
+        with self.lock:
+            label = self.labels[digest] if digest in self.labels else self.gestures[int(digest, 16) % len(self.gestures)]
+        if label is None:
+            return {"CustomLabels": []}
+        return {"CustomLabels": [{"Name": label, "Confidence": 95.0}]}
+
+    def rekognition_describe_project_versions(self, ProjectArn, VersionNames=None, **kwargs):
+        return {"ProjectVersionDescriptions": [{
+            "ProjectVersionArn": f"{ProjectArn}/version/{(VersionNames or ['simulated'])[0]}/1",
+            "CreationTimestamp": datetime.datetime(2021, 3, 1, tzinfo=datetime.timezone.utc),
+            "Status": self.status(self.model)
+        }]}
+
+    def rekognition_start_project_version(self, ProjectVersionArn, MinInferenceUnits, **kwargs):
+        status = self.status(self.model)
+        if status not in ["STOPPED", "TRAINING_COMPLETED"]:
+            raise SimulatedError("ResourceInUseException", f"ProjectVersion is {status}")
+        self.setStatus(self.model, "STARTING")
+        return {"Status": "STARTING"}
+
+    def rekognition_stop_project_version(self, ProjectVersionArn, **kwargs):
+        status = self.status(self.model)
+        if status != "RUNNING":
+            raise SimulatedError("ResourceInUseException", f"ProjectVersion is {status}")
+        self.setStatus(self.model, "STOPPING")
+        return {"Status": "STOPPING"}
+
+    def rekognition_create_stream_processor(self, Input, Output, Name, Settings, RoleArn, **kwargs):
+        with self.lock:
+            if Name in self.processors:
+                raise SimulatedError("ResourceInUseException", f"Stream processor {Name} already exists")
+            if Input["KinesisVideoStream"]["Arn"] not in [stream["ARN"] for stream in self.videoStreams.values()]:
+                raise SimulatedError("InvalidParameterException", f"Kinesis video stream {Input['KinesisVideoStream']['Arn']} does not exist")
+            if Output["KinesisDataStream"]["Arn"] not in [stream["ARN"] for stream in self.dataStreams.values()]:
+                raise SimulatedError("InvalidParameterException", f"Kinesis data stream {Output['KinesisDataStream']['Arn']} does not exist")
+            self.processors[Name] = {
+                "ARN": f"arn:aws:rekognition:{SIMULATED_REGION}:{SIMULATED_ACCOUNT}:streamprocessor/{Name}",
+                "INPUT": Input,
+                "OUTPUT": Output,
+                "SETTINGS": Settings,
+                "ROLE": RoleArn,
+                "CREATED": datetime.datetime.now(datetime.timezone.utc),
+                "STATUS": "STOPPED",
+                "CHANGED": time.monotonic(),
+                "SECONDS": {"STARTING": self.processorSeconds, "STOPPING": self.processorSeconds}
+            }
+            return {"StreamProcessorArn": self.processors[Name]["ARN"]}
+
+    def rekognition_describe_stream_processor(self, Name, **kwargs):
+        processor = self.streamProcessor(Name)
+        return {
+            "Name": Name,
+            "StreamProcessorArn": processor["ARN"],
+            "Status": self.status(processor),
+            "CreationTimestamp": processor["CREATED"],
+            "LastUpdateTimestamp": processor["CREATED"],
+            "Input": processor["INPUT"],
+            "Output": processor["OUTPUT"],
+            "RoleArn": processor["ROLE"],
+            "Settings": processor["SETTINGS"]
+        }
+
+    def rekognition_start_stream_processor(self, Name, **kwargs):
+        processor = self.streamProcessor(Name)
+        status = self.status(processor)
+        if status not in ["STOPPED", "FAILED"]:
+            raise SimulatedError("ResourceInUseException", f"Stream processor {Name} is {status}")
+        self.setStatus(processor, "STARTING")
+        return {}
+
+    def rekognition_stop_stream_processor(self, Name, **kwargs):
+        processor = self.streamProcessor(Name)
+        status = self.status(processor)
+        if status not in ["STARTING", "RUNNING"]:
+            raise SimulatedError("ResourceInUseException", f"Stream processor {Name} is {status}")
+        self.setStatus(processor, "STOPPING")
+        return {}
+
+    def rekognition_delete_stream_processor(self, Name, **kwargs):
+        processor = self.streamProcessor(Name)
+        status = self.status(processor)
+        if status not in ["STOPPED", "FAILED"]:
+            raise SimulatedError("ResourceInUseException", f"Stream processor {Name} is {status}")
+        with self.lock:
+            del self.processors[Name]
+        return {}
+
+    def rekognition_list_stream_processors(self, **kwargs):
+        return {"StreamProcessors": [{"Name": name, "Status": self.status(processor)} for name, processor in list(self.processors.items())]}
+
+    # Kinesis
+
+    def kinesis_describe_stream(self, StreamName=None, StreamARN=None, **kwargs):
+        name, stream = self.dataStream(StreamName, StreamARN)
+        return {"StreamDescription": {
+            "StreamName": name,
+            "StreamARN": stream["ARN"],
+            "StreamStatus": "ACTIVE",
+            "Shards": self.shardDescriptions(stream),
+            "HasMoreShards": False,
+            "RetentionPeriodHours": 24,
+            "StreamCreationTimestamp": stream["CREATED"],
+            "EnhancedMonitoring": []
+        }}
+
+    def kinesis_list_shards(self, StreamName=None, StreamARN=None, NextToken=None, MaxResults=1000, **kwargs):
+        start = 0
+        if NextToken is not None:
+            StreamName, start = self.untoken(NextToken)
+        name, stream = self.dataStream(StreamName, StreamARN)
+        # Every shard is open, so every ShardFilter lists them all
+        shards = self.shardDescriptions(stream)
+        response = {"Shards": shards[start:start + MaxResults]}
+        if start + MaxResults < len(shards):
+            response["NextToken"] = self.token(name, start + MaxResults)
+        return response
+
+    def kinesis_get_shard_iterator(self, ShardId, ShardIteratorType, StreamName=None, StreamARN=None, StartingSequenceNumber=None, Timestamp=None, **kwargs):
+        name, stream = self.dataStream(StreamName, StreamARN)
+        if ShardId not in stream["SHARDS"]:
+            raise SimulatedError("ResourceNotFoundException", f"Shard {ShardId} in stream {name} under account {SIMULATED_ACCOUNT} does not exist")
+        with self.readersChanged:
+            records = list(stream["SHARDS"][ShardId]["RECORDS"])
+            stream["READERS"] += 1
+            self.readersChanged.notify_all()
+
+        if ShardIteratorType == "TRIM_HORIZON":
+            position = 0
+        elif ShardIteratorType == "LATEST":
+            position = len(records)
+        elif ShardIteratorType in ["AT_SEQUENCE_NUMBER", "AFTER_SEQUENCE_NUMBER"]:
+            position = next((index for index, record in enumerate(records) if record["SequenceNumber"] >= StartingSequenceNumber), len(records))
+            if ShardIteratorType == "AFTER_SEQUENCE_NUMBER" and position < len(records) and records[position]["SequenceNumber"] == StartingSequenceNumber:
+                position += 1
+        else:
+            position = next((index for index, record in enumerate(records) if record["ApproximateArrivalTimestamp"] >= Timestamp), len(records))
+        return {"ShardIterator": self.token(name, ShardId, position, time.time())}
+
+    def kinesis_get_records(self, ShardIterator, Limit=10000, **kwargs):
+        name, shardId, position, issued = self.untoken(ShardIterator)
+        if time.time() - issued > self.iteratorSeconds:
+            raise SimulatedError("ExpiredIteratorException", f"Iterator expired. The iterator was created at time {issued} which is further in the past than the tolerated delay of {self.iteratorSeconds} seconds.")
+
+        _, stream = self.dataStream(name)
+        shard = stream["SHARDS"][shardId]
+        now = time.monotonic()
+        with self.lock:
+            # Each shard only allows so many reads a second
+            while shard["READS"] and now - shard["READS"][0] >= 1:
+                shard["READS"].popleft()
+            if len(shard["READS"]) >= self.shardReadsPerSecond:
+                raise SimulatedError("ProvisionedThroughputExceededException", f"Rate exceeded for shard {shardId} in stream {name} under account {SIMULATED_ACCOUNT}.")
+            shard["READS"].append(now)
+            records = shard["RECORDS"][position:position + Limit]
+            unread = shard["RECORDS"][position + len(records):position + len(records) + 1]
+            closed = shard["CLOSED"] and unread == []
+            self.recordsRead[name] += len(records)
+
+        response = {
+            "Records": [{key: value for key, value in record.items() if key != "ARRIVED"} for record in records],
+            "MillisBehindLatest": int((now - unread[0]["ARRIVED"]) * 1000) if unread != [] else 0
+        }
+        # A closed shard has no next iterator once everything on it has been read
+        if not closed:
+            response["NextShardIterator"] = self.token(name, shardId, position + len(records), time.time())
+        return response
+
+    # Kinesis Video
+
+    def kinesisvideo_describe_stream(self, StreamName=None, StreamARN=None, **kwargs):
+        with self.lock:
+            for name, stream in self.videoStreams.items():
+                if name == StreamName or stream["ARN"] == StreamARN:
+                    return {"StreamInfo": {
+                        "StreamName": name,
+                        "StreamARN": stream["ARN"],
+                        "Status": "ACTIVE",
+                        "CreationTime": stream["CREATED"],
+                        "DataRetentionInHours": 24,
+                        "Version": "1"
+                    }}
+        raise SimulatedError("ResourceNotFoundException", f"The requested stream is not found or not active. ({StreamName or StreamARN})")
@@ -5,17 +5,363 @@
 # Released under GNU GPL v3 License
 # -----------------------------------------------------------
 
+import io
+import os
+import sys
+import json
+import struct
+import time
+import threading
+
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.stub import Stubber
+from PIL import Image
+
 from dotenv import load_dotenv
 load_dotenv()
 
+sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts")
+import commons  # noqa: E402
+import images  # noqa: E402
+import manager  # noqa: E402
+import results  # noqa: E402
+import tracing  # noqa: E402
+import simulated  # noqa: E402
+from face import compare_faces, index_photo  # noqa: E402
+
+
+def stubbedS3Client():
+    client = boto3.client("s3", region_name="eu-west-1", aws_access_key_id="testing", aws_secret_access_key="testing")
+    commons.setClient("s3", client)
+    return client, Stubber(client)
+
+
+class TestAwsClients:
+    # Checks clients are only built once and then shared
+    def test_client_shared(self, monkeypatch):
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+        commons.setClient("sts", None)
+        built = commons.getClientStats()["CLIENTS"]
+
+        client = commons.getClient("sts")
+        assert commons.getClient("sts") is client
+        assert commons.getClientStats()["CLIENTS"] == built + 1
+        assert client.meta.config.max_pool_connections == commons.CLIENT_CONFIG.max_pool_connections
+
+    # Checks module level lazy clients resolve to replaced clients
+    def test_lazy_client_replaced(self):
+        class FakeClient:
+            def list_faces(self):
+                return "FAKE"
+
+        lazyClient = commons.LazyClient("fake")
+        commons.setClient("fake", FakeClient())
+        try:
+            assert lazyClient.list_faces() == "FAKE"
+        finally:
+            commons.setClient("fake", None)
+
+
+class TestAwsTracing:
+    # Checks helpers, threads and AWS calls are recorded in the trace attached to a response
+    def test_action_traced(self, tmp_path):
+        client = tracing.instrumentClient(boto3.client("s3", region_name="eu-west-1", aws_access_key_id="testing", aws_secret_access_key="testing"))
+        stubber = Stubber(client)
+        stubber.add_response("list_buckets", {"Buckets": []})
+        stubber.add_response("list_buckets", {"Buckets": []})
+
+        @tracing.traced
+        def listBuckets():
+            return client.list_buckets()
+
+        with stubber:
+            # Nothing is recorded while tracing is off
+            listBuckets()
+            with tracing.tracing("test", True) as trace:
+                worker = threading.Thread(target=tracing.wrap(listBuckets))
+                worker.start()
+                worker.join()
+                with tracing.span("waiting"):
+                    pass
+
+        response = tracing.attach(commons.Response("SUCCESS", 0, "done"), trace, str(tmp_path / "trace.json"))
+        summary = response.content["TRACE"]
+        assert summary["AWS_CALLS"]["s3.ListBuckets"]["COUNT"] == 1
+        assert summary["SPANS"]["TestAwsTracing.test_action_traced.<locals>.listBuckets"]["COUNT"] == 1
+        assert summary["SPANS"]["waiting"]["COUNT"] == 1
+
+        with open(tmp_path / "trace.json") as traceFile:
+            events = json.load(traceFile)["traceEvents"]
+        assert {event["name"] for event in events if event["ph"] == "X"} >= {"test", "s3.ListBuckets", "waiting"}
+
 
 class TestAwsS3:
-    pass
+    def teardown_method(self):
+        commons.setClient("s3", None)
+
+    # Checks uploads share one transfer manager until the S3 client is replaced
+    def test_transfer_manager_shared(self):
+        client, stubber = stubbedS3Client()
+        transferManager = commons.getTransferManager()
+        assert commons.getTransferManager() is transferManager
+
+        stubbedS3Client()
+        assert commons.getTransferManager() is not transferManager
+
+    # Checks background uploads complete and are removed again on rollback
+    def test_pending_uploads_rollback(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        imagePath = str(tmp_path / "face.jpg")
+        Image.new("RGB", (8, 8)).save(imagePath)
+
+        client, stubber = stubbedS3Client()
+        stubber.add_response("put_object", {"ETag": '"abc"'})
+        stubber.add_response("delete_objects", {}, {"Bucket": "testbucket", "Delete": {"Objects": [{"Key": "users/testuser/testuser.jpg"}], "Quiet": True}})
+        with stubber:
+            uploads = manager.PendingUploads("testuser")
+            assert uploads.add(imagePath, None, "testuser.jpg") == "users/testuser/testuser.jpg"
+            uploads.wait()
+            uploads.rollback()
+            stubber.assert_no_pending_responses()
+
+    # Checks images piped in are uploaded straight from memory, and a missing frame is reported before any call is made
+    def test_piped_image_uploaded(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        imagePath = str(tmp_path / "face.jpg")
+        Image.new("RGB", (8, 8)).save(imagePath)
+        with open(imagePath, "rb") as imageFile:
+            imageBytes = imageFile.read()
+
+        backend = simulated.SimulatedAWS()
+        with backend.installed():
+            face = images.loadImageSource("-", io.BytesIO(struct.pack(">I", len(imageBytes)) + imageBytes))
+            assert manager.upload_file(face, "testuser", None, "testuser.jpg") == "users/testuser/testuser.jpg"
+            assert commons.getClient("s3").get_object(Bucket="testbucket", Key="users/testuser/testuser.jpg")["Body"].read() == imageBytes
+
+            response = manager.main(manager.parseArgs(["-a", "compare", "-p", "testuser", "-f", "-"]), io.BytesIO())
+        assert response.code == 8
+        assert backend.calls["s3.PutObject"] == 1
+
+    # Checks formats Rekognition can't read from S3 are stored converted to JPEG, while JPEG and PNG are stored untouched
+    def test_other_formats_uploaded_converted(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        gifPath = str(tmp_path / "face.gif")
+        Image.new("RGB", (8, 8)).save(gifPath)
+        pngPath = str(tmp_path / "face.png")
+        Image.new("RGB", (8, 8)).save(pngPath)
+
+        backend = simulated.SimulatedAWS()
+        with backend.installed():
+            manager.upload_file(gifPath, "testuser", None, "testuser.jpg")
+            manager.upload_file(pngPath, "other", None, "other.jpg")
+            stored = commons.getClient("s3").get_object(Bucket="testbucket", Key="users/testuser/testuser.jpg")["Body"].read()
+            assert images.imageHandle(stored).format == "JPEG"
+            with open(pngPath, "rb") as pngFile:
+                assert commons.getClient("s3").get_object(Bucket="testbucket", Key="users/other/other.jpg")["Body"].read() == pngFile.read()
+
+    # Checks existing profiles are never overwritten, and a failed create leaves nothing behind in S3 or the collection
+    def test_create_user_rollback(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "testcollection")
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+        monkeypatch.setattr(index_photo, "faceIndex", None)
+        monkeypatch.setattr(index_photo, "faceDetailsCache", {})
+        imagePath = str(tmp_path / "face.jpg")
+        Image.new("RGB", (8, 8)).save(imagePath)
+        createArgs = ["-a", "create", "-f", imagePath, "-u", "FIST", "PALM", "POINT", "THUMB"]
+
+        def modelStopping():
+            return commons.respond(messageType="ERROR", message="Stopping", code=23)
+        monkeypatch.setattr(manager.gesture_recog, "acquireModel", modelStopping)
+
+        backend = simulated.SimulatedAWS()
+        with backend.installed():
+            s3 = commons.getClient("s3")
+            s3.put_object(Bucket="testbucket", Key="users/alice/alice.jpg", Body=b"face")
+            assert manager.main(manager.parseArgs(createArgs + ["-p", "alice"])).code == 29
+            assert backend.calls["rekognition.IndexFaces"] == 0
+
+            assert manager.main(manager.parseArgs(createArgs + ["-p", "bob"])).code == 23
+            assert backend.calls["rekognition.IndexFaces"] == 1
+            remaining = [entry["Key"] for entry in s3.list_objects_v2(Bucket="testbucket").get("Contents", [])]
+            faces = commons.getClient("rekognition").list_faces(CollectionId="testcollection")["Faces"]
+
+        assert remaining == ["users/alice/alice.jpg"]
+        assert faces == []
+        assert index_photo.readFaceIndex() == {}
+
+    # Checks whole user folders are deleted in batches of up to 1000 keys, leaving users that share a name prefix alone
+    def test_delete_users(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "testcollection")
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+        monkeypatch.setattr(index_photo, "faceIndex", None)
+        backend = simulated.SimulatedAWS()
+        with backend.installed():
+            s3 = commons.getClient("s3")
+            for profile in ["al", "alice", "bob"]:
+                s3.put_object(Bucket="testbucket", Key=f"users/{profile}/{profile}.jpg", Body=b"face")
+            for position in range(2500):
+                s3.put_object(Bucket="testbucket", Key=f"users/alice/gestures/lock/LockGesture{position}.jpg", Body=b"gesture")
+            commons.getClient("rekognition").index_faces(CollectionId="testcollection", Image={"Bytes": bytes.fromhex("ffd8ffe0")}, ExternalImageId="bob.jpg")
+
+            response = manager.main(manager.parseArgs(["-a", "delete", "-p", "alice", "bob", "nobody"]))
+            remaining = [entry["Key"] for entry in s3.list_objects_v2(Bucket="testbucket").get("Contents", [])]
+
+        assert response.code == 0, response.message
+        assert sorted(response.content["DELETED"]) == ["alice", "bob"]
+        assert response.content["MISSING"] == ["nobody"]
+        assert remaining == ["users/al/al.jpg"]
+        assert backend.calls["s3.DeleteObjects"] == 4
+        assert backend.calls["rekognition.DeleteFaces"] == 1
+        assert manager.main(manager.parseArgs(["-a", "compare", "-p", "alice", "bob"])).code == 13
 
 
 class TestAwsKinesis:
-    pass
+    # Checks a face shown to the camera is found through the simulated stream processor and data stream
+    def test_stream_face_found(self, monkeypatch):
+        for name, value in [("FACE_RECOG_BUCKET", "testbucket"), ("FACE_RECOG_COLLECTION", "testcollection"), ("FACE_RECOG_PROCESSOR", "testprocessor"), ("CAMERA_STREAM_NAME", "testcamera"), ("CAMERA_DATASTREAM_NAME", "testdata"), ("ROLE_ARN", "arn:aws:iam::123456789012:role/test")]:
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr(index_photo, "faceDetailsCache", {})
+        backend = simulated.SimulatedAWS(processorSeconds=0.2)
+        backend.addVideoStream("testcamera")
+        backend.addDataStream("testdata", shardCount=2)
+
+        enrolled = bytes.fromhex("ffd8ffe0") + b"enrolled"
+        captured = bytes.fromhex("ffd8ffe0") + b"captured"
+        backend.identifyImage(enrolled, "testuser")
+        backend.identifyImage(captured, "testuser")
+        stop = threading.Event()
+
+        def camera():
+            while not stop.wait(0.1):
+                backend.showFace(captured)
+
+        with backend.installed():
+            commons.getClient("s3").put_object(Bucket="testbucket", Key="users/testuser/testuser.jpg", Body=enrolled)
+            commons.getClient("rekognition").index_faces(CollectionId="testcollection", Image={"Bytes": enrolled}, ExternalImageId="testuser.jpg")
+            threading.Thread(target=camera, daemon=True).start()
+            try:
+                matchedFace = compare_faces.checkForFaces(deadline=time.time() + 10)
+            finally:
+                stop.set()
+
+        assert matchedFace["Face"]["ExternalImageId"] == "testuser.jpg"
+        assert backend.calls["rekognition.CreateStreamProcessor"] == 1
+        assert backend.calls["rekognition.StartStreamProcessor"] == 1
+        assert backend.calls["kinesis.GetShardIterator"] == 2
+
+    # Checks reads over a shard's budget are throttled (and retried by the client) and old iterators expire
+    def test_get_records_limits(self):
+        backend = simulated.SimulatedAWS(shardReadsPerSecond=1)
+        backend.addDataStream("testdata")
+        client = backend.client("kinesis")
+        iterator = client.get_shard_iterator(StreamName="testdata", ShardId="shardId-000000000000", ShardIteratorType="TRIM_HORIZON")["ShardIterator"]
+        backend.putRecord("testdata", b"first")
+
+        records = client.get_records(ShardIterator=iterator)
+        assert [record["Data"] for record in records["Records"]] == [b"first"]
+        assert client.get_records(ShardIterator=records["NextShardIterator"])["Records"] == []
+        assert backend.failures["kinesis.GetRecords.ProvisionedThroughputExceededException"] >= 1
+
+        backend.iteratorSeconds = 0
+        with pytest.raises(client.exceptions.ExpiredIteratorException):
+            client.get_records(ShardIterator=iterator)
 
 
 class TestAwsRekognition:
-    pass
+    def teardown_method(self):
+        commons.setClient("rekognition", None)
+
+    # Checks identical image calls are answered from the result cache unless the call site opts out
+    def test_results_cached_by_content(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(results, "rekognitionResults", results.ResultCache(str(tmp_path / "results")))
+        client = boto3.client("rekognition", region_name="eu-west-1", aws_access_key_id="testing", aws_secret_access_key="testing")
+        stubber = Stubber(client)
+        for _ in range(3):
+            stubber.add_response("detect_faces", {"FaceDetails": [{"Confidence": 99.5}]})
+
+        def detectFaces():
+            return client.detect_faces(Image={"Bytes": b"face"})["FaceDetails"]
+
+        with stubber:
+            assert results.cachedCall("detect_faces", b"face", {}, detectFaces, True) == [{"Confidence": 99.5}]
+            assert results.cachedCall("detect_faces", b"face", {}, detectFaces, True) == [{"Confidence": 99.5}]
+            # Different bytes or parameters are a different call
+            results.cachedCall("detect_faces", b"other face", {}, detectFaces, True)
+            results.cachedCall("detect_faces", b"face", {"Attributes": ["ALL"]}, detectFaces, False)
+            stubber.assert_no_pending_responses()
+
+        stats = results.rekognitionResults.getStats()
+        assert (stats["HITS"], stats["MISSES"]) == (1, 2)
+
+        # A new execution reuses the results stored on disk
+        monkeypatch.setattr(results, "rekognitionResults", results.ResultCache(str(tmp_path / "results")))
+        assert results.cachedCall("detect_faces", b"face", {}, detectFaces, True) == [{"Confidence": 99.5}]
+        assert results.rekognitionResults.getStats()["DISK_HITS"] == 1
+        # An image handle shares the result of its bytes
+        assert results.cachedCall("detect_faces", images.imageHandle(b"face"), {}, detectFaces, True) == [{"Confidence": 99.5}]
+
+    # Checks the least recently used results are evicted and expired results are fetched again
+    def test_results_evicted_and_expired(self, tmp_path):
+        cache = results.ResultCache(str(tmp_path / "results"), ttl=60, maxEntries=2, maxMemoryEntries=0)
+        for key in ["first", "second"]:
+            cache.get(key, lambda: key)
+        os.utime(tmp_path / "results" / "first.json", (0, 0))
+        cache.get("third", lambda: "third")
+        assert sorted(os.listdir(tmp_path / "results")) == ["second.json", "third.json"]
+        assert cache.get("first", lambda: "refetched") == "refetched"
+
+        cache.ttl = 0
+        assert cache.get("third", lambda: "expired") == "expired"
+
+    # Checks the stored results are counted rather than scanned for on every miss
+    def test_results_scanned_only_to_evict(self, monkeypatch, tmp_path):
+        cache = results.ResultCache(str(tmp_path / "results"), ttl=60, maxEntries=3, maxMemoryEntries=0)
+        scanEntries = cache.scanEntries
+        scans = []
+        monkeypatch.setattr(cache, "scanEntries", lambda: scans.append(1) or scanEntries())
+        for key in ["first", "second", "third"]:
+            cache.get(key, lambda: key)
+        assert len(scans) == 1
+        cache.get("fourth", lambda: "fourth")
+        assert len(scans) == 2
+        assert (len(os.listdir(tmp_path / "results")), cache.diskEntries) == (3, 3)
+
+    # Checks the simulated model takes time to start and stop, and cannot be used until it is running
+    def test_simulated_model_boot(self):
+        backend = simulated.SimulatedAWS(modelStatus="STOPPED", modelBootSeconds=0.2, modelStopSeconds=0.2)
+        client = backend.client("rekognition")
+
+        def modelStatus():
+            return client.describe_project_versions(ProjectArn="arn:aws:rekognition:eu-west-1:123456789012:project/test/1")["ProjectVersionDescriptions"][0]["Status"]
+
+        client.start_project_version(ProjectVersionArn="arn:aws:rekognition:eu-west-1:123456789012:project/test/version/test/1", MinInferenceUnits=1)
+        assert modelStatus() == "STARTING"
+        with pytest.raises(client.exceptions.ResourceNotReadyException):
+            client.detect_custom_labels(ProjectVersionArn="arn:aws:rekognition:eu-west-1:123456789012:project/test/version/test/1", Image={"Bytes": bytes.fromhex("ffd8ffe0")})
+        time.sleep(0.25)
+        assert modelStatus() == "RUNNING"
+
+        client.stop_project_version(ProjectVersionArn="arn:aws:rekognition:eu-west-1:123456789012:project/test/version/test/1")
+        assert modelStatus() == "STOPPING"
+        time.sleep(0.25)
+        assert modelStatus() == "STOPPED"
+
+    # Checks images Rekognition would refuse are refused, and injected failures are retried before they are raised
+    def test_simulated_failures(self, monkeypatch):
+        # One retry
+        monkeypatch.setattr(commons, "CLIENT_CONFIG", Config(retries={"mode": "standard", "max_attempts": 1}))
+        backend = simulated.SimulatedAWS(faults=simulated.FaultProfile(errorRates={"CompareFaces": {"InternalServerError": 1.0}}))
+        client = backend.client("rekognition")
+
+        with pytest.raises(client.exceptions.ImageTooLargeException):
+            client.detect_faces(Image={"Bytes": bytes.fromhex("ffd8ffe0") + bytes(simulated.MAX_IMAGE_BYTES)})
+        with pytest.raises(client.exceptions.InvalidImageFormatException):
+            client.detect_faces(Image={"Bytes": b"not an image"})
+
+        with pytest.raises(client.exceptions.InternalServerError):
+            client.compare_faces(SourceImage={"Bytes": bytes.fromhex("ffd8ffe0")}, TargetImage={"Bytes": bytes.fromhex("ffd8ffe0")})
+        assert backend.calls["rekognition.CompareFaces"] == 2
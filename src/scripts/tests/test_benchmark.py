@@ -0,0 +1,249 @@
+# --------------------------------------------------------------------
+# Benchmarks the manager actions end to end against the simulated AWS backend, failing on regressions from the saved baselines
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# --------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+from collections import Counter, OrderedDict
+
+import pytest
+import numpy as np
+from PIL import Image
+
+from dotenv import load_dotenv
+load_dotenv()
+
+sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts")
+import manager  # noqa: E402
+import results  # noqa: E402
+import simulated  # noqa: E402
+from face import index_photo  # noqa: E402
+from gesture import gesture_recog  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmarks", "baseline.json")
+# How many times each action is timed. BENCHMARK_UPDATE=true saves the results as the new baselines and BENCHMARK_OUTPUT writes them to a file
+BENCHMARK_RUNS = int(os.getenv("BENCHMARK_RUNS", 10))
+BENCHMARK_UPDATE = os.getenv("BENCHMARK_UPDATE", "false").lower() == "true"
+# Timings depend on the machine, so actions are only timed with BENCHMARK=true. Otherwise each action runs once without latency and only its AWS calls are checked
+BENCHMARK = os.getenv("BENCHMARK", "false").lower() == "true" or BENCHMARK_UPDATE
+BENCHMARK_OUTPUT = os.getenv("BENCHMARK_OUTPUT") or None
+# Latencies may be this much slower than the baseline (plus LATENCY_SLACK seconds) before the benchmark fails, as they depend on the machine
+LATENCY_TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", 0.5))
+LATENCY_SLACK = 0.05
+
+# Latency of each API as (median, spread) in seconds. These are a tenth of typical AWS latencies so the suite stays quick
+LATENCIES = {
+    "s3.PutObject": (0.012, 0.3),
+    "s3.GetObject": (0.008, 0.3),
+    "s3.GetObjectAcl": (0.006, 0.3),
+    "s3.DeleteObject": (0.006, 0.3),
+    "rekognition.IndexFaces": (0.05, 0.25),
+    "rekognition.ListFaces": (0.02, 0.25),
+    "rekognition.DeleteFaces": (0.02, 0.25),
+    "rekognition.CompareFaces": (0.04, 0.25),
+    "rekognition.DetectFaces": (0.03, 0.25),
+    "rekognition.DetectCustomLabels": (0.04, 0.25),
+    "rekognition.DescribeProjectVersions": (0.01, 0.25)
+}
+LOCK_GESTURES = ["FIST", "PALM", "OK", "PEACE"]
+UNLOCK_GESTURES = ["PALM", "FIST", "PEACE", "OK"]
+EDITED_UNLOCK_GESTURES = ["OK", "PEACE", "FIST", "PALM"]
+
+benchmarkResults = OrderedDict()
+
+
+def percentiles(seconds):
+    return {
+        "P50": round(float(np.percentile(seconds, 50)), 4),
+        "P95": round(float(np.percentile(seconds, 95)), 4),
+        "P99": round(float(np.percentile(seconds, 99)), 4)
+    }
+
+
+def checkAgainstBaseline(action, result, baseline, timed=True):
+    """checkAgainstBaseline() : Compares a benchmark result with its baseline
+    :param action: Name of the benchmarked action
+    :param result: Result of the benchmark
+    :param baseline: Saved result to compare against
+    :param timed: If False, only the AWS calls are compared
+    :return: List of regressions (empty if there are none)
+    """
+    regressions = []
+    for operation, calls in result["AWS_CALLS"].items():
+        if calls > baseline["AWS_CALLS"].get(operation, 0):
+            regressions.append(f"{action} makes {calls} {operation} calls, up from {baseline['AWS_CALLS'].get(operation, 0)}")
+    if not timed:
+        return regressions
+    for percentile in ["P50", "P95"]:
+        allowed = baseline[percentile] * (1 + LATENCY_TOLERANCE) + LATENCY_SLACK
+        if result[percentile] > allowed:
+            regressions.append(f"{action} {percentile} is {result[percentile]}s, over the {allowed:.4f}s allowed by its {baseline[percentile]}s baseline")
+    return regressions
+
+
+def noisyImage(path):
+    Image.frombytes("RGB", (64, 48), os.urandom(64 * 48 * 3)).save(path, format="JPEG")
+    return str(path)
+
+
+def setup_module(module):
+    if BENCHMARK:
+        print(f"[INFO] Benchmarking {BENCHMARK_RUNS} runs of each action")
+    else:
+        print("[INFO] Checking the AWS calls of each action. Set BENCHMARK=true to time them too")
+
+
+def teardown_module(module):
+    if benchmarkResults == {} or not BENCHMARK:
+        return
+    print(json.dumps(benchmarkResults, indent=4))
+    paths = ([BENCHMARK_OUTPUT] if BENCHMARK_OUTPUT is not None else []) + ([BASELINE_PATH] if BENCHMARK_UPDATE else [])
+    for path in paths:
+        # Indented, so changes to the baselines are easy to review
+        with open(path, "w") as resultsFile:
+            json.dump(benchmarkResults, resultsFile, indent=4)
+            resultsFile.write("\n")
+
+
+class Benchmark:
+    """Benchmark : A simulated backend with one enrolled user, and the images to run the actions with"""
+
+    def __init__(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "benchmark")
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "benchmark")
+        monkeypatch.setenv("PROJECT_ARN", "arn:aws:rekognition:eu-west-1:123456789012:project/gestures/1614556800000")
+        monkeypatch.setenv("LATEST_MODEL_VERSION", "benchmark")
+        monkeypatch.setenv("LATEST_MODEL_ARN", "arn:aws:rekognition:eu-west-1:123456789012:project/gestures/version/benchmark/1614556800000")
+
+        # Nothing is carried over from other runs, and every run does the full work
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+        monkeypatch.setattr(index_photo, "faceIndex", None)
+        monkeypatch.setattr(index_photo, "faceDetailsCache", {})
+        monkeypatch.setattr(gesture_recog, "MODEL_STATE_PATH", str(tmp_path / "model_state.json"))
+        monkeypatch.setattr(gesture_recog, "MODEL_IDLE_TIMEOUT", 60)
+        monkeypatch.setattr(gesture_recog, "GESTURE_ENGINE", "rekognition")
+        monkeypatch.setattr(gesture_recog, "configCache", OrderedDict())
+        # Logins are rate limited against bruteforcing, which the repeated runs would trip
+        monkeypatch.setattr(gesture_recog, "inUserCombination", gesture_recog.checkUserCombination)
+        for cacheName in ["projectVersionsCache", "gestureTypesCache"]:
+            cache = getattr(gesture_recog, cacheName)
+            monkeypatch.setattr(cache, "path", str(tmp_path / os.path.basename(cache.path)))
+            monkeypatch.setattr(cache, "entries", {})
+            monkeypatch.setattr(cache, "modified", None)
+        monkeypatch.setattr(results, "rekognitionResults", results.ResultCache(str(tmp_path / "results")))
+        monkeypatch.setattr(manager, "ENROLMENT_RESULT_CACHE", False)
+        monkeypatch.setattr(manager, "LOGIN_RESULT_CACHE", False)
+
+        self.backend = simulated.SimulatedAWS(simulated.LatencyProfile(LATENCIES, seed=0) if BENCHMARK else None)
+        self.runs = BENCHMARK_RUNS if BENCHMARK else 1
+        self.face = noisyImage(tmp_path / "face.jpg")
+        self.lock = self.gestureImages(tmp_path, "lock", LOCK_GESTURES)
+        self.unlock = self.gestureImages(tmp_path, "unlock", UNLOCK_GESTURES)
+        self.editedUnlock = self.gestureImages(tmp_path, "edited", EDITED_UNLOCK_GESTURES)
+
+    def gestureImages(self, tmp_path, name, gestures):
+        paths = []
+        for position, gesture in enumerate(gestures, start=1):
+            path = noisyImage(tmp_path / f"{name}_{position}.jpg")
+            with open(path, "rb") as imageFile:
+                self.backend.labelImage(imageFile.read(), gesture)
+            paths.append(path)
+        return paths
+
+    def createArgs(self, profile):
+        return ["-a", "create", "-m", "-p", profile, "-f", self.face, "-l", *self.lock, "-u", *self.unlock]
+
+    def run(self, action, argsForRun, setUp=None):
+        """run() : Times an action BENCHMARK_RUNS times (once without BENCHMARK), after an untimed run to warm up the clients and caches
+        :param action: Name of the action
+        :param argsForRun: Function given the run number that returns the manager arguments for that run
+        :param setUp: Optional function given the run number that prepares the run without being timed
+        :return: The benchmark result
+        """
+        seconds = []
+        calls = Counter()
+        criticalPath = Counter()
+        with self.backend.installed():
+            for run in range(self.runs + 1):
+                if setUp is not None:
+                    setUp(run)
+                before = Counter(self.backend.calls)
+                args = manager.parseArgs(argsForRun(run) + ["--trace"])
+
+                startTime = time.perf_counter()
+                response = manager.main(args)
+                elapsed = time.perf_counter() - startTime
+
+                assert response.code == 0, response.message
+                if run == 0:
+                    continue
+                seconds.append(elapsed)
+                calls.update(self.backend.calls - before)
+                for name, span in response.content["TRACE"]["CRITICAL_PATH"].items():
+                    criticalPath[name] += span["SECONDS"]
+
+        result = {
+            "RUNS": self.runs,
+            **percentiles(seconds),
+            "AWS_CALLS": {operation: round(count / self.runs, 2) for operation, count in sorted(calls.items())},
+            "CRITICAL_PATH": {name: round(total / self.runs, 4) for name, total in criticalPath.most_common()}
+        }
+        benchmarkResults[action] = result
+        return result
+
+    def check(self, action, result):
+        if BENCHMARK_UPDATE:
+            return
+        with open(BASELINE_PATH, "r") as baselineFile:
+            baseline = json.load(baselineFile)
+        if action not in baseline:
+            pytest.skip(f"No baseline for {action}, run with BENCHMARK_UPDATE=true to save one")
+        regressions = checkAgainstBaseline(action, result, baseline[action], BENCHMARK)
+        assert regressions == [], "\n".join(regressions)
+
+
+@pytest.fixture
+def benchmark(monkeypatch, tmp_path):
+    return Benchmark(monkeypatch, tmp_path)
+
+
+class TestBenchmark:
+    def test_benchmark_create(self, benchmark):
+        result = benchmark.run("create", lambda run: benchmark.createArgs(f"create{run}"))
+        benchmark.check("create", result)
+
+    def test_benchmark_edit(self, benchmark):
+        def setUp(run):
+            manager.main(manager.parseArgs(benchmark.createArgs(f"edit{run}")))
+        result = benchmark.run("edit", lambda run: ["-a", "edit", "-m", "-p", f"edit{run}", "-f", benchmark.face, "-u", *benchmark.editedUnlock], setUp)
+        benchmark.check("edit", result)
+
+    def test_benchmark_gesture(self, benchmark):
+        def setUp(run):
+            if run == 0:
+                manager.main(manager.parseArgs(benchmark.createArgs("gesture")))
+            # Every login downloads the config file, as it would in a new process
+            gesture_recog.configCache.clear()
+        result = benchmark.run("gesture", lambda run: ["-a", "gesture", "-m", "-p", "gesture", "-u", *benchmark.unlock], setUp)
+        benchmark.check("gesture", result)
+
+    def test_benchmark_compare(self, benchmark):
+        def setUp(run):
+            if run == 0:
+                manager.main(manager.parseArgs(benchmark.createArgs("compare")))
+            index_photo.faceDetailsCache.clear()
+        result = benchmark.run("compare", lambda run: ["-a", "compare", "-p", "compare", "-f", benchmark.face], setUp)
+        benchmark.check("compare", result)
+
+    # Checks more AWS calls or a slower action than the baseline are reported as regressions
+    def test_baseline_regressions(self):
+        baseline = {"P50": 0.1, "P95": 0.2, "AWS_CALLS": {"s3.PutObject": 2}}
+        assert checkAgainstBaseline("create", {"P50": 0.1, "P95": 0.2, "AWS_CALLS": {"s3.PutObject": 2}}, baseline) == []
+        assert len(checkAgainstBaseline("create", {"P50": 0.1, "P95": 0.2, "AWS_CALLS": {"s3.PutObject": 3, "s3.GetObject": 1}}, baseline)) == 2
+        assert len(checkAgainstBaseline("create", {"P50": 0.1, "P95": 1.0, "AWS_CALLS": {}}, baseline)) == 1
+        assert checkAgainstBaseline("create", {"P50": 0.1, "P95": 1.0, "AWS_CALLS": {}}, baseline, timed=False) == []
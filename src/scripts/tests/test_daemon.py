@@ -0,0 +1,157 @@
+# --------------------------------------------------------------------
+# Runs the pytest suite against the resident manager service, backed by the simulated AWS services
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# --------------------------------------------------------------------
+
+import os
+import sys
+import json
+import stat
+import time
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dotenv import load_dotenv
+load_dotenv()
+
+sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts")
+import commons  # noqa: E402
+import daemon  # noqa: E402
+import manager  # noqa: E402
+import simulated  # noqa: E402
+from face import index_photo  # noqa: E402
+
+WORKERS = 4
+
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+    monkeypatch.setenv("FACE_RECOG_COLLECTION", "testcollection")
+    monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+    monkeypatch.setattr(index_photo, "faceIndex", None)
+    backend = simulated.SimulatedAWS()
+    server = daemon.createServer(port=0, workers=WORKERS)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    with backend.installed():
+        thread.start()
+        try:
+            yield server, backend
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def request(server, method, path, body=None):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        reply = connection.getresponse()
+        return reply.status, json.loads(reply.read())
+    finally:
+        connection.close()
+
+
+class TestDaemon:
+    # Checks an action posted to the service replies with the same envelope the response file would hold
+    def test_post_action(self, service):
+        server, backend = service
+        commons.getClient("s3").put_object(Bucket="testbucket", Key="users/foobar/foobar.jpg", Body=b"face")
+
+        status, body = request(server, "POST", "/", json.dumps({"args": ["-a", "delete", "-p", "foobar"]}))
+        assert status == 200
+        assert (body["TYPE"], body["CODE"]) == ("SUCCESS", 0)
+
+        status, body = request(server, "POST", "/", json.dumps({"args": ["-a", "delete", "-p", "foobar"]}))
+        assert (status, body["CODE"]) == (200, 9)
+
+    # Checks malformed bodies and arguments are rejected without running anything
+    def test_post_invalid(self, service):
+        server, backend = service
+        for body in ["not json", json.dumps({"arguments": []}), json.dumps({"args": "-a delete"}), json.dumps({"args": [1, 2]})]:
+            status, reply = request(server, "POST", "/", body)
+            assert (status, reply["CODE"]) == (400, 13)
+
+        status, reply = request(server, "POST", "/", json.dumps({"args": ["-a", "nonsense"]}))
+        assert (status, reply["CODE"]) == (200, 13)
+        assert sum(backend.calls.values()) == 0
+
+    # Checks the health endpoint reports the pool size and unknown paths are not found
+    def test_health(self, service):
+        server, backend = service
+        status, body = request(server, "GET", "/health")
+        assert status == 200
+        assert json.loads(body["CONTENT"])["WORKERS"] == WORKERS
+        assert request(server, "GET", "/nothing")[0] == 404
+
+    # Checks actions are run on the pool at the same time rather than one after another
+    def test_concurrent_actions(self, service, monkeypatch):
+        server, backend = service
+        for position in range(WORKERS):
+            commons.getClient("s3").put_object(Bucket="testbucket", Key=f"users/user{position}/user{position}.jpg", Body=b"face")
+
+        # Every action waits for all the others to have started, which only happens if they run concurrently
+        started = threading.Barrier(WORKERS, timeout=5)
+        deleteUser = manager.delete_user
+
+        def concurrentDeleteUser(profile):
+            started.wait()
+            return deleteUser(profile)
+        monkeypatch.setattr(manager, "delete_user", concurrentDeleteUser)
+
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            replies = list(pool.map(
+                lambda position: request(server, "POST", "/", json.dumps({"args": ["-a", "delete", "-p", f"user{position}"]})),
+                range(WORKERS)
+            ))
+        assert [(status, body["CODE"]) for status, body in replies] == [(200, 0)] * WORKERS
+
+    # Checks actions beyond the pool and its queue are turned away instead of waiting indefinitely
+    def test_queue_bounded(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        server = daemon.createServer(port=0, workers=1, maxQueued=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        release = threading.Event()
+        monkeypatch.setattr(manager, "delete_user", lambda profile: release.wait(5) and commons.respond(messageType="SUCCESS", message="Deleted", code=0))
+        thread.start()
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                # One action runs and one waits for it, so the third has nowhere to go
+                pending = [pool.submit(request, server, "POST", "/", json.dumps({"args": ["-a", "delete", "-p", "foobar"]})) for position in range(2)]
+                while server.slots._value > 0:
+                    time.sleep(0.01)
+                status, body = request(server, "POST", "/", json.dumps({"args": ["-a", "delete", "-p", "foobar"]}))
+                assert (status, body["CODE"]) == (503, 30)
+                release.set()
+                assert [reply.result()[0] for reply in pending] == [200, 200]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Checks the socket is only accessible to its owner and anything other than an old socket is never removed
+    def test_socket_permissions(self, tmp_path):
+        socketPath = str(tmp_path / "manager.sock")
+        previousUmask = os.umask(0o022)
+        try:
+            server = daemon.createServer(socketPath=socketPath, workers=1)
+        finally:
+            # The process umask is put back once the socket is bound
+            assert os.umask(previousUmask) == 0o022
+        try:
+            assert stat.S_IMODE(os.stat(socketPath).st_mode) == 0o600
+        finally:
+            server.server_close()
+
+        # A socket left behind by a previous run is replaced
+        daemon.createServer(socketPath=socketPath, workers=1).server_close()
+
+        notSocket = tmp_path / "important.txt"
+        notSocket.write_text("keep me")
+        with pytest.raises(FileExistsError):
+            daemon.createServer(socketPath=str(notSocket), workers=1)
+        assert notSocket.read_text() == "keep me"
@@ -5,9 +5,405 @@
 # Released under GNU GPL v3 License
 # --------------------------------------------------------------------
 
+import io
+import os
+import sys
+import json
+import gzip
+import time
+import threading
+
+import pytest
+import numpy as np
+from PIL import Image
+
+import boto3
+from botocore.stub import Stubber, ANY
+from botocore.response import StreamingBody
+
 from dotenv import load_dotenv
 load_dotenv()
 
+sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts")
+import commons  # noqa: E402
+import manager  # noqa: E402
+import simulated  # noqa: E402
+from face import index_photo  # noqa: E402
+from face import compare_faces  # noqa: E402
+from face import stream_replay  # noqa: E402
+from face import local_faces  # noqa: E402
+
+TEST_LANDMARKS = [
+    {"Type": "eyeLeft", "X": 0.31, "Y": 0.42},
+    {"Type": "eyeRight", "X": 0.62, "Y": 0.41},
+    {"Type": "nose", "X": 0.47, "Y": 0.58},
+    {"Type": "mouthLeft", "X": 0.35, "Y": 0.74},
+    {"Type": "mouthRight", "X": 0.6, "Y": 0.73}
+]
+
+
+def stubbedClient(serviceName):
+    client = boto3.client(serviceName, region_name="eu-west-1", aws_access_key_id="testing", aws_secret_access_key="testing")
+    commons.setClient(serviceName, client)
+    return client, Stubber(client)
+
+
+def jsonBody(body):
+    bodyBytes = json.dumps(body).encode("utf-8")
+    return StreamingBody(io.BytesIO(bodyBytes), len(bodyBytes))
+
 
 class TestIndex:
-    pass
+    def setup_method(self):
+        index_photo.faceDetailsCache.clear()
+
+    def teardown_method(self):
+        commons.setClient("s3", None)
+        commons.setClient("rekognition", None)
+
+    # Checks stored face details are read from the sidecar once and then served from memory
+    def test_face_details_cached(self, monkeypatch):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        client, stubber = stubbedClient("s3")
+        stubber.add_response(
+            "get_object",
+            {"Body": jsonBody({"Landmarks": TEST_LANDMARKS})},
+            {"Bucket": "testbucket", "Key": "users/testuser/FaceDetails.json"}
+        )
+        with stubber:
+            assert index_photo.getFaceDetails("testuser")["Landmarks"] == TEST_LANDMARKS
+            assert index_photo.getFaceDetails("testuser")["Landmarks"] == TEST_LANDMARKS
+            stubber.assert_no_pending_responses()
+
+    # Checks faces enrolled without a sidecar are detected once and get one created
+    def test_face_details_backfilled(self, monkeypatch):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        s3, s3Stubber = stubbedClient("s3")
+        rekog, rekogStubber = stubbedClient("rekognition")
+        s3Stubber.add_client_error("get_object", service_error_code="NoSuchKey", http_status_code=404)
+        s3Stubber.add_response("put_object", {}, {"Bucket": "testbucket", "Key": "users/testuser/FaceDetails.json", "Body": ANY})
+        rekogStubber.add_response("detect_faces", {"FaceDetails": [{"Landmarks": TEST_LANDMARKS, "Confidence": 99.9, "Smile": {"Value": True}}]})
+        with s3Stubber, rekogStubber:
+            faceDetails = index_photo.getFaceDetails("testuser")
+            s3Stubber.assert_no_pending_responses()
+        assert faceDetails == {"Landmarks": TEST_LANDMARKS, "Confidence": 99.9}
+
+
+class TestFaceIndex:
+    def setup_method(self):
+        index_photo.faceIndex = None
+
+    def teardown_method(self):
+        commons.setClient("rekognition", None)
+
+    # Checks the index is built from every page of the collection and lookups then need no API calls
+    def test_face_index_paginated(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "testcollection")
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+        client, stubber = stubbedClient("rekognition")
+        stubber.add_response(
+            "list_faces",
+            {"Faces": [{"FaceId": "11111111-1111-1111-1111-111111111111", "ExternalImageId": "first.jpg"}], "NextToken": "page2"},
+            {"CollectionId": "testcollection"}
+        )
+        stubber.add_response(
+            "list_faces",
+            {"Faces": [{"FaceId": "22222222-2222-2222-2222-222222222222", "ExternalImageId": "second.jpg"}]},
+            {"CollectionId": "testcollection", "NextToken": "page2"}
+        )
+        with stubber:
+            assert index_photo.faceInCollection("second.jpg")["FaceId"] == "22222222-2222-2222-2222-222222222222"
+            assert index_photo.faceInCollection("first.jpg")["FaceId"] == "11111111-1111-1111-1111-111111111111"
+            assert index_photo.faceInCollection("missing.jpg") == {}
+            stubber.assert_no_pending_responses()
+
+        # Another execution reading the same file sees the same index
+        index_photo.faceIndex = None
+        assert sorted(index_photo.readFaceIndex().keys()) == ["first.jpg", "second.jpg"]
+
+    # Checks collections sharing a cache directory each get their own index
+    def test_face_index_per_collection(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", None)
+        monkeypatch.setattr(commons, "CACHE_DIR", str(tmp_path))
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "first")
+        commons.writeJsonFile(str(tmp_path / "face_index-first.json"), {})
+        index_photo.updateFaceIndex(lambda index: {"first.jpg": {"FaceId": "11111111-1111-1111-1111-111111111111", "ExternalImageId": "first.jpg"}})
+
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "second")
+        assert index_photo.readFaceIndex() is None
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "first")
+        assert list(index_photo.readFaceIndex()) == ["first.jpg"]
+
+    # Checks removed faces are dropped from the index
+    def test_face_index_removed(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "testcollection")
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+        faceId = "11111111-1111-1111-1111-111111111111"
+        commons.writeJsonFile(index_photo.FACE_INDEX_PATH, {"first.jpg": {"FaceId": faceId, "ExternalImageId": "first.jpg"}})
+        client, stubber = stubbedClient("rekognition")
+        stubber.add_response("delete_faces", {"DeletedFaces": [faceId]}, {"CollectionId": "testcollection", "FaceIds": [faceId]})
+        with stubber:
+            assert index_photo.remove_face_from_collection("first.jpg")["FaceId"] == faceId
+        assert index_photo.readFaceIndex() == {}
+
+    # Checks a face missing from a stale index is still found in the collection before it is deleted
+    def test_face_index_stale_remove(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "testcollection")
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+        faceId = "11111111-1111-1111-1111-111111111111"
+        commons.writeJsonFile(index_photo.FACE_INDEX_PATH, {})
+        client, stubber = stubbedClient("rekognition")
+        stubber.add_response(
+            "list_faces",
+            {"Faces": [{"FaceId": faceId, "ExternalImageId": "first.jpg"}]},
+            {"CollectionId": "testcollection"}
+        )
+        stubber.add_response("delete_faces", {"DeletedFaces": [faceId]}, {"CollectionId": "testcollection", "FaceIds": [faceId]})
+        with stubber:
+            assert index_photo.remove_face_from_collection("first.jpg")["FaceId"] == faceId
+            stubber.assert_no_pending_responses()
+        assert index_photo.readFaceIndex() == {}
+
+        # A face that is in neither the index nor the collection is reported as gone
+        stubber.add_response("list_faces", {"Faces": []}, {"CollectionId": "testcollection"})
+        with stubber:
+            assert index_photo.remove_face_from_collection("first.jpg") is None
+            stubber.assert_no_pending_responses()
+
+    # Checks a face re-indexed elsewhere under a new id is still deleted when the indexed id turns out to be stale
+    def test_face_index_stale_id_remove(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_COLLECTION", "testcollection")
+        monkeypatch.setattr(index_photo, "FACE_INDEX_PATH", str(tmp_path / "face_index.json"))
+        staleId = "11111111-1111-1111-1111-111111111111"
+        liveId = "22222222-2222-2222-2222-222222222222"
+        commons.writeJsonFile(index_photo.FACE_INDEX_PATH, {"first.jpg": {"FaceId": staleId, "ExternalImageId": "first.jpg"}})
+        client, stubber = stubbedClient("rekognition")
+        stubber.add_response("delete_faces", {}, {"CollectionId": "testcollection", "FaceIds": [staleId]})
+        stubber.add_response(
+            "list_faces",
+            {"Faces": [{"FaceId": liveId, "ExternalImageId": "first.jpg"}]},
+            {"CollectionId": "testcollection"}
+        )
+        stubber.add_response("delete_faces", {"DeletedFaces": [liveId]}, {"CollectionId": "testcollection", "FaceIds": [liveId]})
+        with stubber:
+            assert index_photo.remove_face_from_collection("first.jpg")["FaceId"] == liveId
+            stubber.assert_no_pending_responses()
+        assert index_photo.readFaceIndex() == {}
+
+
+class TestCompare:
+    # Checks every shard is read at once and the first match stops the other consumers
+    def test_shards_consumed_concurrently(self, monkeypatch):
+        class FakeRekognition:
+            def describe_stream_processor(self, Name):
+                return {"Status": "RUNNING"}
+
+        class FakeKinesis:
+            def list_shards(self, StreamName, ShardFilter):
+                return {"Shards": [{"ShardId": "quiet"}, {"ShardId": "camera"}]}
+
+        stopped = []
+
+        def examineShard(shardJson, deadline=None, stop=None, poller=None):
+            if shardJson["ShardId"] == "camera":
+                time.sleep(0.05)
+                return {"Face": {"ExternalImageId": "testuser.jpg"}}
+            while not stop.is_set():
+                time.sleep(0.01)
+            stopped.append(shardJson["ShardId"])
+            return None
+
+        monkeypatch.setattr(compare_faces, "rekog", FakeRekognition())
+        monkeypatch.setattr(compare_faces, "kinesis", FakeKinesis())
+        monkeypatch.setattr(compare_faces, "examineShard", examineShard)
+        assert compare_faces.checkForFaces(time.time() + 5) == {"Face": {"ExternalImageId": "testuser.jpg"}}
+        assert stopped == ["quiet"]
+
+    # Checks landmarks within the threshold pass while a single landmark outside it, or missing, is an attack
+    def test_presentation_attack_threshold(self):
+        shifted = [dict(mark, X=mark["X"] + 0.08) for mark in TEST_LANDMARKS]
+        assert compare_faces.checkPresentationAttack(shifted, TEST_LANDMARKS, "testuser") is False
+        shifted[2]["Y"] += 0.1
+        assert compare_faces.checkPresentationAttack(shifted, TEST_LANDMARKS, "testuser") is True
+        assert compare_faces.checkPresentationAttack(TEST_LANDMARKS[1:], TEST_LANDMARKS, "testuser") is True
+
+    # Checks a batch of frames is checked in one call, aligning the faces first when asked to
+    def test_presentation_attack_batch_aligned(self):
+        # The same face, further from the camera and off to one side
+        moved = [dict(mark, X=mark["X"] * 0.6 + 0.3, Y=mark["Y"] * 0.6 + 0.2) for mark in TEST_LANDMARKS]
+        batch = [TEST_LANDMARKS, moved, TEST_LANDMARKS[:4]]
+        assert compare_faces.checkPresentationAttacks(batch, TEST_LANDMARKS).tolist() == [False, True, True]
+        assert compare_faces.checkPresentationAttacks(batch, TEST_LANDMARKS, align=True).tolist() == [False, False, True]
+
+    # Checks quiet shards are polled less often but never slower than the maximum, and records reset the pace
+    def test_shard_polling_backoff(self):
+        poller = compare_faces.ShardPoller(0.2, 1)
+        for attempt in range(10):
+            poller.update({"Records": [], "MillisBehindLatest": 0})
+            assert 0.2 <= poller.interval <= 1
+        assert poller.backoff == 1
+
+        poller.update({"Records": [], "MillisBehindLatest": 4000})
+        assert poller.interval == 0.2
+        poller.throttled()
+        assert 0.5 <= poller.interval <= 1
+        poller.update({"Records": [{"Data": "{}"}], "MillisBehindLatest": 0})
+        assert poller.interval == 0.2
+
+    # Checks waiting for the next poll ends as soon as the search is stopped
+    def test_shard_polling_stopped(self):
+        poller = compare_faces.ShardPoller(5, 5)
+        stop = threading.Event()
+        assert poller.wait(stop=stop) is True
+        stop.set()
+        startTime = time.monotonic()
+        assert poller.wait(stop=stop) is False
+        assert time.monotonic() - startTime < 1
+
+
+def searchRecord(shardId, offset, sequence, matchedFaces):
+    data = {"FaceSearchResponse": [{"DetectedFace": {"Landmarks": TEST_LANDMARKS}, "MatchedFaces": matchedFaces}]}
+    return {"Type": "RECORD", "ShardId": shardId, "Offset": offset, "SequenceNumber": str(sequence), "PartitionKey": "camera", "Data": json.dumps(data)}
+
+
+class TestLocalFaces:
+    def embeddings(self, count, seed=0):
+        random = np.random.default_rng(seed)
+        vectors = random.normal(size=(count, local_faces.EMBEDDING_SIZE)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    # Checks enrolled faces are identified from the memory mapped matrix, and the index is shared through its files
+    def test_embeddings_identified(self, tmp_path):
+        path = str(tmp_path / "face_embeddings.json")
+        index = local_faces.FaceEmbeddingIndex(path)
+        vectors = self.embeddings(3)
+        for username, vector in zip(["alice", "bob", "carol"], vectors):
+            index.add(username, vector)
+
+        reloaded = local_faces.FaceEmbeddingIndex(path)
+        assert reloaded.identify(vectors[1] + 0.01)[0] == "bob"
+        assert reloaded.identify(-vectors[1]) is None
+        assert isinstance(reloaded.embeddings, np.memmap)
+
+        index.remove("bob")
+        assert reloaded.identify(vectors[1]) is None
+        assert reloaded.distance(vectors[0], "alice") < 1e-6
+        assert reloaded.distance(vectors[0], "bob") is None
+        # Only the current matrix is kept on disk
+        assert len(list(tmp_path.glob("*.f32"))) == 1
+
+    # Checks enrolling one user only writes their row, appending new users and replacing re-enrolled ones in place
+    def test_embeddings_written_in_place(self, tmp_path):
+        path = str(tmp_path / "face_embeddings.json")
+        index = local_faces.FaceEmbeddingIndex(path)
+        vectors = self.embeddings(3)
+        index.add("alice", vectors[0])
+        matrixFile = index.embeddingsFile
+        index.add("bob", vectors[1])
+        index.add("alice", vectors[2])
+        assert (index.embeddingsFile, index.usernames) == (matrixFile, ["alice", "bob"])
+        assert os.path.getsize(tmp_path / matrixFile) == 2 * local_faces.EMBEDDING_BYTES
+
+        reloaded = local_faces.FaceEmbeddingIndex(path)
+        assert reloaded.identify(vectors[2]) == ("alice", pytest.approx(0, abs=1e-3))
+        assert reloaded.identify(vectors[1]) == ("bob", pytest.approx(0, abs=1e-3))
+
+    # Checks rebuilding enrols every user with a single rewrite of the index
+    def test_embeddings_rebuilt_at_once(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        vectors = self.embeddings(3)
+        monkeypatch.setattr(local_faces, "faceEmbeddingIndex", local_faces.FaceEmbeddingIndex(str(tmp_path / "face_embeddings.json")))
+        local_faces.faceEmbeddingIndex.add("carol", vectors[2])
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: {b"alice": vectors[0], b"bob": vectors[1]}.get(image))
+        updates = []
+        update = local_faces.faceEmbeddingIndex.update
+        monkeypatch.setattr(local_faces.faceEmbeddingIndex, "update", lambda change: updates.append(change) or update(change))
+
+        backend = simulated.SimulatedAWS()
+        with backend.installed():
+            for username in ["alice", "bob", "carol"]:
+                commons.getClient("s3").put_object(Bucket="testbucket", Key=f"users/{username}/{username}.jpg", Body=username.encode())
+            assert local_faces.rebuildIndex(["alice", "bob", "carol", "dave"]) == ["alice", "bob"]
+        assert len(updates) == 1
+        assert local_faces.faceEmbeddingIndex.usernames == ["alice", "bob"]
+
+    # Checks identification stays exact with tens of thousands of users
+    def test_embeddings_identified_at_scale(self, tmp_path):
+        index = local_faces.FaceEmbeddingIndex(str(tmp_path / "face_embeddings.json"))
+        vectors = self.embeddings(20000)
+        index.update(lambda embeddings: embeddings.update({f"user{row}": vector for row, vector in enumerate(vectors)}))
+        assert index.identify(vectors[12345], threshold=0.1) == ("user12345", pytest.approx(0, abs=1e-3))
+
+    # Checks a face is verified against the user's own enrolled embedding
+    def test_face_verified(self, monkeypatch, tmp_path):
+        vectors = self.embeddings(2)
+        monkeypatch.setattr(local_faces, "faceEmbeddingIndex", local_faces.FaceEmbeddingIndex(str(tmp_path / "face_embeddings.json")))
+        local_faces.faceEmbeddingIndex.add("alice", vectors[0])
+
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: vectors[0] * 1.05)
+        assert local_faces.verifyFace("face.jpg", "alice")["MATCH"] is True
+        assert local_faces.verifyFace("face.jpg", "bob") is None
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: vectors[1])
+        assert local_faces.verifyFace("face.jpg", "alice")["MATCH"] is False
+        # Only a measured distance rejects a face, one dlib could not find is left to rekognition
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: None)
+        assert local_faces.verifyFace("face.jpg", "alice") is None
+
+    # Checks a replacement face without a face in it removes the old one instead of leaving it to be matched
+    def test_face_replaced_without_face(self, monkeypatch, tmp_path):
+        vectors = self.embeddings(1)
+        monkeypatch.setattr(local_faces, "faceEmbeddingIndex", local_faces.FaceEmbeddingIndex(str(tmp_path / "face_embeddings.json")))
+        local_faces.faceEmbeddingIndex.add("alice", vectors[0])
+
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: None)
+        assert local_faces.enrolFace("alice", "empty.jpg") is False
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: vectors[0])
+        assert local_faces.verifyFace("face.jpg", "alice") is None
+
+    # Checks compare without a profile identifies the user from the local index
+    def test_face_identified_by_compare(self, monkeypatch, tmp_path):
+        vectors = self.embeddings(2)
+        monkeypatch.setattr(local_faces, "FACE_ENGINE", "local")
+        monkeypatch.setattr(local_faces, "faceEmbeddingIndex", local_faces.FaceEmbeddingIndex(str(tmp_path / "face_embeddings.json")))
+        local_faces.faceEmbeddingIndex.add("alice", vectors[0])
+        local_faces.faceEmbeddingIndex.add("bob", vectors[1])
+        facePath = str(tmp_path / "face.jpg")
+        Image.new("RGB", (8, 8)).save(facePath)
+
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: vectors[1] * 1.05)
+        response = commons.invoke(manager.compare_face, None, facePath)
+        assert (response.code, response.content["USERNAME"]) == (0, "bob")
+        monkeypatch.setattr(local_faces, "computeEmbedding", lambda image: -vectors[0])
+        assert commons.invoke(manager.compare_face, None, facePath).code == 10
+
+
+class TestReplay:
+    # Checks a recorded session is replayed through the face search without any AWS services
+    def test_replay_finds_face(self, tmp_path):
+        recordingPath = str(tmp_path / "session.jsonl.gz")
+        match = {"Similarity": 99.1, "Face": {"ExternalImageId": "testuser.jpg"}}
+        entries = [searchRecord("quiet", offset / 10, offset, []) for offset in range(50)]
+        entries += [searchRecord("camera", offset / 10, 100 + offset, []) for offset in range(20)]
+        entries.append(searchRecord("camera", 2.5, 200, [match]))
+        entries.append({"Type": "FACE_DETAILS", "Username": "testuser", "FaceDetails": {"Landmarks": TEST_LANDMARKS}})
+        with gzip.open(recordingPath, "wt", encoding="utf-8") as recording:
+            for entry in entries:
+                recording.write(json.dumps(entry) + "\n")
+
+        result = stream_replay.replay(recordingPath, timeout=10)
+        assert result["FACE"] == match
+        assert result["TIME_TO_MATCH"] is not None
+        assert 21 <= result["RECORDS"] <= 71
+        assert commons.awsClients.get("kinesis") is None
+
+    # Checks a recording without a match ends once every replayed shard has been read, rather than waiting for the timeout
+    def test_replay_ends_without_match(self, tmp_path):
+        recordingPath = str(tmp_path / "session.jsonl.gz")
+        with gzip.open(recordingPath, "wt", encoding="utf-8") as recording:
+            for offset in range(30):
+                recording.write(json.dumps(searchRecord(f"shard{offset % 3}", offset / 10, offset, [])) + "\n")
+
+        startTime = time.monotonic()
+        result = stream_replay.replay(recordingPath, timeout=30)
+        assert time.monotonic() - startTime < 10
+        assert (result["FACE"], result["RECORDS"], result["TIME_TO_MATCH"]) == (None, 30, None)
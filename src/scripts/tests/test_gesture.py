@@ -5,9 +5,381 @@
 # Released under GNU GPL v3 License
 # --------------------------------------------------------------------
 
+import io
+import os
+import sys
+import json
+import time
+import datetime
+import subprocess
+
+import pytest
+import numpy as np
+from PIL import Image
+
+import boto3
+from botocore.stub import Stubber
+from botocore.response import StreamingBody
+from ratelimit import RateLimitException
+
 from dotenv import load_dotenv
 load_dotenv()
 
+sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts")
+import commons  # noqa: E402
+from gesture import gesture_recog  # noqa: E402
+from gesture import local_gestures  # noqa: E402
+
+TEST_PROJECT_ARN = "arn:aws:rekognition:eu-west-1:123456789012:project/gestures/1614556800000"
+TEST_MODEL_ARN = f"{TEST_PROJECT_ARN.replace('/1614556800000', '')}/version/testversion/1614556800000"
+TEST_CONFIG = {"lock": {}, "unlock": {"1": {"gesture": "FIST", "path": "users/testuser/gestures/unlock/UnlockGesture1.jpg"}}}
+
+
+def stubbedClient(serviceName):
+    client = boto3.client(serviceName, region_name="eu-west-1", aws_access_key_id="testing", aws_secret_access_key="testing")
+    commons.setClient(serviceName, client)
+    return client, Stubber(client)
+
+
+def versionStatus(status):
+    return {"ProjectVersionDescriptions": [{"Status": status, "CreationTimestamp": datetime.datetime(2021, 3, 1)}]}
+
+
+def stubModelStop(stubber):
+    stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+    stubber.add_response("stop_project_version", {"Status": "STOPPING"}, {"ProjectVersionArn": TEST_MODEL_ARN})
+    stubber.add_response("describe_project_versions", versionStatus("STOPPING"))
+
+
+def configBody():
+    configBytes = json.dumps(TEST_CONFIG).encode("utf-8")
+    return StreamingBody(io.BytesIO(configBytes), len(configBytes))
+
 
 class TestGesture:
-    pass
+    def setup_method(self):
+        gesture_recog.configCache.clear()
+
+    def teardown_method(self):
+        commons.setClient("s3", None)
+
+    # Checks repeated config lookups within the TTL only download the config once
+    def test_config_cached(self, monkeypatch):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        client, stubber = stubbedClient("s3")
+        stubber.add_response(
+            "get_object",
+            {"Body": configBody(), "ETag": '"abc"'},
+            {"Bucket": "testbucket", "Key": "users/testuser/gestures/GestureConfig.json"}
+        )
+        with stubber:
+            assert gesture_recog.getUserCombinationFile("testuser") == TEST_CONFIG
+            assert gesture_recog.getUserCombinationFile("testuser") == TEST_CONFIG
+            stubber.assert_no_pending_responses()
+
+    # Checks expired configs are revalidated with their ETag and kept when unchanged
+    def test_config_revalidated(self, monkeypatch):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        monkeypatch.setattr(gesture_recog, "CONFIG_CACHE_TTL", 0)
+        gesture_recog.cacheUserCombinationFile("testuser", TEST_CONFIG, '"abc"')
+        client, stubber = stubbedClient("s3")
+        stubber.add_client_error(
+            "get_object",
+            service_error_code="304",
+            http_status_code=304,
+            expected_params={"Bucket": "testbucket", "Key": "users/testuser/gestures/GestureConfig.json", "IfNoneMatch": '"abc"'}
+        )
+        with stubber:
+            assert gesture_recog.getUserCombinationFile("testuser") == TEST_CONFIG
+            stubber.assert_no_pending_responses()
+
+    # Checks the least recently used config is evicted once the cache is full
+    def test_config_evicted(self, monkeypatch):
+        monkeypatch.setattr(gesture_recog, "CONFIG_CACHE_SIZE", 2)
+        for username in ["first", "second", "third"]:
+            gesture_recog.cacheUserCombinationFile(username, TEST_CONFIG, '"abc"')
+        assert list(gesture_recog.configCache.keys()) == ["second", "third"]
+
+    # Checks one user running out of combination checks doesn't lock out anyone else
+    def test_combination_limited_per_user(self, monkeypatch):
+        monkeypatch.setattr(gesture_recog, "COMBINATION_CALLS", 2)
+        monkeypatch.setattr(gesture_recog, "combinationLimits", {})
+        for username in ["first", "second"]:
+            gesture_recog.cacheUserCombinationFile(username, TEST_CONFIG, '"abc"')
+        gesture = {"Name": TEST_CONFIG["unlock"]["1"]["gesture"]}
+        for attempt in range(2):
+            assert gesture_recog.inUserCombination(gesture, "first", "unlock", "1")
+        with pytest.raises(RateLimitException):
+            gesture_recog.inUserCombination(gesture, "first", "unlock", "1")
+        assert gesture_recog.inUserCombination(gesture, "second", "unlock", "1")
+
+    # Checks concurrent detections are returned in combination order, whichever finishes first
+    def test_detection_ordered(self):
+        def detect(position, image):
+            time.sleep(0.05 * (4 - position))
+            return image.upper()
+        assert gesture_recog.detectGestures(["fist", "palm", "point", "thumb"], detect) == ["FIST", "PALM", "POINT", "THUMB"]
+
+    # Checks the error for the earliest failing image is the one raised
+    def test_detection_error_ordered(self):
+        def detect(position, image):
+            if position > 1:
+                time.sleep(0.05 * (4 - position))
+                return commons.respond(messageType="ERROR", message=f"No gesture in {image}", code=17 + position)
+            time.sleep(0.2)
+            return image
+        with pytest.raises(commons.ResponseError) as error:
+            gesture_recog.detectGestures(["fist", "palm", "point", "thumb"], detect)
+        assert error.value.response.code == 19
+
+
+class TestModelLifecycle:
+    def teardown_method(self):
+        commons.setClient("rekognition", None)
+
+    def stubbedModel(self, monkeypatch, tmp_path, idleTimeout):
+        monkeypatch.setenv("PROJECT_ARN", TEST_PROJECT_ARN)
+        monkeypatch.setenv("LATEST_MODEL_VERSION", "testversion")
+        monkeypatch.setenv("LATEST_MODEL_ARN", TEST_MODEL_ARN)
+        monkeypatch.setattr(gesture_recog, "MODEL_STATE_PATH", str(tmp_path / "model_state.json"))
+        monkeypatch.setattr(gesture_recog, "MODEL_IDLE_TIMEOUT", idleTimeout)
+        # Stops are not confirmed in the background while the stubbed responses are in use
+        monkeypatch.setattr(gesture_recog, "watchProjectStop", lambda: None)
+        # Every status check has to reach the stubbed client
+        monkeypatch.setattr(gesture_recog, "projectVersionsCache", commons.DiskCache("project_versions", 0))
+        monkeypatch.setattr(gesture_recog.projectVersionsCache, "path", str(tmp_path / "project_versions.json"))
+        return stubbedClient("rekognition")
+
+    # Checks the model is only stopped once its last concurrent user releases it
+    def test_model_reference_counted(self, monkeypatch, tmp_path):
+        client, stubber = self.stubbedModel(monkeypatch, tmp_path, 0)
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        stubModelStop(stubber)
+        with stubber:
+            first = gesture_recog.acquireModel()
+            second = gesture_recog.acquireModel()
+            assert gesture_recog.releaseModel(first) is False
+            assert gesture_recog.releaseModel(second) is True
+            stubber.assert_no_pending_responses()
+
+    # Checks an idle model is left running until the idle timeout has passed
+    def test_model_reaped_when_idle(self, monkeypatch, tmp_path):
+        client, stubber = self.stubbedModel(monkeypatch, tmp_path, 0.2)
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        stubModelStop(stubber)
+        with stubber:
+            holder = gesture_recog.acquireModel()
+            assert gesture_recog.releaseModel(holder) is False
+            assert gesture_recog.reapModel() is False
+            time.sleep(0.25)
+            assert gesture_recog.reapModel() is True
+            assert gesture_recog.reapModel() is False
+            stubber.assert_no_pending_responses()
+
+    # Checks users whose process exited without releasing the model do not keep it running
+    def test_model_dead_holder_dropped(self, monkeypatch, tmp_path):
+        client, stubber = self.stubbedModel(monkeypatch, tmp_path, 0)
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        commons.writeJsonFile(gesture_recog.MODEL_STATE_PATH, {"HOLDERS": {"crashed": {"PID": exited.pid, "ACQUIRED": time.time()}}, "RELEASED": None})
+        stubModelStop(stubber)
+        with stubber:
+            assert gesture_recog.reapModel() is True
+            stubber.assert_no_pending_responses()
+
+    # Checks a blocking stop polls the model's status with growing delays until it has stopped
+    def test_model_stop_polled(self, monkeypatch, tmp_path):
+        client, stubber = self.stubbedModel(monkeypatch, tmp_path, 0)
+        delays = []
+        monkeypatch.setattr(gesture_recog.time, "sleep", delays.append)
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        stubber.add_response("stop_project_version", {"Status": "STOPPING"}, {"ProjectVersionArn": TEST_MODEL_ARN})
+        for status in ["STOPPING", "STOPPING", "STOPPING", "STOPPING", "STOPPED", "STOPPED"]:
+            stubber.add_response("describe_project_versions", versionStatus(status))
+        with stubber:
+            assert gesture_recog.projectHandler(False, wait=True) is True
+            stubber.assert_no_pending_responses()
+        assert delays == [1, 2, 4]
+
+    # Checks a model still stopping from its last use is waited on and then started again, instead of failing
+    def test_model_acquired_while_stopping(self, monkeypatch, tmp_path):
+        client, stubber = self.stubbedModel(monkeypatch, tmp_path, 0)
+        delays = []
+        monkeypatch.setattr(gesture_recog.time, "sleep", delays.append)
+        for status in ["STOPPING", "STOPPING", "STOPPED"]:
+            stubber.add_response("describe_project_versions", versionStatus(status))
+        stubber.add_response(
+            "start_project_version",
+            {"Status": "STARTING"},
+            {"ProjectVersionArn": TEST_MODEL_ARN, "MinInferenceUnits": 1}
+        )
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        stubModelStop(stubber)
+        with stubber:
+            holder = gesture_recog.acquireModel()
+            assert gesture_recog.releaseModel(holder) is True
+            stubber.assert_no_pending_responses()
+        assert delays == [1]
+
+    # Checks a model its last user is still stopping is only started again once that user has asked it to stop
+    def test_model_acquired_while_being_stopped(self, monkeypatch, tmp_path):
+        client, stubber = self.stubbedModel(monkeypatch, tmp_path, 0)
+        commons.writeJsonFile(gesture_recog.MODEL_STATE_PATH, {"HOLDERS": {}, "RELEASED": None, "STOPPING": {"PID": os.getpid(), "ID": "last"}})
+        delays = []
+
+        def stopRequested(seconds):
+            # The last user only gets round to stopping the model while this one waits for it
+            if delays == []:
+                gesture_recog.stopModel("last")
+            delays.append(seconds)
+        monkeypatch.setattr(gesture_recog.time, "sleep", stopRequested)
+        stubModelStop(stubber)
+        for status in ["STOPPING", "STOPPED"]:
+            stubber.add_response("describe_project_versions", versionStatus(status))
+        stubber.add_response(
+            "start_project_version",
+            {"Status": "STARTING"},
+            {"ProjectVersionArn": TEST_MODEL_ARN, "MinInferenceUnits": 1}
+        )
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        with stubber:
+            gesture_recog.acquireModel()
+            stubber.assert_no_pending_responses()
+        assert delays == [gesture_recog.MODEL_STOP_REQUEST_POLL]
+        with open(gesture_recog.MODEL_STATE_PATH) as stateFile:
+            assert json.load(stateFile)["STOPPING"] is None
+
+
+class TestMetadataCache:
+    def teardown_method(self):
+        commons.setClient("rekognition", None)
+        commons.setClient("s3", None)
+
+    def cacheIn(self, monkeypatch, tmp_path, name, ttl):
+        cache = commons.DiskCache(name, ttl)
+        monkeypatch.setattr(cache, "path", str(tmp_path / f"{name}.json"))
+        return cache
+
+    # Checks every page of gesture labels is listed and later executions reuse them from disk
+    def test_gesture_types_paginated_and_persisted(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("FACE_RECOG_BUCKET", "testbucket")
+        monkeypatch.setattr(gesture_recog, "gestureTypesCache", self.cacheIn(monkeypatch, tmp_path, "gesture_types", 60))
+        client, stubber = stubbedClient("s3")
+        listing = {"Bucket": "testbucket", "Prefix": gesture_recog.GESTURE_TYPES_PREFIX, "Delimiter": "/"}
+        stubber.add_response(
+            "list_objects_v2",
+            {"CommonPrefixes": [{"Prefix": "gestureTraining/mixed/FIST/"}], "IsTruncated": True, "NextContinuationToken": "page2"},
+            listing
+        )
+        stubber.add_response("list_objects_v2", {"CommonPrefixes": [{"Prefix": "gestureTraining/mixed/PALM/"}], "IsTruncated": False}, dict(listing, ContinuationToken="page2"))
+        with stubber:
+            assert gesture_recog.getGestureTypes() == ["FIST", "PALM"]
+            assert gesture_recog.getGestureTypes() == ["FIST", "PALM"]
+            stubber.assert_no_pending_responses()
+
+        # A new execution starts with an empty memory but the same cache file
+        monkeypatch.setattr(gesture_recog, "gestureTypesCache", self.cacheIn(monkeypatch, tmp_path, "gesture_types", 60))
+        with stubber:
+            assert gesture_recog.getGestureTypes() == ["FIST", "PALM"]
+
+    # Checks the model's version details are reused until they are invalidated
+    def test_project_versions_invalidated(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("PROJECT_ARN", TEST_PROJECT_ARN)
+        monkeypatch.setenv("LATEST_MODEL_VERSION", "testversion")
+        monkeypatch.setattr(gesture_recog, "projectVersionsCache", self.cacheIn(monkeypatch, tmp_path, "project_versions", 60))
+        client, stubber = stubbedClient("rekognition")
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        stubber.add_response("describe_project_versions", versionStatus("STOPPED"))
+        with stubber:
+            assert gesture_recog.getProjectVersions()[0]["Status"] == "RUNNING"
+            assert gesture_recog.getProjectVersions()[0]["Status"] == "RUNNING"
+            gesture_recog.invalidateProjectVersions()
+            assert gesture_recog.getProjectVersions()[0]["Status"] == "STOPPED"
+            stubber.assert_no_pending_responses()
+
+    # Checks the model is started or stopped based on its current status rather than the cached one
+    def test_project_handler_not_cached(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("PROJECT_ARN", TEST_PROJECT_ARN)
+        monkeypatch.setenv("LATEST_MODEL_VERSION", "testversion")
+        monkeypatch.setattr(gesture_recog, "projectVersionsCache", self.cacheIn(monkeypatch, tmp_path, "project_versions", 60))
+        client, stubber = stubbedClient("rekognition")
+        stubber.add_response("describe_project_versions", versionStatus("STOPPED"))
+        stubber.add_response("describe_project_versions", versionStatus("RUNNING"))
+        with stubber:
+            assert gesture_recog.getProjectVersions()[0]["Status"] == "STOPPED"
+            # Another execution started the model since, so it must not be started again
+            assert gesture_recog.projectHandler(True) is True
+            assert gesture_recog.getProjectVersions()[0]["Status"] == "RUNNING"
+            stubber.assert_no_pending_responses()
+
+
+def stripedImage(path, vertical, seed):
+    random = np.random.default_rng(seed)
+    pixels = random.integers(0, 60, (96, 96)).astype(np.uint8)
+    offset = int(random.integers(0, 12))
+    for stripe in range(offset, 96, 24):
+        if vertical:
+            pixels[:, stripe:stripe + 10] = 220
+        else:
+            pixels[stripe:stripe + 10, :] = 220
+    Image.fromarray(pixels).save(path)
+    return str(path)
+
+
+def stripedDataset(root, count):
+    for label, vertical in [("PALM", True), ("FIST", False)]:
+        os.makedirs(root / label)
+        for seed in range(count):
+            stripedImage(root / label / f"{seed}.png", vertical, seed)
+    return str(root)
+
+
+class TestLocalGestures:
+    def teardown_method(self):
+        commons.setClient("rekognition", None)
+
+    # Checks a model trained from a labelled dataset survives being saved and tells the gestures apart
+    def test_local_model_trained(self, tmp_path):
+        modelPath = str(tmp_path / "gesture_model.npz")
+        trained = local_gestures.trainModel(stripedDataset(tmp_path / "mixed", 8), modelPath, neighbours=3)
+        assert trained.classes == ["FIST", "PALM"]
+
+        model = local_gestures.getModel(modelPath)
+        palm = model.classify(stripedImage(tmp_path / "palm.png", True, 100))
+        fist = model.classify(stripedImage(tmp_path / "fist.png", False, 101))
+        assert palm["Name"] == "PALM" and palm["Confidence"] > 80
+        assert fist["Name"] == "FIST" and fist["Confidence"] > 80
+
+    # Checks the local engine answers confident gestures itself and falls back to rekognition otherwise
+    def test_local_engine_falls_back(self, monkeypatch, tmp_path):
+        image = stripedImage(tmp_path / "palm.png", True, 100)
+        started = []
+        monkeypatch.setattr(gesture_recog, "projectHandler", started.append)
+        monkeypatch.setenv("LATEST_MODEL_ARN", TEST_MODEL_ARN)
+        client, stubber = stubbedClient("rekognition")
+        stubber.add_response("detect_custom_labels", {"CustomLabels": [{"Name": "FIST", "Confidence": 97.5}]})
+
+        monkeypatch.setattr(local_gestures, "classifyGesture", lambda image: {"Name": "PALM", "Confidence": 90.0})
+        with stubber:
+            assert gesture_recog.checkForGestures(image, "local") == {"Name": "PALM", "Confidence": 90.0}
+            assert started == []
+
+        monkeypatch.setattr(local_gestures, "classifyGesture", lambda image: {"Name": "PALM", "Confidence": 60.0})
+        with stubber:
+            assert gesture_recog.checkForGestures(image, "local") == {"Name": "FIST", "Confidence": 97.5}
+            assert started == [True]
+            stubber.assert_no_pending_responses()
+
+    # Checks the response is written to the file given with -r, so concurrent executions never share one
+    def test_response_file_argument(self, tmp_path):
+        responseFile = tmp_path / "response.json"
+        script = os.path.join(os.getenv('ROOT_DIR'), "src/scripts/gesture/local_gestures.py")
+        finished = subprocess.run(
+            [sys.executable, script, "-a", "train", "-d", str(tmp_path / "missing"), "-r", str(responseFile)],
+            capture_output=True
+        )
+        assert finished.returncode == 8
+        assert json.loads(responseFile.read_text())["CODE"] == 8
+        assert commons.parseResponseFile(["-a", "gesture", "-f", "-", "-r", "other.json"]) == "other.json"
+        assert commons.parseResponseFile(["-a", "gesture"]) is None
@@ -0,0 +1,142 @@
+# --------------------------------------------------------------------
+# Runs the pytest suite against the image preparation python scripts
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# --------------------------------------------------------------------
+
+import io
+import os
+import sys
+import mmap
+import base64
+import hashlib
+import struct
+
+import pytest
+from PIL import Image
+
+from dotenv import load_dotenv
+load_dotenv()
+
+sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts")
+import images  # noqa: E402
+
+
+def noisyImage(path, size, exif=None):
+    image = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3))
+    if exif is not None:
+        image.save(path, format="JPEG", quality=100, exif=exif)
+    else:
+        image.save(path, format="JPEG", quality=100)
+    return path
+
+
+class TestImages:
+    # Checks images already within the limits are sent untouched
+    def test_small_image_untouched(self, tmp_path):
+        path = noisyImage(tmp_path / "small.jpg", (64, 48))
+        assert images.fitImage(path) == path.read_bytes()
+
+    # Checks oversized images are re-encoded within the byte budget and resolution cap
+    def test_large_image_fitted(self, tmp_path):
+        path = noisyImage(tmp_path / "large.jpg", (800, 600))
+        assert os.path.getsize(path) > 200000
+        fitted = images.fitImage(path, maxBytes=200000, maxDimension=400)
+        assert len(fitted) <= 200000
+        with Image.open(io.BytesIO(fitted)) as image:
+            assert image.format == "JPEG"
+            assert max(image.size) <= 400
+
+    # Checks a budget smaller than any JPEG is rejected instead of shrinking forever
+    def test_budget_too_small(self, tmp_path):
+        path = noisyImage(tmp_path / "large.jpg", (800, 600))
+        with pytest.raises(ValueError):
+            images.fitImage(path, maxBytes=100)
+
+    # Checks images rotated by their EXIF data are sent upright
+    def test_exif_orientation_applied(self, tmp_path):
+        exif = Image.Exif()
+        exif[images.EXIF_ORIENTATION] = 6
+        path = noisyImage(tmp_path / "rotated.jpg", (64, 48), exif)
+        with Image.open(io.BytesIO(images.fitImage(path))) as image:
+            assert image.size == (48, 64)
+            assert image.getexif().get(images.EXIF_ORIENTATION, 1) == 1
+
+    # Checks images piped in on stdin are read frame by frame, in order
+    def test_stdin_frames(self, tmp_path):
+        first = noisyImage(tmp_path / "first.jpg", (64, 48)).read_bytes()
+        second = noisyImage(tmp_path / "second.jpg", (32, 24)).read_bytes()
+        stdin = io.BytesIO(struct.pack(">I", len(first)) + first + struct.pack(">I", len(second)) + second)
+        loaded = images.loadImageSources(["-", "FIST", "-"], stdin)
+        assert loaded[0].data == first and loaded[2].data == second
+        assert loaded[1] == "FIST"
+        assert str(loaded[2]) == "stdin:2"
+        assert images.fitImage(loaded[0]) == first
+        with pytest.raises(ValueError):
+            images.loadImageSource("-", stdin)
+
+    # Checks images in shared memory are copied out, leaving the segment for its creator (the server) to remove
+    @pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="POSIX shared memory is not mounted at /dev/shm")
+    def test_shared_memory(self, tmp_path):
+        imageBytes = noisyImage(tmp_path / "shared.jpg", (64, 48)).read_bytes()
+        name = f"eye-of-horus-test-{os.getpid()}"
+        with open(f"/dev/shm/{name}", "wb") as segment:
+            segment.write(imageBytes)
+        try:
+            loaded = images.loadImageSource(f"shm:{name}:{len(imageBytes)}")
+            assert images.isLocalImage(loaded)
+            assert images.readImage(loaded) == imageBytes
+            with images.openImage(loaded) as image:
+                assert image.size == (64, 48)
+            assert os.path.exists(f"/dev/shm/{name}")
+        finally:
+            os.remove(f"/dev/shm/{name}")
+        with pytest.raises(ValueError):
+            images.loadImageSource(f"shm:{name}")
+
+    # Checks data URIs are decoded, files get a handle and everything else is left as it is
+    def test_data_uri(self, tmp_path):
+        imageBytes = noisyImage(tmp_path / "uri.jpg", (64, 48)).read_bytes()
+        loaded = images.loadImageSource(f"data:image/jpeg;base64,{base64.b64encode(imageBytes).decode()}")
+        assert loaded.data == imageBytes
+        assert str(images.loadImageSource(str(tmp_path / "uri.jpg"))) == str(tmp_path / "uri.jpg")
+        assert images.loadImageSource("FIST") == "FIST"
+        assert images.loadImageSources(None) is None
+        with pytest.raises(ValueError):
+            images.loadImageSource("data:image/jpeg;base64,not base64!")
+
+    # Checks a file is read once, after which its format, dimensions, digest and fitted bytes all come from the handle
+    def test_handle_reads_once(self, tmp_path):
+        path = noisyImage(tmp_path / "once.jpg", (800, 600))
+        handle = images.imageHandle(str(path))
+        assert images.verifyImage(handle) is handle
+        assert handle.format == "JPEG"
+        imageBytes = handle.bytes()
+        os.remove(path)
+
+        assert handle.dimensions == (800, 600)
+        assert handle.digest == hashlib.sha256(imageBytes).hexdigest()
+        fitted = images.fitImage(handle, maxBytes=200000, maxDimension=400)
+        assert images.fitImage(handle, maxBytes=200000, maxDimension=400) is fitted
+        with images.openImage(handle) as image:
+            assert image.size == (800, 600)
+
+    # Checks large files are memory mapped and still readable by everything that uses the handle
+    def test_handle_memory_mapped(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(images, "MMAP_MIN_BYTES", 1)
+        path = noisyImage(tmp_path / "mapped.jpg", (64, 48))
+        handle = images.imageHandle(path)
+        assert isinstance(handle.data, mmap.mmap)
+        assert handle.bytes() == path.read_bytes()
+        assert images.fitImage(handle) == path.read_bytes()
+        assert handle.open().read() == path.read_bytes()
+
+    # Checks formats are sniffed from the magic bytes, so anything else is rejected without decoding it
+    def test_handle_format_sniffed(self, tmp_path):
+        pngPath = tmp_path / "image.png"
+        Image.new("RGB", (8, 8)).save(pngPath)
+        assert images.imageHandle(pngPath).format == "PNG"
+        assert images.imageHandle(b"RIFF\x00\x00\x00\x00WEBPVP8 ").format == "WEBP"
+        with pytest.raises(IOError):
+            images.verifyImage(b"not an image")
@@ -6,9 +6,7 @@
 # --------------------------------------------------------------------
 
 import sys
-import pytest
 import logging
-import json
 import os
 
 from dotenv import load_dotenv
@@ -16,6 +14,7 @@ load_dotenv()
 
 sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts")
 from manager import main, parseArgs  # noqa: E402
+from commons import ResponseError  # noqa: E402
 sys.path.append(os.getenv('ROOT_DIR') + "/src/scripts/gesture")
 from gesture.gesture_recog import projectHandler  # noqa: E402
 
@@ -28,16 +27,11 @@ def setup_module(__name__):
     logger.info("[INFO] Starting Rekognition project before running tests...")
     try:
         projectHandler(True)
-    except SystemExit:
-        # Ignore system exit errors as they ae generated by respond()
+    except ResponseError:
+        # Ignore response errors here, the tests themselves will report the failure
         pass
 
 
-def readResponseFile():
-    with open(f"{os.getenv('ROOT_DIR')}/src/scripts/response.json", "r") as logfile:
-        return json.loads(logfile.read())
-
-
 class TestManagerCreate:
     # Checks test user was successfully created
     def test_user_create_success(self):
@@ -50,9 +44,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 0
+        assert main(args).code == 0
 
     # Checks failed create action on missing profile
     def test_user_profile_fail(self):
@@ -64,9 +56,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 13
+        assert main(args).code == 13
 
     # Checks failed create action on missing face
     def test_user_face_fail(self):
@@ -78,9 +68,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 13
+        assert main(args).code == 13
 
     # Checks failed create action on missing face file
     def test_user_face_not_exist_fail(self):
@@ -93,9 +81,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 8
+        assert main(args).code == 8
 
     # Checks failed create action on txt face file
     def test_user_face_not_img_fail(self):
@@ -108,9 +94,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 7
+        assert main(args).code == 7
 
     # Checks failed create action on missing lock/unlock
     def test_user_gesture_fail(self):
@@ -122,9 +106,7 @@ class TestManagerCreate:
             "-f", f"{TEST_IMAGE_DIR}/test_face.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 13
+        assert main(args).code == 13
 
         args = parseArgs([
             "-m",
@@ -133,9 +115,7 @@ class TestManagerCreate:
             "-f", f"{TEST_IMAGE_DIR}/test_face.jpg",
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 13
+        assert main(args).code == 13
 
     # Checks failed create action on missing lock/unlock gesture file
     def test_user_gesture_not_exist_fail(self):
@@ -149,9 +129,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/foobar.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 17
+        assert main(args).code == 17
 
         # Unlock
         args = parseArgs([
@@ -162,9 +140,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/foobar.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 17
+        assert main(args).code == 17
 
     # Checks failed create action on broken combination rules lock/unlock gesture file
     def test_user_gesture_rule_broken_fail_on_create(self):
@@ -177,9 +153,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_1.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 20
+        assert main(args).code == 20
 
         args = parseArgs([
             "-m",
@@ -189,9 +163,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 21
+        assert main(args).code == 21
 
         args = parseArgs([
             "-m",
@@ -201,9 +173,7 @@ class TestManagerCreate:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_lock_4.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_1.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 22
+        assert main(args).code == 22
 
 
 class TestManagerEdit:
@@ -216,9 +186,7 @@ class TestManagerEdit:
             "-p", "testuser",
             "-f", f"{TEST_IMAGE_DIR}/test_face.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 0
+        assert main(args).code == 0
 
     # Checks a test gesture combination was successfully edited
     def test_user_edit_lock_success(self):
@@ -230,9 +198,7 @@ class TestManagerEdit:
             "-p", "testuser",
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 0
+        assert main(args).code == 0
 
         # Unlock Gesture
         args = parseArgs([
@@ -241,9 +207,7 @@ class TestManagerEdit:
             "-p", "testuser",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 0
+        assert main(args).code == 0
 
         # All Gesture
         args = parseArgs([
@@ -253,9 +217,7 @@ class TestManagerEdit:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 0
+        assert main(args).code == 0
 
     # Checks a full test user edit was successfully achieved
     def test_user_edit_all_success(self):
@@ -268,9 +230,7 @@ class TestManagerEdit:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_4.jpg", f"{TEST_IMAGE_DIR}/test_unlock_2.jpg", f"{TEST_IMAGE_DIR}/test_unlock_3.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 0
+        assert main(args).code == 0
 
     # Checks a test user's name ommited fails
     def test_user_edit_no_username_fail(self):
@@ -280,9 +240,7 @@ class TestManagerEdit:
             "-a", "edit",
             "-f", f"{TEST_IMAGE_DIR}/foobar.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 13
+        assert main(args).code == 13
 
     # Checks a test user's name not exist fails
     def test_user_edit_invalid_user_fail(self):
@@ -293,9 +251,7 @@ class TestManagerEdit:
             "-p", "foobar",
             "-f", f"{TEST_IMAGE_DIR}/test_face.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 9
+        assert main(args).code == 9
 
     # Checks a test user's face that does not exist fails
     def test_user_edit_face_not_exist_fail(self):
@@ -306,9 +262,7 @@ class TestManagerEdit:
             "-p", "testuser",
             "-f", f"{TEST_IMAGE_DIR}/foobar.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 8
+        assert main(args).code == 8
 
     # Checks a test user's face that is not an image fails
     def test_user_edit_face_not_image_fail(self):
@@ -319,9 +273,7 @@ class TestManagerEdit:
             "-p", "testuser",
             "-f", f"{TEST_IMAGE_DIR}/placeholder.txt"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 7
+        assert main(args).code == 7
 
     # Checks failed edit action on broken combination rules lock/unlock gesture file
     def test_user_gesture_rule_broken_fail_on_edit(self):
@@ -332,9 +284,7 @@ class TestManagerEdit:
             "-p", "testuser",
             "-u", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg", f"{TEST_IMAGE_DIR}/test_unlock_1.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 20
+        assert main(args).code == 20
 
         args = parseArgs([
             "-m",
@@ -343,9 +293,7 @@ class TestManagerEdit:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 21
+        assert main(args).code == 21
 
         args = parseArgs([
             "-m",
@@ -354,9 +302,7 @@ class TestManagerEdit:
             "-l", f"{TEST_IMAGE_DIR}/test_lock_1.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_4.jpg",
             "-u", f"{TEST_IMAGE_DIR}/test_lock_4.jpg", f"{TEST_IMAGE_DIR}/test_lock_3.jpg", f"{TEST_IMAGE_DIR}/test_lock_2.jpg", f"{TEST_IMAGE_DIR}/test_lock_1.jpg"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 22
+        assert main(args).code == 22
 
 
 class TestManagerDelete:
@@ -367,9 +313,7 @@ class TestManagerDelete:
             "-m",
             "-a", "delete"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 13
+        assert main(args).code == 13
 
     # Checks a test user doesn't exist fails
     def test_user_delete_user_not_exist_fail(self):
@@ -379,9 +323,7 @@ class TestManagerDelete:
             "-a", "delete",
             "-p", "foobar"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 9
+        assert main(args).code == 9
 
     # Checks a test user delete succeeds
     def test_user_delete_user_succeeds(self):
@@ -391,9 +333,7 @@ class TestManagerDelete:
             "-a", "delete",
             "-p", "testuser"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 0
+        assert main(args).code == 0
 
     # Checks the user just deleted was actually deleted
     def test_user_delete_user_succeeded(self):
@@ -403,9 +343,7 @@ class TestManagerDelete:
             "-a", "delete",
             "-p", "testuser"
         ])
-        with pytest.raises(SystemExit):
-            main(args)
-        assert readResponseFile()['CODE'] == 9
+        assert main(args).code == 9
 
 
 # After running tests, shutdown project
@@ -413,5 +351,5 @@ def teardown_module(__name__):
     logger.info("[INFO] All tests completed, shutting down rekog project...")
     try:
         projectHandler(False)
-    except SystemExit:
+    except ResponseError:
         pass
@@ -0,0 +1,238 @@
+# -----------------------------------------------------------
+# Lightweight tracing of how long each action, helper and AWS call takes, returned with the action's response
+#
+# Copyright (c) 2021 Morgan Davies, UK
+# Released under GNU GPL v3 License
+# -----------------------------------------------------------
+
+import os
+import json
+import time
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Trace every action (as if --trace was given). TRACE_OUTPUT also writes each trace to that path as Chrome trace JSON (open it in chrome://tracing or Perfetto)
+TRACE_ENABLED = os.getenv("TRACE", "false").lower() == "true"
+TRACE_OUTPUT = os.getenv("TRACE_OUTPUT") or None
+
+# The trace of the action running in this context. Threads only see it if their work is wrapped with wrap()
+currentTrace = contextvars.ContextVar("currentTrace", default=None)
+
+
+class Trace:
+    """Trace : Spans recorded while running one action"""
+
+    def __init__(self, name):
+        self.name = name
+        self.thread = threading.get_ident()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, category, start, end, args=None):
+        """record() : Adds a finished span to the trace
+        :param name: Name of the span (e.g. the function or AWS operation)
+        :param category: Kind of span (action, helper or aws)
+        :param start: perf_counter() value the span started at
+        :param end: perf_counter() value the span ended at
+        :param args: Optional JSON serialisable details of the span
+        """
+        thread = threading.current_thread()
+        with self.lock:
+            self.threads.setdefault(thread.ident, thread.name)
+            self.spans.append({
+                "NAME": name,
+                "CATEGORY": category,
+                "START": start - self.origin,
+                "SECONDS": end - start,
+                "THREAD": thread.ident,
+                "ARGS": args
+            })
+
+    def summary(self):
+        """summary() : Totals the spans of the trace by name
+        :return: Dictionary of the total SECONDS so far, then the COUNT and total SECONDS of every helper SPAN and AWS_CALL, and of the spans on the CRITICAL_PATH (the action's own thread, which any concurrent work shows up on as time spent waiting for it)
+        """
+        totals = {"span": {}, "aws": {}, "critical": {}}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span["CATEGORY"] == "action":
+                continue
+            kinds = ["aws" if span["CATEGORY"] == "aws" else "span"]
+            if span["THREAD"] == self.thread:
+                kinds.append("critical")
+            for kind in kinds:
+                total = totals[kind].setdefault(span["NAME"], {"COUNT": 0, "SECONDS": 0.0})
+                total["COUNT"] += 1
+                total["SECONDS"] += span["SECONDS"]
+
+        def rounded(spanTotals):
+            return {name: {"COUNT": total["COUNT"], "SECONDS": round(total["SECONDS"], 4)} for name, total in sorted(spanTotals.items())}
+
+        return {
+            "SECONDS": round(time.perf_counter() - self.origin, 4),
+            "SPANS": rounded(totals["span"]),
+            "AWS_CALLS": rounded(totals["aws"]),
+            "CRITICAL_PATH": rounded(totals["critical"])
+        }
+
+    def chromeTrace(self):
+        """chromeTrace() : Converts the trace to the Chrome trace event format
+        :return: Dictionary that can be written out as Chrome trace JSON
+        """
+        with self.lock:
+            spans = list(self.spans)
+            threads = dict(self.threads)
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+            for ident, name in threads.items()
+        ]
+        events.extend(
+            {
+                "name": span["NAME"],
+                "cat": span["CATEGORY"],
+                "ph": "X",
+                "ts": round(span["START"] * 1000000, 1),
+                "dur": round(span["SECONDS"] * 1000000, 1),
+                "pid": os.getpid(),
+                "tid": span["THREAD"],
+                "args": span["ARGS"] or {}
+            }
+            for span in spans
+        )
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"action": self.name}}
+
+    def writeChromeTrace(self, path):
+        """writeChromeTrace() : Writes the trace to a file as Chrome trace JSON
+        :param path: Path of the file to write
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tempFile = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tempFile, "w") as traceFile:
+            json.dump(self.chromeTrace(), traceFile)
+        os.replace(tempFile, path)
+
+
+@contextmanager
+def span(name, category="helper", **args):
+    """span() : Times the code within it as a span of the current trace. Does nothing if no trace is running
+    :param name: Name of the span
+    :param category: Kind of span (action, helper or aws)
+    """
+    trace = currentTrace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(name, category, start, time.perf_counter(), args or None)
+
+
+def traced(function):
+    """traced() : Decorator that times every call of a function as a span of the current trace"""
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def tracedFunction(*args, **kwargs):
+        trace = currentTrace.get()
+        if trace is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            trace.record(name, "helper", start, time.perf_counter())
+    return tracedFunction
+
+
+def wrap(function):
+    """wrap() : Carries the current trace over to work that runs on another thread (e.g. submitted to a thread pool)
+    :param function: Function that will be run on another thread
+    :return: Function that runs it in the current trace
+    """
+    if currentTrace.get() is None:
+        return function
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def wrappedFunction(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so every call gets its own copy
+        return context.copy().run(function, *args, **kwargs)
+    return wrappedFunction
+
+
+@contextmanager
+def tracing(name, enabled=None):
+    """tracing() : Records a trace of the code within it
+    :param name: Name of the traced action
+    :param enabled: Whether to trace. Defaults to TRACE
+    :return: The Trace being recorded, or None if tracing is disabled
+    """
+    if not (TRACE_ENABLED if enabled is None else enabled):
+        yield None
+        return
+    trace = Trace(name)
+    token = currentTrace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.record(name, "action", start, time.perf_counter())
+        currentTrace.reset(token)
+
+
+def attach(response, trace, output=None):
+    """attach() : Adds the summary of a trace to the CONTENT of a response, and writes the trace out as Chrome trace JSON if asked to
+    :param response: Response of the traced action
+    :param trace: Trace from tracing(), or None if tracing was disabled
+    :param output: Path to write the Chrome trace to. Defaults to TRACE_OUTPUT
+    :return: The response
+    """
+    if trace is None:
+        return response
+    output = output or TRACE_OUTPUT
+    if output is not None:
+        try:
+            trace.writeChromeTrace(output)
+        except OSError as e:
+            print(f"[WARNING] Failed to write the trace to {output}: {e}")
+
+    if response.content is None:
+        response.content = {}
+    if isinstance(response.content, dict):
+        response.content["TRACE"] = trace.summary()
+    return response
+
+
+def beforeCall(context, **kwargs):
+    if currentTrace.get() is not None:
+        context["traceStart"] = time.perf_counter()
+
+
+def afterCall(context, event_name, **kwargs):
+    trace = currentTrace.get()
+    start = context.get("traceStart")
+    if trace is not None and start is not None:
+        # event_name is after-call.<service>.<operation>
+        trace.record(event_name.split(".", 1)[1], "aws", start, time.perf_counter())
+
+
+def instrumentClient(client):
+    """instrumentClient() : Times every call made by a boto3 client as a span of the current trace. Calls made while no trace is running are left alone
+    :param client: boto3 client to instrument
+    :return: The client
+    """
+    # Timed from before the parameters are built, which (unlike before-call) is never skipped by a handler answering the call itself
+    client.meta.events.register("before-parameter-build", beforeCall, unique_id="tracing-before-call")
+    client.meta.events.register("after-call", afterCall, unique_id="tracing-after-call")
+    return client
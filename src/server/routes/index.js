@@ -2,6 +2,8 @@ var express = require('express')
 var router = express.Router()
 var fileUpload = require('express-fileupload')
 var fs = require("fs")
+var crypto = require("crypto")
+var responses = require("./responses")
 var spawn = require('child_process').spawn
 
 router.use(fileUpload())
@@ -11,78 +13,79 @@ router.get('/', function(req, res, next) {
   res.render('index', { title: 'Express' })
 })
 
+// Uploaded images are kept in shared memory (/dev/shm) where the OS has it, so the python scripts read them from RAM as shm:<name> instead of from files in public/
+const SHARED_MEMORY_DIR = "/dev/shm"
+const SEGMENT_PREFIX = "eye-of-horus-"
+const PUBLIC_DIR = `${process.env.ROOT_DIR}/src/server/public`
+// Uploads are reused by the following requests of the same sign up or login, so they are only removed once they are this many seconds old
+const UPLOAD_TTL = parseInt(process.env.UPLOAD_TTL || "900") * 1000
+const useSharedMemory = fs.existsSync(SHARED_MEMORY_DIR)
+
+function storeImage(buffer) {
+  const name = `${SEGMENT_PREFIX}${crypto.randomBytes(12).toString('hex')}`
+  if (useSharedMemory) {
+    fs.writeFileSync(`${SHARED_MEMORY_DIR}/${name}`, buffer, { mode: 0o600 })
+    return `shm:${name}`
+  }
+  const path = `${PUBLIC_DIR}/${name}.jpg`
+  fs.writeFileSync(path, buffer, { mode: 0o600 })
+  return path
+}
+
+function sweepUploads() {
+  const directory = useSharedMemory ? SHARED_MEMORY_DIR : PUBLIC_DIR
+  fs.readdir(directory, function (err, names) {
+    if (err) {
+      return console.log(`Failed to sweep old uploads from ${directory}: ${err}`)
+    }
+    names.filter(name => name.startsWith(SEGMENT_PREFIX)).forEach(name => {
+      const path = `${directory}/${name}`
+      fs.stat(path, function (err, stats) {
+        if (!err && Date.now() - stats.mtimeMs > UPLOAD_TTL) {
+          fs.unlink(path, function () {})
+        }
+      })
+    })
+  })
+}
+setInterval(sweepUploads, Math.min(UPLOAD_TTL, 60000)).unref()
+
 router.post('/upload/file', function(req, res, next) {
   // Verify req params
-  if (req.files === undefined || Object.keys(req.files).length <= 0) {
-    res.status(400).send("No files supplied")
+  if (req.files === undefined || req.files === null || Object.keys(req.files).length <= 0) {
+    return res.status(400).send("No files supplied")
   }
 
-  // Iterate through files and upload one at a time
+  // Store each file under a unique name, so concurrent users never overwrite each other's images
   let uploadedPaths = []
-  Object.keys(req.files).forEach(fileWrapper => {
-    let fileObj = req.files[fileWrapper]
-    console.log(`UPLOADING ${fileObj.name}`)
-    let currentFilePath = `${process.env.ROOT_DIR}/src/server/public/${fileObj.name}`
-
-    // Delete old copy if it exists
-    try {
-      fs.unlinkSync(currentFilePath)
-      console.log("Successfully deleted old file");
-    } catch (err) {
-      if (err && err.code === 'ENOENT') {
-        // File doesn't exist
-        console.log("Old File doesn't exist, won't remove it.")
-      } else {
-        // Other errors, e.g. maybe we don't have enough permission
-        res.status(500).send("Error occurred while trying to remove file")
-      }
-    }
-
-    // Upload new
-    fileObj.mv(
-      currentFilePath,
-      function (err) {
-        if (err) {
-          return res.status(500).send(err)
-        }
-      }
-    )
-
-    console.log(`SUCCESSFULLY UPLOADED ${fileObj.name}`)
-    uploadedPaths.push(currentFilePath)
-  })
+  try {
+    Object.keys(req.files).forEach(fileWrapper => {
+      let fileObj = req.files[fileWrapper]
+      console.log(`UPLOADING ${fileObj.name}`)
+      const path = storeImage(fileObj.data)
+      console.log(`SUCCESSFULLY UPLOADED ${fileObj.name} TO ${path}`)
+      uploadedPaths.push(path)
+    })
+  } catch (err) {
+    return res.status(500).send(`Error occurred while trying to store file: ${err}`)
+  }
 
-  // Return server side paths to uploaded files
+  // Return server side paths (or shared memory names) of the uploaded files
   return res.send(uploadedPaths)
 });
 
 router.post('/upload/encoded', function(req, res, next) {
-  if (req.body.encoded === undefined) { res.status(500).send("No encoded object uploaded") }
-  const path = `${process.env.ROOT_DIR}/src/server/public/${Math.floor((Math.random() * 1000000) + 1).toString()}.jpg`
+  if (req.body.encoded === undefined) { return res.status(500).send("No encoded object uploaded") }
 
-  // Delete old copy if it exists
+  // Create new image from data
+  const data = req.body.encoded.replace(/^data:image\/\w+;base64,/, "")
+  let path = null
   try {
-    fs.unlinkSync(path)
-    console.log("Successfully deleted old file");
+    path = storeImage(Buffer.from(data, 'base64'))
   } catch (err) {
-    if (err && err.code === 'ENOENT') {
-      // File doesn't exist
-      console.log("Old File doesn't exist, won't remove it.")
-    } else {
-      // Other errors, e.g. maybe we don't have enough permission
-      res.status(500).send("Error occurred while trying to remove file")
-    }
+    return res.status(500).send(`Error occurred while trying to store capture: ${err}`)
   }
 
-  // Create new file from data
-  const data = req.body.encoded.replace(/^data:image\/\w+;base64,/, "")
-  let buffer = new Buffer(data, 'base64')
-  fs.writeFile(path, buffer, function(err, result) {
-    if (err) {
-      return res.status(500).send(err)
-    }
-  })
-
   console.log(`SUCCESSFULLY UPLOADED AND CONVERTED CAPTURE TO ${path}`)
   res.status(200).send([path])
 })
@@ -97,13 +100,16 @@ router.post("/types", function(req, res, next) {
     args.push(path)
   })
 
+  const responseFile = responses.responsePath()
+  args.push("-r", responseFile)
+
   let response = null
   let logs = null
   const gestureRequest = spawn("python", args)
 
   gestureRequest.on('error', function(err) {
     console.log(`Gesture types child process errored with message: ${err}`)
-    response = JSON.parse(fs.readFileSync(`${process.env.ROOT_DIR}/src/scripts/response.json`))
+    response = responses.readResponse(responseFile)
     if (response === false) {
         res.sendStatus(500)
     } else {
@@ -117,7 +123,11 @@ router.post("/types", function(req, res, next) {
 
   gestureRequest.on('close', (code) => {
     console.log(`Gesture types child process close all stdio with code ${code}\nLogs collected:\n${logs}`)
-    response = JSON.parse(fs.readFileSync(`${process.env.ROOT_DIR}/src/scripts/response.json`))
+    response = responses.readResponse(responseFile)
+    responses.removeResponse(responseFile)
+    if (response === false) {
+      return res.sendStatus(500)
+    }
 
     if (response.TYPE === "ERROR") {
       res.status(400).send(response.MESSAGE)
@@ -0,0 +1,23 @@
+var fs = require('fs')
+var os = require('os')
+var path = require('path')
+var crypto = require('crypto')
+
+// Each script execution is given its own response file (with -r), so concurrent requests never read each other's response
+function responsePath() {
+    return path.join(os.tmpdir(), `eye-of-horus-response-${crypto.randomBytes(12).toString('hex')}.json`)
+}
+
+function readResponse(responseFile) {
+    try {
+        return JSON.parse(fs.readFileSync(responseFile))
+    } catch (err) {
+        return false
+    }
+}
+
+function removeResponse(responseFile) {
+    fs.unlink(responseFile, function () {})
+}
+
+module.exports = { responsePath, readResponse, removeResponse }
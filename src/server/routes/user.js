@@ -5,6 +5,7 @@ var spawnSync = require('child_process').spawnSync
 var fs = require('fs')
 var cors = require('cors')
 var AWS = require('aws-sdk')
+var responses = require('./responses')
 
 var S3 = new AWS.S3()
 
@@ -12,13 +13,6 @@ router.use(cors())
 
 const badCreds = `Incorrect face or gesture combination given`
 
-function readResponse() {
-    try {
-        return JSON.parse(fs.readFileSync(`${process.env.ROOT_DIR}/src/scripts/response.json`))
-    } catch (err) {
-        return false
-    }
-}
 
 router.post("/exists", function(req, res, next) {
     if (req.body.user === undefined) {
@@ -107,12 +101,14 @@ router.post("/create", function(req, res, next) {
         args.push(gesture)
     })
 
+    const responseFile = responses.responsePath()
+    args.push("-r", responseFile)
     const createRequest = spawn("python", args)
 
     // On error event, something has gone wrong early so read response file if exists or exit with error
     createRequest.on('error', function(err) {
         console.log(`Create child process errored with message: ${err}`)
-        response = readResponse()
+        response = responses.readResponse(responseFile)
         if (response === false) {
             res.sendStatus(500)
         } else {
@@ -128,7 +124,8 @@ router.post("/create", function(req, res, next) {
         console.log(`Create child process close all stdio with code ${code}\nLogs collected:\n${logs}`)
 
         // Read response file if exists
-        response = readResponse()
+        response = responses.readResponse(responseFile)
+        responses.removeResponse(responseFile)
         if (response === false) {
             res.sendStatus(500)
         }
@@ -146,13 +143,14 @@ function checkFace(user, face) {
     let faceResponse = null
 
     // Authenticate face
-    const faceArgs = [`${process.env.ROOT_DIR}/src/scripts/manager.py`, "-m", "-a", "compare", "-f", `${face}`, "-p", `${user}`]
+    const responseFile = responses.responsePath()
+    const faceArgs = [`${process.env.ROOT_DIR}/src/scripts/manager.py`, "-m", "-a", "compare", "-f", `${face}`, "-p", `${user}`, "-r", responseFile]
 
     try {
         spawnSync("python", faceArgs)
     } catch (err) {
         console.log(`Face child process errored with message: ${err}`)
-        faceResponse = readResponse()
+        faceResponse = responses.readResponse(responseFile)
         if (faceResponse === false) {
             return 500
         } else {
@@ -162,7 +160,8 @@ function checkFace(user, face) {
 
     // Read response file if exists
     console.log("Face child process close all stdio with exit code 0")
-    faceResponse = readResponse()
+    faceResponse = responses.readResponse(responseFile)
+    responses.removeResponse(responseFile)
     if (faceResponse === false) {
         return 500
     } else if (faceResponse.TYPE === "ERROR") {
@@ -231,12 +230,14 @@ router.post("/auth", function(req, res, next) {
                 gestureArgs.push(gesture)
             })
         }
+        const responseFile = responses.responsePath()
+        gestureArgs.push("-r", responseFile)
         const gestureRequest = spawn("python", gestureArgs)
 
         // On error event, something has gone wrong early so read response file if exists or exit with error
         gestureRequest.on('error', function(err) {
             console.log(`Gesture child process errored with message: ${err}`)
-            gestureResponse = readResponse()
+            gestureResponse = responses.readResponse(responseFile)
             if (gestureResponse === false) {
                 res.sendStatus(500)
             } else {
@@ -251,7 +252,8 @@ router.post("/auth", function(req, res, next) {
         gestureRequest.on('close', (code) => {
             console.log(`Gesture child process close all stdio with code ${code}\nLogs collected:\n${gestureLogs}`)
             // Read response file if exists
-            gestureResponse = readResponse()
+            gestureResponse = responses.readResponse(responseFile)
+            responses.removeResponse(responseFile)
             if (gestureResponse === false) {
                 res.sendStatus(500)
             }
@@ -317,11 +319,13 @@ router.post("/edit", function(req, res, next) {
             args.push(gesture)
         })
     }
+    const responseFile = responses.responsePath()
+    args.push("-r", responseFile)
     const request = spawn("python", args)
 
     request.on('error', function(err) {
         console.log(`Edit child process errored with message: ${err}`)
-        response = readResponse()
+        response = responses.readResponse(responseFile)
         if (response === false) {
             res.sendStatus(500)
         } else {
@@ -335,7 +339,8 @@ router.post("/edit", function(req, res, next) {
 
     request.on('close', (code) => {
         console.log(`Edit child process close all stdio with code ${code}\nLogs collected:\n${logs}`)
-        response = readResponse()
+        response = responses.readResponse(responseFile)
+        responses.removeResponse(responseFile)
         if (response === false) {
             res.sendStatus(500)
         }
@@ -358,11 +363,13 @@ router.post("/delete", function(req, res, next) {
     }
 
     let args = [`${process.env.ROOT_DIR}/src/scripts/manager.py`, "-m", "-a", "delete", "-p", `${req.body.user}`]
+    const responseFile = responses.responsePath()
+    args.push("-r", responseFile)
     const request = spawn("python", args)
 
     request.on('error', function(err) {
         console.log(`Delete child process errored with message: ${err}`)
-        response = readResponse()
+        response = responses.readResponse(responseFile)
         if (response === false) {
             res.sendStatus(500)
         } else {
@@ -376,7 +383,8 @@ router.post("/delete", function(req, res, next) {
 
     request.on('close', (code) => {
         console.log(`Delete child process close all stdio with code ${code}\nLogs collected:\n${logs}`)
-        response = readResponse()
+        response = responses.readResponse(responseFile)
+        responses.removeResponse(responseFile)
         if (response === false) {
             res.sendStatus(500)
         }